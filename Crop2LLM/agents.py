@@ -0,0 +1,95 @@
+import os
+import hashlib
+import threading
+from dataclasses import dataclass
+from utilities import extract_text
+from telemetry import agent_name
+
+#-----------------------------------------------------------------
+# Registry of the agents : the instructions of each config/Agents/Agent-*.txt file, loaded once per run
+# An agent is identified by the path of its default instructions file. When a folder of overrides is given, a file
+# of the same name in that folder replaces the default instructions.
+#-----------------------------------------------------------------
+
+# Default reasoning effort and verbosity of each agent
+AGENT_SETTINGS = {
+  "UnitMeta": ("medium", "low"),
+  "CompositeMeta": ("high", "low"),
+  "PyRefactor": ("high", "low"),
+  "PyConsensus": ("high", "low"),
+  "AlgoMeta": ("high", "low"),
+  "CyMLTranspile": ("high", "low"),
+  "DebugCode": ("high", "medium"),
+  "DebugXML": ("high", "medium"),
+  "ApplyCode": ("medium", "low"),
+  "ApplyXML": ("medium", "low"),
+  "CodeOrXML": ("medium", "low"),
+  "Summarize": ("low", "low"),
+}
+DEFAULT_SETTINGS = ("high", "low")
+# Reasoning effort and verbosity of the agents given a draft of their answer, computed without any agent
+DRAFT_SETTINGS = {
+  "AlgoMeta": ("low", "low"),
+}
+
+_lock = threading.Lock()
+_state = {"overrides_folder": None, "agents": {}}
+
+
+#-----------------------------------------------------------------
+# Instructions of an agent, hash is the sha256 of its text
+#-----------------------------------------------------------------
+@dataclass(frozen=True)
+class Agent:
+  name: str
+  path: str
+  text: str
+  hash: str
+  reasoning_effort: str
+  verbosity: str
+
+
+def _load_agent(agent_path):
+  path = agent_path
+  overrides_folder = _state["overrides_folder"]
+  if overrides_folder is not None:
+    override = os.path.join(overrides_folder, os.path.basename(agent_path))
+    if os.path.exists(override):
+      path = override
+
+  if not os.path.exists(path):
+    raise FileNotFoundError(f"Configuration file {path} does not exist")
+  try:
+    text = extract_text(path)
+  except Exception as e:
+    raise ValueError(f"Cannot read configuration file {path}: {e}")
+
+  name = agent_name(agent_path)
+  reasoning_effort, verbosity = AGENT_SETTINGS.get(name, DEFAULT_SETTINGS)
+  return Agent(name, path, text, hashlib.sha256(text.encode("utf-8")).hexdigest(), reasoning_effort, verbosity)
+
+
+#-----------------------------------------------------------------
+# Function to load the instructions of all the agents, once at startup
+# Raises FileNotFoundError or ValueError when an instructions file is missing or cannot be read.
+#-----------------------------------------------------------------
+def load_agents(agent_paths, overrides_folder=None):
+  with _lock:
+    _state["overrides_folder"] = overrides_folder
+    _state["agents"] = {path: _load_agent(path) for path in agent_paths}
+    return dict(_state["agents"])
+
+
+#-----------------------------------------------------------------
+# Function to get an agent from the path of its default instructions file
+# Agents that were not loaded at startup are loaded on their first use.
+#-----------------------------------------------------------------
+def get_agent(agent_path):
+  agent = _state["agents"].get(agent_path)
+  if agent is None:
+    with _lock:
+      agent = _state["agents"].get(agent_path)
+      if agent is None:
+        agent = _load_agent(agent_path)
+        _state["agents"][agent_path] = agent
+  return agent
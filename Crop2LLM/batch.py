@@ -0,0 +1,162 @@
+import os
+import json
+import time
+import threading
+from dataclasses import dataclass, field
+from dag import TaskGraph
+
+#-----------------------------------------------------------------
+# Batch of conversions
+# A manifest lists conversion jobs, each one either converts model units and their composite into a Crop2ML package
+# (as --unit) or a Crop2ML package into the other languages (as --package). The jobs run on one pool of workers and
+# share the response cache, the client pool and the rate limiter of the models, so that running several models
+# together never sends more requests than the limits of the OpenAI tier.
+# A job starts once the jobs listed in its "after" key are done, and is skipped when one of them failed : a package
+# job on the package produced by a unit job of the same manifest must run after it.
+#
+# JSON manifest, the YAML equivalent can be used when PyYAML is installed, relative paths are from the manifest folder :
+# {"jobs": [
+#   {"name": "SQ_Wheat_Phenology", "unit": [["a.cs", "b.cs"], ["c.cs"]], "composite": "comp.cs", "output": "out/SQ", "resume": true},
+#   {"name": "SQ_Wheat_Phenology_package", "package": "out/SQ/SQ_Wheat_Phenology", "after": ["SQ_Wheat_Phenology"]}
+# ]}
+#-----------------------------------------------------------------
+@dataclass
+class Job:
+  name: str
+  units: list = field(default_factory=list)
+  composite: str = None
+  output: str = None
+  package: str = None
+  asyncio: bool = False
+  resume: bool = False
+  after: list = field(default_factory=list)
+
+  @property
+  def kind(self):
+    return "package" if self.package is not None else "unit"
+
+
+@dataclass
+class JobResult:
+  name: str
+  kind: str
+  status: str
+  elapsed: float
+  result: str = None
+  error: str = None
+
+
+#-----------------------------------------------------------------
+# Function to read the jobs of a manifest
+#-----------------------------------------------------------------
+def load_manifest(manifest_path):
+  with open(manifest_path, "r", encoding="utf-8") as f:
+    if manifest_path.endswith((".yaml", ".yml")):
+      try:
+        import yaml
+      except ImportError:
+        raise ImportError("PyYAML is needed to read a YAML manifest, install it or use a JSON manifest")
+      manifest = yaml.safe_load(f)
+    else:
+      manifest = json.load(f)
+
+  entries = manifest.get("jobs", []) if isinstance(manifest, dict) else manifest
+  if not isinstance(entries, list) or not entries:
+    raise ValueError(f"The manifest {manifest_path} does not contain any job")
+
+  folder = os.path.dirname(os.path.abspath(manifest_path))
+  resolve = lambda path: path if path is None else os.path.normpath(os.path.join(folder, path))
+  jobs = []
+  names = set()
+  for i, entry in enumerate(entries):
+    name = entry.get("name", f"job{i + 1}")
+    if name in names:
+      raise ValueError(f"Job {name} is defined twice in {manifest_path}")
+    names.add(name)
+
+    # The jobs to wait for must be defined before, so that the jobs never wait for each other
+    after = entry.get("after", [])
+    after = [after] if isinstance(after, str) else list(after)
+    for dependency in after:
+      if dependency not in names or dependency == name:
+        raise ValueError(f"Job {name} runs after {dependency}, which must be defined before it in {manifest_path}")
+
+    if ("unit" in entry) == ("package" in entry):
+      raise ValueError(f"Job {name} must have either unit or package, not both")
+    if "package" in entry:
+      jobs.append(Job(name, package=resolve(entry["package"]), after=after))
+      continue
+
+    if "output" not in entry:
+      raise ValueError(f"Job {name} must have an output folder")
+    # A unit made of a single file can be given as a string instead of a list of files
+    units = [[resolve(f) for f in ([unit] if isinstance(unit, str) else unit)] for unit in entry["unit"]]
+    jobs.append(Job(name, units=units, composite=resolve(entry.get("composite")), output=resolve(entry["output"]),
+                    asyncio=bool(entry.get("asyncio", False)), resume=bool(entry.get("resume", False)), after=after))
+  return jobs
+
+
+#-----------------------------------------------------------------
+# Function to run the jobs, at most max_jobs at the same time, each one once the jobs it runs after are done
+# run_job(job) returns the package generated, or a false value when the conversion failed without raising an error.
+# A failed job does not stop the others, only the jobs running after it. Returns the JobResult of each job, in the
+# order of the manifest.
+#-----------------------------------------------------------------
+def run_batch(jobs, run_job, max_jobs):
+  lock = threading.Lock()
+  finished = [0]
+
+  def run(job, *dependencies):
+    failed = [d.name for d in dependencies if d.status != "ok"]
+    if failed:
+      job_result = JobResult(job.name, job.kind, "skipped", 0.0, error=f"Not run, {', '.join(failed)} did not succeed")
+      with lock:
+        finished[0] += 1
+        print(f"Job {job.name} skipped ({finished[0]}/{len(jobs)})")
+      return job_result
+
+    print(f"Starting job {job.name} ({job.kind})...")
+    start = time.perf_counter()
+    try:
+      result = run_job(job)
+      status, error = ("ok", None) if result else ("failed", "The conversion did not succeed, see the report of the job")
+    except Exception as e:
+      result, status, error = None, "failed", f"{type(e).__name__}: {e}"
+    job_result = JobResult(job.name, job.kind, status, time.perf_counter() - start, None if result in (None, True, False) else str(result), error)
+    with lock:
+      finished[0] += 1
+      print(f"Job {job.name} {status} in {job_result.elapsed:.1f} s ({finished[0]}/{len(jobs)})")
+    return job_result
+
+  # Each job runs in its own copy of the context, its checkpoint and telemetry scope are not seen by the others.
+  # run never raises, so a failed job does not stop the graph.
+  graph = TaskGraph()
+  for job in jobs:
+    graph.add(job.name, lambda *dependencies, job=job: run(job, *dependencies), job.after)
+  results = graph.run(max_jobs)
+  return [results[job.name] for job in jobs]
+
+
+#-----------------------------------------------------------------
+# Function to write the consolidated report of the batch, as JSON, and return it as a table
+#-----------------------------------------------------------------
+def write_batch_report(results, report_path, elapsed):
+  report = {
+    "jobs": len(results),
+    "succeeded": sum(r.status == "ok" for r in results),
+    "failed": sum(r.status == "failed" for r in results),
+    "skipped": sum(r.status == "skipped" for r in results),
+    "elapsed": round(elapsed, 3),
+    "results": [{"name": r.name, "kind": r.kind, "status": r.status, "elapsed": round(r.elapsed, 3),
+                 "result": r.result, "error": r.error} for r in results],
+  }
+  with open(report_path, "w", encoding="utf-8") as f:
+    json.dump(report, f, ensure_ascii=False, indent=2)
+
+  lines = [f"{'job':<40} {'kind':<8} {'status':<7} {'time (s)':>9}"]
+  for r in results:
+    lines.append(f"{r.name[:40]:<40} {r.kind:<8} {r.status:<7} {r.elapsed:9.1f}")
+    if r.error:
+      lines.append(f"  {r.error}")
+  lines.append(f"{report['succeeded']} succeeded, {report['failed']} failed, {report['skipped']} skipped in {elapsed:.1f} s")
+  return "\n".join(lines)
@@ -0,0 +1,158 @@
+import ast
+import asyncio
+import hashlib
+import concurrent.futures
+
+#-----------------------------------------------------------------
+# Streaming selection of the refactored python candidates
+# Each candidate is parsed as it arrives : candidates that are not valid python are dropped, the others are
+# fingerprinted on their AST. As soon as quorum candidates are AST-equivalent one of them is taken as is and the
+# consensus agent is not called. When the candidates all differ, extra candidates can be requested.
+#-----------------------------------------------------------------
+
+
+#-----------------------------------------------------------------
+# Function to remove the markdown fences around python code
+#-----------------------------------------------------------------
+def strip_code_fences(code):
+  code = code.strip()
+  if code.startswith("```"):
+    code = code.split("\n", 1)[1] if "\n" in code else ""
+    if code.rstrip().endswith("```"):
+      code = code.rstrip()[:-3]
+  return code
+
+
+#-----------------------------------------------------------------
+# Function to get the structural fingerprint of python code, None when the code does not parse
+# Docstrings, comments and formatting are ignored, names and literals are kept.
+#-----------------------------------------------------------------
+def candidate_fingerprint(code):
+  try:
+    tree = ast.parse(strip_code_fences(code))
+  except (SyntaxError, ValueError):
+    return None
+
+  for node in ast.walk(tree):
+    if isinstance(node, (ast.Module, ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)) and node.body:
+      first = node.body[0]
+      if isinstance(first, ast.Expr) and isinstance(first.value, ast.Constant) and isinstance(first.value.value, str):
+        node.body = node.body[1:] or [ast.Pass()]
+  return hashlib.sha256(ast.dump(tree, annotate_fields=False).encode("utf-8")).hexdigest()
+
+
+#-----------------------------------------------------------------
+# Candidates received so far, grouped by fingerprint
+#-----------------------------------------------------------------
+class CandidatePool:
+
+  def __init__(self, quorum):
+    self.quorum = quorum
+    self.codes = {}
+    self.invalid = []
+    self.groups = {}
+
+  #-----------------------------------------------------------------
+  # Function to add the candidate of index i, returns the agreed code once quorum candidates are equivalent
+  # The agreed code is the one of the lowest index in its group, so that it does not depend on the arrival order.
+  #-----------------------------------------------------------------
+  def add(self, index, code):
+    fingerprint = candidate_fingerprint(code)
+    if fingerprint is None:
+      self.invalid.append(index)
+      self.codes[index] = code
+      return None
+    self.codes[index] = code
+    group = self.groups.setdefault(fingerprint, [])
+    group.append(index)
+    if len(group) >= self.quorum:
+      return strip_code_fences(self.codes[min(group)])
+    return None
+
+  def agreement(self):
+    return max([len(group) for group in self.groups.values()], default=0)
+
+  #-----------------------------------------------------------------
+  # Function to get the candidates to give to the consensus agent, in index order
+  # Equivalent candidates are only given once. When no candidate is valid python, all of them are given.
+  #-----------------------------------------------------------------
+  def for_consensus(self):
+    if not self.groups:
+      return [self.codes[i] for i in sorted(self.codes)]
+    return [self.codes[i] for i in sorted(min(group) for group in self.groups.values())]
+
+  def summary(self):
+    return f"{len(self.codes)} candidates, {len(self.invalid)} invalid, {len(self.groups)} distinct, best agreement {self.agreement()}"
+
+
+#-----------------------------------------------------------------
+# Function to generate the candidates in a thread pool, launch(i) submits the candidate of index i and returns its future
+# Returns the agreed code (None when the consensus agent is needed) and the pool of candidates.
+# Extra candidates are launched once, when all the first candidates arrived without quorum of them being equivalent.
+# When every candidate failed, the error of the last one is raised.
+#-----------------------------------------------------------------
+def generate_candidates(launch, number_candidates, quorum, max_extra):
+  pool = CandidatePool(quorum)
+  pending = {launch(i): i for i in range(number_candidates)}
+  extra_launched = False
+  error = None
+
+  while pending:
+    done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+    for fut in sorted(done, key=pending.get):
+      index = pending.pop(fut)
+      try:
+        agreed = pool.add(index, fut.result())
+      except Exception as e:
+        print(f"Candidate {index} dropped: {e}")
+        error = e
+        continue
+      if agreed is not None:
+        for other in pending:
+          other.cancel()
+        return agreed, pool
+
+    if not pending and not extra_launched and pool.agreement() < pool.quorum:
+      extra_launched = True
+      pending = {launch(i): i for i in range(number_candidates, number_candidates + max_extra)}
+
+  # Without any candidate the consensus agent would have nothing to choose from
+  if not pool.codes and error is not None:
+    raise error
+  return None, pool
+
+
+#-----------------------------------------------------------------
+# Asynchronous version of generate_candidates, launch(i) returns the coroutine of the candidate of index i
+# The requests of the candidates still running are cancelled once the quorum is reached.
+#-----------------------------------------------------------------
+async def generate_candidates_async(launch, number_candidates, quorum, max_extra):
+  pool = CandidatePool(quorum)
+  pending = {asyncio.ensure_future(launch(i)): i for i in range(number_candidates)}
+  extra_launched = False
+  error = None
+
+  try:
+    while pending:
+      done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+      for task in sorted(done, key=pending.get):
+        index = pending.pop(task)
+        try:
+          agreed = pool.add(index, task.result())
+        except Exception as e:
+          print(f"Candidate {index} dropped: {e}")
+          error = e
+          continue
+        if agreed is not None:
+          return agreed, pool
+
+      if not pending and not extra_launched and pool.agreement() < pool.quorum:
+        extra_launched = True
+        pending = {asyncio.ensure_future(launch(i)): i for i in range(number_candidates, number_candidates + max_extra)}
+  finally:
+    for task in pending:
+      task.cancel()
+
+  if not pool.codes and error is not None:
+    raise error
+  return None, pool
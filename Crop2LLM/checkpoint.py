@@ -0,0 +1,131 @@
+import os
+import json
+import hashlib
+import threading
+import contextvars
+from utilities import extract_text
+
+#-----------------------------------------------------------------
+# Checkpoints of the --unit pipeline
+# The result of each phase of each unit is recorded in a JSON manifest of the output folder, with the hash of the
+# inputs it was computed from and the artifacts it wrote. When resuming, a phase whose inputs did not change and whose
+# artifacts still exist is not run again, its recorded result is used instead.
+#-----------------------------------------------------------------
+# The checkpoint of the conversion running in the current context, so that the jobs of a batch each have their own
+_lock = threading.Lock()
+_current = contextvars.ContextVar("checkpoint", default=None)
+
+
+#-----------------------------------------------------------------
+# Function to get the checkpoint of the current context
+# Without configure_checkpoint, a fresh state that neither restores nor records is returned.
+#-----------------------------------------------------------------
+def _state():
+  state = _current.get()
+  if state is None:
+    return {"path": None, "resume": False, "manifest": {"units": {}}, "restored": 0, "recorded": 0}
+  return state
+
+
+#-----------------------------------------------------------------
+# Function to configure the checkpoint of the current context, inherited by the tasks and threads started from it
+# Without resume the manifest starts empty, the phases are still recorded so that the next run can be resumed.
+#-----------------------------------------------------------------
+def configure_checkpoint(manifest_path, resume=False):
+  manifest = {"units": {}}
+  if resume and os.path.exists(manifest_path):
+    try:
+      with open(manifest_path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    except (OSError, ValueError) as e:
+      print(f"Cannot read the checkpoint {manifest_path}, starting from scratch: {e}")
+
+  _current.set({"path": manifest_path, "resume": resume, "manifest": manifest, "restored": 0, "recorded": 0})
+
+
+def checkpoint_stats():
+  state = _state()
+  with _lock:
+    return {"restored": state["restored"], "recorded": state["recorded"]}
+
+
+#-----------------------------------------------------------------
+# Function to compute the key of the inputs of a phase, inputs must be JSON serializable
+#-----------------------------------------------------------------
+def phase_key(*inputs):
+  text = json.dumps(inputs, sort_keys=True, ensure_ascii=False, default=str)
+  return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+#-----------------------------------------------------------------
+# Function to compute the key of the content of files, for the sources of a unit
+#-----------------------------------------------------------------
+def files_key(files):
+  return phase_key(*[hashlib.sha256(extract_text(f).encode("utf-8")).hexdigest() for f in files])
+
+
+#-----------------------------------------------------------------
+# Function to get the recorded result of a phase
+# Returns (True, result) when resuming, the inputs are the same and every artifact exists, (False, None) otherwise.
+#-----------------------------------------------------------------
+def load_phase(unit, phase, key):
+  state = _state()
+  with _lock:
+    if not state["resume"]:
+      return False, None
+    entry = state["manifest"]["units"].get(unit, {}).get(phase)
+  if entry is None or entry["inputs"] != key or not all(os.path.exists(a) for a in entry["artifacts"]):
+    return False, None
+  with _lock:
+    state["restored"] += 1
+  return True, json.loads(json.dumps(entry["result"], ensure_ascii=False))
+
+
+#-----------------------------------------------------------------
+# Function to record the result of a phase, the manifest is rewritten atomically after each phase
+# Nothing is recorded when no checkpoint is configured.
+#-----------------------------------------------------------------
+def save_phase(unit, phase, key, result, artifacts=()):
+  state = _current.get()
+  if state is None:
+    return
+  with _lock:
+    # The result is copied, the phases after it may modify the objects they are given
+    result = json.loads(json.dumps(result, ensure_ascii=False))
+    state["manifest"]["units"].setdefault(unit, {})[phase] = {"inputs": key, "artifacts": list(artifacts), "result": result}
+    state["recorded"] += 1
+    if state["path"] is None:
+      return
+    tmp_path = f"{state['path']}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+      json.dump(state["manifest"], f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, state["path"])
+
+
+#-----------------------------------------------------------------
+# Function to run a phase unless its result can be restored from the checkpoint
+# compute() returns the JSON serializable result of the phase, artifacts(result) the files it wrote.
+#-----------------------------------------------------------------
+def run_phase(unit, phase, inputs, compute, artifacts=None):
+  key = phase_key(*inputs)
+  found, result = load_phase(unit, phase, key)
+  if found:
+    print(f"Phase {phase} of {unit} restored from the checkpoint")
+    return result
+  result = compute()
+  save_phase(unit, phase, key, result, artifacts(result) if artifacts else [])
+  return result
+
+
+#-----------------------------------------------------------------
+# Asynchronous version of run_phase, compute() returns the coroutine computing the result
+#-----------------------------------------------------------------
+async def run_phase_async(unit, phase, inputs, compute, artifacts=None):
+  key = phase_key(*inputs)
+  found, result = load_phase(unit, phase, key)
+  if found:
+    print(f"Phase {phase} of {unit} restored from the checkpoint")
+    return result
+  result = await compute()
+  save_phase(unit, phase, key, result, artifacts(result) if artifacts else [])
+  return result
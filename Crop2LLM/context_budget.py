@@ -0,0 +1,450 @@
+import os
+import re
+import io
+import ast
+import tokenize
+import threading
+from dataclasses import dataclass, field
+from pathlib import Path
+from utilities import extract_text
+
+#-----------------------------------------------------------------
+# Context budgeting of the source files given to the agents
+# Sources within the budget are given as they are. Otherwise they are reduced step by step until they fit :
+#   1. comments and blank lines are removed,
+#   2. the functions not reachable from the entry points of the main file are omitted,
+#   3. the functions farthest from the entry points are moved out of the prompt, split in chunks and summarized
+#      (map), the summaries being summarized again until they fit (reduce).
+# The reduced sources of a unit are computed once and shared by all the prompts of the unit.
+#-----------------------------------------------------------------
+ENTRY_POINTS = ["init", "initialize", "initialise", "process", "estimate", "calculatemodel", "calculate",
+                "run", "main", "simulate", "integrate", "rate", "update", "createvariables"]
+C_FAMILY = [".cs", ".java", ".cpp", ".c", ".h", ".hpp"]
+FORTRAN = [".f90", ".for", ".f", ".f95"]
+END_MARKER = "... end of the file summarized below ...\n"
+
+_lock = threading.Lock()
+_state = {"max_tokens": 40000, "chunk_tokens": 8000, "summary_tokens": 8000, "summarize": None, "sources": {}, "locks": {}}
+
+
+#-----------------------------------------------------------------
+# Function to configure the budget
+# max_tokens bounds the sources of a prompt, chunk_tokens the code given to one summary call and summary_tokens the
+# summaries kept in the prompt. summarize(text) returns the summary of a chunk, without it the chunks are only listed.
+#-----------------------------------------------------------------
+def configure_context_budget(max_tokens, chunk_tokens=8000, summary_tokens=8000, summarize=None):
+  with _lock:
+    _state["max_tokens"] = max_tokens
+    _state["chunk_tokens"] = chunk_tokens
+    _state["summary_tokens"] = summary_tokens
+    _state["summarize"] = summarize
+    _state["sources"] = {}
+
+
+#-----------------------------------------------------------------
+# Function to estimate the number of tokens of a text, about 4 characters per token
+#-----------------------------------------------------------------
+def estimate_tokens(text):
+  return len(text) // 4 + 1
+
+
+#-----------------------------------------------------------------
+# Sources of a unit once budgeted : the text of each file, the summaries of the code moved out and what was done
+#-----------------------------------------------------------------
+@dataclass
+class BudgetedSources:
+  texts: dict
+  summaries: list = field(default_factory=list)
+  notes: list = field(default_factory=list)
+
+  def tokens(self):
+    return sum(estimate_tokens(t) for t in self.texts.values()) + sum(estimate_tokens(s) for s in self.summaries)
+
+
+#-----------------------------------------------------------------
+# Function to remove the comments of C-like code (C#, Java, C++), string and char literals are kept as they are
+#-----------------------------------------------------------------
+def strip_c_comments(source):
+  out = []
+  i = 0
+  n = len(source)
+  while i < n:
+    c = source[i]
+    if c == '/' and source.startswith('//', i):
+      j = source.find('\n', i)
+      i = n if j == -1 else j
+    elif c == '/' and source.startswith('/*', i):
+      j = source.find('*/', i + 2)
+      i = n if j == -1 else j + 2
+      out.append(' ')
+    elif c == '"' or c == "'":
+      verbatim = c == '"' and i > 0 and source[i - 1] == '@'
+      j = i + 1
+      while j < n and source[j] != c and (verbatim or source[j] != '\n'):
+        j += 1 if verbatim or source[j] != '\\' else 2
+      out.append(source[i:j + 1])
+      i = j + 1
+    else:
+      out.append(c)
+      i += 1
+  return "".join(out)
+
+
+#-----------------------------------------------------------------
+# Function to remove the comments of Fortran code, free form (!) and fixed form (C, c, * in the first column)
+#-----------------------------------------------------------------
+def strip_fortran_comments(source, fixed_form):
+  lines = []
+  for line in source.split("\n"):
+    if fixed_form and line[:1] in ("c", "C", "*"):
+      continue
+    quote = None
+    for i, c in enumerate(line):
+      if quote is not None:
+        if c == quote:
+          quote = None
+      elif c in ("'", '"'):
+        quote = c
+      elif c == '!':
+        line = line[:i]
+        break
+    lines.append(line)
+  return "\n".join(lines)
+
+
+#-----------------------------------------------------------------
+# Function to remove the comments of python code, the docstrings are kept
+#-----------------------------------------------------------------
+def strip_python_comments(source):
+  try:
+    tokens = [t for t in tokenize.generate_tokens(io.StringIO(source).readline) if t.type != tokenize.COMMENT]
+    return tokenize.untokenize(tokens)
+  except (tokenize.TokenError, IndentationError, SyntaxError):
+    return source
+
+
+#-----------------------------------------------------------------
+# Function to remove the comments and the boilerplate of a source file : blank lines, trailing spaces and #region markers
+#-----------------------------------------------------------------
+def strip_comments(source, extension):
+  extension = extension.lower()
+  if extension in C_FAMILY:
+    source = strip_c_comments(source)
+  elif extension in FORTRAN:
+    source = strip_fortran_comments(source, extension in (".for", ".f"))
+  elif extension == ".py":
+    source = strip_python_comments(source)
+  elif extension == ".vba":
+    source = "\n".join(re.sub(r"'[^\"]*$", "", line) for line in source.split("\n") if not line.strip().lower().startswith("rem "))
+
+  lines = []
+  for line in source.split("\n"):
+    line = line.rstrip()
+    if not line.strip() or line.strip().startswith(("#region", "#endregion")):
+      continue
+    lines.append(line)
+  return "\n".join(lines) + "\n"
+
+
+#-----------------------------------------------------------------
+# Function definition found in a source file, start and end are offsets of the text
+#-----------------------------------------------------------------
+@dataclass
+class Region:
+  name: str
+  start: int
+  end: int
+
+
+_C_HEADER = re.compile(r"^[ \t]*(?:[\w<>\[\],.?@]+[ \t]+)*?(\w+)[ \t]*\(", re.MULTILINE)
+_C_KEYWORDS = {"if", "for", "foreach", "while", "switch", "catch", "using", "return", "new", "else", "lock", "fixed", "do", "sizeof", "typeof"}
+_FORTRAN_START = re.compile(r"^[ \t]*(?:[\w(),*]+[ \t]+)*?(SUBROUTINE|FUNCTION)[ \t]+(\w+)", re.MULTILINE | re.IGNORECASE)
+
+
+#-----------------------------------------------------------------
+# Function to find the end of a block opened at offset start, strings and chars are skipped
+#-----------------------------------------------------------------
+def _match_brace(text, start):
+  depth = 0
+  i = start
+  n = len(text)
+  while i < n:
+    c = text[i]
+    if c in ('"', "'"):
+      j = i + 1
+      while j < n and text[j] != c and text[j] != '\n':
+        j += 2 if text[j] == '\\' else 1
+      i = j
+    elif c == '{':
+      depth += 1
+    elif c == '}':
+      depth -= 1
+      if depth == 0:
+        return i + 1
+    i += 1
+  return n
+
+
+def _c_regions(text):
+  regions = []
+  pos = 0
+  while True:
+    m = _C_HEADER.search(text, pos)
+    if m is None:
+      return regions
+    name = m.group(1)
+    # The parameters must be followed by the body, or by a throws clause or a constructor initializer then the body
+    close = _match_parenthesis(text, m.end() - 1)
+    after = re.match(r"\s*(?:(?:throws|where)[^{;]*|:\s*(?:base|this)\s*\([^)]*\)\s*)?\{", text[close:])
+    if name in _C_KEYWORDS or after is None:
+      pos = m.end()
+      continue
+    end = _match_brace(text, close + after.end() - 1)
+    start = text.rfind("\n", 0, m.start()) + 1
+    regions.append(Region(name, start, end))
+    pos = end
+
+
+def _match_parenthesis(text, start):
+  depth = 0
+  for i in range(start, len(text)):
+    if text[i] == '(':
+      depth += 1
+    elif text[i] == ')':
+      depth -= 1
+      if depth == 0:
+        return i + 1
+  return len(text)
+
+
+def _fortran_regions(text):
+  regions = []
+  pos = 0
+  while True:
+    m = _FORTRAN_START.search(text, pos)
+    if m is None:
+      return regions
+    line_start = text.rfind("\n", 0, m.start()) + 1
+    if text[line_start:m.start(1)].strip().upper().startswith("END"):
+      pos = m.end()
+      continue
+    kind, name = m.group(1), m.group(2)
+    end_m = re.compile(rf"^[ \t]*END[ \t]*{kind}\b.*$", re.MULTILINE | re.IGNORECASE).search(text, m.end())
+    end = len(text) if end_m is None else end_m.end()
+    regions.append(Region(name, line_start, end))
+    pos = end
+
+
+def _python_regions(text):
+  try:
+    tree = ast.parse(text)
+  except SyntaxError:
+    return []
+  offsets = [0]
+  for line in text.split("\n"):
+    offsets.append(offsets[-1] + len(line) + 1)
+  regions = []
+  for node in tree.body:
+    nodes = node.body if isinstance(node, ast.ClassDef) else [node]
+    for sub in nodes:
+      if isinstance(sub, (ast.FunctionDef, ast.AsyncFunctionDef)):
+        start = (sub.decorator_list[0].lineno if sub.decorator_list else sub.lineno) - 1
+        regions.append(Region(sub.name, offsets[start], offsets[sub.end_lineno]))
+  return regions
+
+
+#-----------------------------------------------------------------
+# Function to find the functions, methods and subroutines of a source file, sorted by position
+#-----------------------------------------------------------------
+def find_regions(text, extension):
+  extension = extension.lower()
+  if extension in C_FAMILY:
+    return _c_regions(text)
+  if extension in FORTRAN:
+    return _fortran_regions(text)
+  if extension == ".py":
+    return _python_regions(text)
+  return []
+
+
+#-----------------------------------------------------------------
+# Function to tell if a function is an entry point of the model of the main file
+#-----------------------------------------------------------------
+def is_entry_point(name, model_name):
+  lower = name.lower()
+  model_name = model_name.lower()
+  return lower in ENTRY_POINTS or lower.startswith(("init_", "model_")) or (model_name and model_name in lower)
+
+
+#-----------------------------------------------------------------
+# Function to get the distance of each function from the entry points of the main file
+# A function is reachable when its name appears in the body of a reachable function, of any file.
+# Returns None when the main file has no recognizable entry point, nothing is then omitted.
+#-----------------------------------------------------------------
+def reachable_regions(texts, regions, main_file):
+  model_name = Path(main_file).stem
+  by_name = {}
+  for file, file_regions in regions.items():
+    for region in file_regions:
+      by_name.setdefault(region.name, []).append((file, region))
+
+  frontier = [(main_file, r) for r in regions.get(main_file, []) if is_entry_point(r.name, model_name)]
+  if not frontier:
+    return None
+
+  distances = {}
+  for file, region in frontier:
+    distances[(file, region.start)] = 0
+  depth = 0
+  while frontier:
+    depth += 1
+    next_frontier = []
+    for file, region in frontier:
+      body = texts[file][region.start:region.end]
+      for identifier in set(re.findall(r"\b\w+\b", body)):
+        for target in by_name.get(identifier, []):
+          key = (target[0], target[1].start)
+          if key not in distances:
+            distances[key] = depth
+            next_frontier.append(target)
+    frontier = next_frontier
+  return distances
+
+
+#-----------------------------------------------------------------
+# Function to remove regions from a text, each of them being replaced by a one line marker
+#-----------------------------------------------------------------
+def omit_regions(text, omitted, reason):
+  parts = []
+  pos = 0
+  for region in sorted(omitted, key=lambda r: r.start):
+    parts.append(text[pos:region.start])
+    parts.append(f"... {region.name} omitted ({reason}) ...\n")
+    pos = region.end
+  parts.append(text[pos:])
+  return "".join(parts)
+
+
+#-----------------------------------------------------------------
+# Function to split texts in chunks of at most max_tokens tokens, on line boundaries
+#-----------------------------------------------------------------
+def chunk_texts(texts, max_tokens):
+  chunks = []
+  current = []
+  size = 0
+  for text in texts:
+    for line in text.split("\n"):
+      line_tokens = estimate_tokens(line)
+      if current and size + line_tokens > max_tokens:
+        chunks.append("\n".join(current))
+        current = []
+        size = 0
+      current.append(line)
+      size += line_tokens
+  if current:
+    chunks.append("\n".join(current))
+  return chunks
+
+
+#-----------------------------------------------------------------
+# Function to summarize chunks of code (map), then the summaries themselves until they fit in max_tokens (reduce)
+# Without summarizer, the summaries are the first line of each chunk.
+#-----------------------------------------------------------------
+def map_reduce_summaries(texts, chunk_tokens, max_tokens):
+  summarize = _state["summarize"]
+  summaries = [summarize(chunk) if summarize else chunk.split("\n", 1)[0] for chunk in chunk_texts(texts, chunk_tokens)]
+  while summarize and sum(estimate_tokens(s) for s in summaries) > max_tokens and len(summaries) > 1:
+    reduced = [summarize(chunk) for chunk in chunk_texts(summaries, chunk_tokens)]
+    if len(reduced) >= len(summaries):
+      break
+    summaries = reduced
+  while summaries and sum(estimate_tokens(s) for s in summaries) > max_tokens:
+    summaries.pop()
+  return summaries
+
+
+#-----------------------------------------------------------------
+# Function to budget the sources of a unit
+#-----------------------------------------------------------------
+def budget_sources(main_file, helper_files):
+  files = [main_file] + list(helper_files)
+  texts = {f: extract_text(f) for f in files}
+  budgeted = BudgetedSources(texts)
+  max_tokens = _state["max_tokens"]
+  if max_tokens is None or budgeted.tokens() <= max_tokens:
+    return budgeted
+
+  # 1. Comments and boilerplate
+  texts = {f: strip_comments(t, Path(f).suffix) for f, t in texts.items()}
+  budgeted = BudgetedSources(texts, notes=["comments and blank lines were removed"])
+  if budgeted.tokens() <= max_tokens:
+    return budgeted
+
+  # 2. Functions not reachable from the entry points
+  regions = {f: find_regions(t, Path(f).suffix) for f, t in texts.items()}
+  distances = reachable_regions(texts, regions, main_file)
+  if distances is not None:
+    texts = {f: omit_regions(t, [r for r in regions[f] if (f, r.start) not in distances], "not reachable from the entry point")
+             for f, t in texts.items()}
+    regions = {f: find_regions(t, Path(f).suffix) for f, t in texts.items()}
+    distances = reachable_regions(texts, regions, main_file) or {}
+    budgeted = BudgetedSources(texts, notes=budgeted.notes + ["functions not reachable from the entry point were omitted"])
+    if budgeted.tokens() <= max_tokens:
+      return budgeted
+  else:
+    distances = {}
+
+  # 3. Functions farthest from the entry points moved out and summarized, the whole text when there are no functions
+  summary_tokens = min(_state["summary_tokens"], max_tokens // 4)
+  candidates = sorted(((distances.get((f, r.start), len(distances) + 1), f, r) for f, rs in regions.items() for r in rs),
+                      key=lambda item: (-item[0], files.index(item[1]), item[2].start))
+  moved = {f: [] for f in files}
+  size = budgeted.tokens()
+  for distance, f, region in candidates:
+    if size <= max_tokens - summary_tokens:
+      break
+    if distance == 0:
+      continue
+    moved[f].append(region)
+    size -= estimate_tokens(texts[f][region.start:region.end])
+
+  moved_texts = [texts[f][r.start:r.end] for f in files for r in sorted(moved[f], key=lambda r: r.start)]
+  texts = {f: omit_regions(t, moved[f], "summarized below") for f, t in texts.items()}
+
+  # Text still too big (no function found, or huge entry points) : the end of the biggest files is moved out too
+  # The marker is added once the cuts are done, its size is kept out of the budget of the texts
+  remaining = max_tokens - summary_tokens - len(files) * estimate_tokens(END_MARKER)
+  cut_files = []
+  while sum(estimate_tokens(t) for t in texts.values()) > remaining:
+    f = max(texts, key=lambda k: len(texts[k]))
+    excess = (sum(estimate_tokens(t) for t in texts.values()) - remaining) * 4
+    cut = texts[f].rfind("\n", 0, max(0, len(texts[f]) - excess)) + 1
+    if cut >= len(texts[f]):
+      break
+    moved_texts.append(texts[f][cut:])
+    texts[f] = texts[f][:cut]
+    if f not in cut_files:
+      cut_files.append(f)
+  for f in cut_files:
+    texts[f] += END_MARKER
+
+  summaries = map_reduce_summaries(moved_texts, _state["chunk_tokens"], summary_tokens)
+  return BudgetedSources(texts, summaries, budgeted.notes + ["the code farthest from the entry point was summarized"])
+
+
+#-----------------------------------------------------------------
+# Function to get the budgeted sources of a unit, computed once per unit and content of its files
+# Concurrent callers for the same unit wait for the first one instead of summarizing the chunks again.
+#-----------------------------------------------------------------
+def unit_sources(main_file, helper_files):
+  files = [main_file] + list(helper_files)
+  key = tuple((os.path.abspath(f), os.stat(f).st_mtime_ns, os.stat(f).st_size) for f in files)
+  with _lock:
+    unit_lock = _state["locks"].setdefault(key, threading.Lock())
+  with unit_lock:
+    budgeted = _state["sources"].get(key)
+    if budgeted is None:
+      budgeted = budget_sources(main_file, helper_files)
+      with _lock:
+        _state["sources"][key] = budgeted
+  return budgeted
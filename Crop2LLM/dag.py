@@ -0,0 +1,55 @@
+import contextvars
+import concurrent.futures
+
+#-----------------------------------------------------------------
+# Scheduler of a graph of tasks
+# Each task is a function called with the results of the tasks it depends on, in the order of its dependencies.
+# A task starts as soon as all its dependencies are done, at most max_workers tasks run at the same time.
+# When a task fails, no other task is started, the running ones are waited for and the error is raised.
+#-----------------------------------------------------------------
+class TaskGraph:
+
+  def __init__(self):
+    self.tasks = {}
+
+  #-----------------------------------------------------------------
+  # Function to add a task, its dependencies must have been added before it
+  #-----------------------------------------------------------------
+  def add(self, name, function, dependencies=()):
+    if name in self.tasks:
+      raise ValueError(f"Task {name} is already in the graph")
+    for dependency in dependencies:
+      if dependency not in self.tasks:
+        raise ValueError(f"Task {name} depends on {dependency}, which is not in the graph")
+    self.tasks[name] = (function, list(dependencies))
+    return name
+
+  #-----------------------------------------------------------------
+  # Function to run all the tasks, returns the result of each task by name
+  #-----------------------------------------------------------------
+  def run(self, max_workers):
+    results = {}
+    waiting = dict(self.tasks)
+    running = {}
+
+    def start_ready(executor):
+      for name, (function, dependencies) in list(waiting.items()):
+        if all(dependency in results for dependency in dependencies):
+          del waiting[name]
+          args = [results[dependency] for dependency in dependencies]
+          running[executor.submit(contextvars.copy_context().run, function, *args)] = name
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+      start_ready(executor)
+      while running:
+        done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+        for fut in done:
+          name = running.pop(fut)
+          try:
+            results[name] = fut.result()
+          except Exception:
+            waiting.clear()
+            concurrent.futures.wait(running)
+            raise
+        start_ready(executor)
+    return results
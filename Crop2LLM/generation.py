@@ -1,11 +1,25 @@
 from path import Path
 import os
+import sys
+import copy
 import time
+import traceback
+import multiprocessing
+import contextvars
 from cookiecutter.main import cookiecutter
 import shutil
 from openAI_interaction import create_composite_metadata, create_unit_metadata, create_python_code, create_algo_metadata, create_consensus_python
+from openAI_interaction import create_unit_metadata_async, create_python_code_async, create_algo_metadata_async, create_consensus_python_async
+from openAI_interaction import configure_async_concurrency, close_async_clients, save_python_code
+from candidates import generate_candidates, generate_candidates_async
 from json2XML import json_to_XML_composite, json_to_XML_unit
-from transpiler import transpile_functions
+from transpiler import transpile_functions, transpile_functions_async
+from telemetry import telemetry_scope, scoped
+from checkpoint import files_key, run_phase, run_phase_async
+from dag import TaskGraph
+from agents import get_agent
+from run_log import flush_logs
+import asyncio
 import concurrent.futures
 import pycropml
 from pycropml.cyml import NAMES, prefix, ext, langs, domain_class, wrapper
@@ -19,64 +33,246 @@ import re
 import xml.etree.ElementTree as ET
 from textwrap import dedent
 
+# Folder of the output where the draft XML of the units are written for the composite
+DRAFT_FOLDER = "draft"
+
 #-----------------------------------------------------------------
-# Function to transform a modelUnit in Crop2ML
+# Function to get the paths of the artifacts written for a unit
 #-----------------------------------------------------------------
-def process_unit(api_key, unit_meta, py_refactor, algo_meta, cyml_transpile, py_consensus, 
-                 small_model, big_model, number_candidates, log_file, group, model_composite, output_folder):
+def metadata_path(output_folder, main_file):
+  return output_folder + "/" + Path(main_file).stem + "_metadata.json"
+
+
+def python_code_path(output_folder, main_file):
+  return output_folder + "/" + Path(main_file).stem + "_code.py"
+
+
+#-----------------------------------------------------------------
+# Function to get the inputs of each phase of a unit that do not depend on the previous phases, for the checkpoints
+#-----------------------------------------------------------------
+def unit_phase_inputs(group, unit_meta, py_refactor, py_consensus, algo_meta, cyml_transpile, small_model, big_model,
+                      number_candidates, candidate_quorum, max_extra_candidates):
+  sources = files_key(group)
+  return {
+    "metadata": [sources, get_agent(unit_meta).hash, small_model],
+    "candidates": [sources, get_agent(py_refactor).hash, big_model, number_candidates, candidate_quorum, max_extra_candidates],
+    "consensus": [sources, get_agent(py_consensus).hash, big_model],
+    "algo": [sources, get_agent(algo_meta).hash, small_model],
+    "transpile": [get_agent(cyml_transpile).hash, big_model],
+  }
+
+
+#-----------------------------------------------------------------
+# Function to add the tasks transforming a modelUnit in Crop2ML to a task graph
+# The agent calls of each step are recorded by the telemetry under the name of the unit and of the step.
+# The consensus is skipped when candidate_quorum candidates are AST-equivalent, up to max_extra_candidates more
+# candidates are requested when the first ones all differ.
+# Each phase is recorded in the checkpoint, and restored from it when resuming with the same inputs.
+# The metadata and the candidates do not depend on each other and run at the same time. A draft of the XML is written
+# as soon as the algo metadata exists, for the composite, the XML itself once the functions are transpiled.
+# Returns the names of the draft XML and of the final task, whose result is the XML and the transpiled functions.
+#-----------------------------------------------------------------
+def add_unit_tasks(graph, api_key, unit_meta, py_refactor, algo_meta, cyml_transpile, py_consensus,
+                   small_model, big_model, number_candidates, log_file, group, model_composite, output_folder, max_parallel_functions=4,
+                   candidate_quorum=2, max_extra_candidates=2):
   main_file = group[0]
   helper_files = group[1:]
   model_unit_name = Path(main_file).stem
-  codes = []
+  inputs = unit_phase_inputs(group, unit_meta, py_refactor, py_consensus, algo_meta, cyml_transpile, small_model, big_model,
+                             number_candidates, candidate_quorum, max_extra_candidates)
+
+  def metadata_phase():
+    print(f"Processing descriptive metadata of the model {model_unit_name}...")
+    with telemetry_scope(model_unit_name, "metadata"):
+      return create_unit_metadata(api_key, unit_meta, small_model, output_folder, main_file, helper_files)
+
+  def candidates_phase():
+    print(f"Creating {number_candidates} candidates refactored python versions of the model {model_unit_name}...")
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=number_candidates + max_extra_candidates)
+    try:
+      with telemetry_scope(model_unit_name, "candidates"):
+        launch = lambda i: executor.submit(contextvars.copy_context().run, create_python_code, api_key, py_refactor, big_model, main_file, helper_files, i)
+        code, candidates = generate_candidates(launch, number_candidates, candidate_quorum, max_extra_candidates)
+    finally:
+      # Candidates still running once the quorum is reached are not waited for
+      executor.shutdown(wait=False, cancel_futures=True)
+    return {"code": code, "candidates": candidates.for_consensus(), "summary": candidates.summary()}
+
+  def consensus_phase(selection):
+    if selection["code"] is not None:
+      print(f"Candidates of the model {model_unit_name} agree, consensus skipped ({selection['summary']})")
+      return save_python_code(selection["code"], output_folder, main_file)
+    print(f"Selecting the best candidate for the model {model_unit_name} ({selection['summary']})...")
+    with telemetry_scope(model_unit_name, "consensus"):
+      return create_consensus_python(api_key, py_consensus, big_model, selection["candidates"], main_file, helper_files, output_folder)
+
+  def algo_phase(code):
+    with telemetry_scope(model_unit_name, "algo"):
+      return create_algo_metadata(api_key, algo_meta, small_model, code, group)
+
+  def transpile_phase(code, algo, metadata):
+    print(f"Transpiling each function into CyML of the model {model_unit_name}...")
+    # The functions that could not be transpiled are removed from a copy of the algo metadata, the draft XML
+    # is written from the original one at the same time
+    algo = copy.deepcopy(algo)
+    with telemetry_scope(model_unit_name, "transpile"):
+      functions = transpile_functions(code, algo, metadata, api_key, big_model, cyml_transpile, output_folder, max_parallel_functions)
+    return {"functions": functions, "algo": algo}
+
+  def xml_phase(metadata, transpiled):
+    xml = write_unit_xml(model_unit_name, main_file, model_composite, output_folder, metadata, transpiled["algo"], log_file)
+    print(f"{model_unit_name} generated successfully !")
+    return xml, transpiled["functions"]
+
+  task = lambda phase: f"{model_unit_name}:{phase}"
+  graph.add(task("metadata"), lambda: run_phase(model_unit_name, "metadata", inputs["metadata"], metadata_phase,
+                                                lambda result: [metadata_path(output_folder, main_file)]))
+  graph.add(task("candidates"), lambda: run_phase(model_unit_name, "candidates", inputs["candidates"], candidates_phase))
+  graph.add(task("consensus"),
+            lambda selection: run_phase(model_unit_name, "consensus", inputs["consensus"] + [selection], lambda: consensus_phase(selection),
+                                        lambda result: [python_code_path(output_folder, main_file)]),
+            [task("candidates")])
+  graph.add(task("algo"), lambda code: run_phase(model_unit_name, "algo", inputs["algo"] + [code], lambda: algo_phase(code)),
+            [task("consensus")])
+  graph.add(task("draft"), lambda metadata, algo: write_draft_xml(main_file, model_composite, output_folder, metadata, algo),
+            [task("metadata"), task("algo")])
+  graph.add(task("transpile"),
+            lambda code, algo, metadata: run_phase(model_unit_name, "transpile", inputs["transpile"] + [code, algo, metadata],
+                                                   lambda: transpile_phase(code, algo, metadata),
+                                                   lambda result: result["functions"] or []),
+            [task("consensus"), task("algo"), task("metadata")])
+  graph.add(task("XML"), xml_phase, [task("metadata"), task("transpile")])
+  return task("draft"), task("XML")
 
-  # To delete
-  start = time.time()
 
-  print(f"Processing descriptive metadata of the model {model_unit_name}...")
-  metadata = create_unit_metadata(api_key, unit_meta, small_model, output_folder, main_file, helper_files)
+#-----------------------------------------------------------------
+# Function to transform a modelUnit in Crop2ML, returns its XML and its transpiled functions
+#-----------------------------------------------------------------
+def process_unit(api_key, unit_meta, py_refactor, algo_meta, cyml_transpile, py_consensus, 
+                 small_model, big_model, number_candidates, log_file, group, model_composite, output_folder, max_parallel_functions=4,
+                 candidate_quorum=2, max_extra_candidates=2):
+  graph = TaskGraph()
+  _, final = add_unit_tasks(graph, api_key, unit_meta, py_refactor, algo_meta, cyml_transpile, py_consensus,
+                            small_model, big_model, number_candidates, log_file, group, model_composite, output_folder,
+                            max_parallel_functions, candidate_quorum, max_extra_candidates)
+  return graph.run(max_workers=2)[final]
 
-  print(f"Creating {number_candidates} candidates refactored python versions of the model {model_unit_name}...")
-  with concurrent.futures.ThreadPoolExecutor() as executor:
-    futures = []
-    for _ in range(number_candidates):
-      futures.append(
-        executor.submit(create_python_code, api_key, py_refactor, big_model, main_file, helper_files)
-        )
-    for fut in concurrent.futures.as_completed(futures):
-      code = fut.result()
-      codes.append(code)
 
-  print(f"Selecting the best candidate for the model {model_unit_name}...")
-  code = create_consensus_python(api_key, py_consensus, big_model, codes, main_file, helper_files, output_folder)
-  algo = create_algo_metadata(api_key, algo_meta, small_model, code)
+#-----------------------------------------------------------------
+# Function to write the draft XML of a unit, before its functions are transpiled, in the draft folder
+# The composite only needs the inputs and outputs of the units, which do not change with the transpilation.
+#-----------------------------------------------------------------
+def write_draft_xml(main_file, model_composite, output_folder, metadata, algo):
+  source = main_file if model_composite is None else model_composite
+  draft_folder = os.path.join(output_folder, DRAFT_FOLDER)
+  os.makedirs(draft_folder, exist_ok=True)
+  return json_to_XML_unit(source, draft_folder, metadata, algo, None)
 
-  # To delete
-  end = time.time()
-  print(f"Time elapsed for processing {model_unit_name}: {end - start} seconds")
-  start = time.time()
 
-  print(f"Transpiling each function into CyML of the model {model_unit_name}...")
-  functions = transpile_functions(code, algo, metadata, api_key, big_model, cyml_transpile, output_folder)
+#-----------------------------------------------------------------
+# Function to write the XML of a unit, recorded in the checkpoint as its last phase
+#-----------------------------------------------------------------
+def write_unit_xml(model_unit_name, main_file, model_composite, output_folder, metadata, algo, log_file):
+  source = main_file if model_composite is None else model_composite
+  return run_phase(model_unit_name, "XML", [source, metadata, algo],
+                   lambda: json_to_XML_unit(source, output_folder, metadata, algo, log_file),
+                   lambda result: [result])
 
-  # To delete
-  end = time.time()
-  print(f"Time elapsed for transpiling {model_unit_name}: {end - start} seconds")
-  
-  if model_composite is None:
-    xml = json_to_XML_unit(main_file, output_folder, metadata, algo, log_file)
-  else:
-    xml = json_to_XML_unit(model_composite, output_folder, metadata, algo, log_file)
+
+#-----------------------------------------------------------------
+# Asynchronous version of process_unit
+# The metadata, the candidates and the transpilation of each function are requested concurrently on the event loop.
+#-----------------------------------------------------------------
+async def process_unit_async(api_key, unit_meta, py_refactor, algo_meta, cyml_transpile, py_consensus, 
+                             small_model, big_model, number_candidates, log_file, group, model_composite, output_folder,
+                             candidate_quorum=2, max_extra_candidates=2):
+  main_file = group[0]
+  helper_files = group[1:]
+  model_unit_name = Path(main_file).stem
+  inputs = unit_phase_inputs(group, unit_meta, py_refactor, py_consensus, algo_meta, cyml_transpile, small_model, big_model,
+                             number_candidates, candidate_quorum, max_extra_candidates)
+
+  async def candidates_phase():
+    launch = lambda i: scoped(create_python_code_async(api_key, py_refactor, big_model, main_file, helper_files, i), model_unit_name, "candidates")
+    code, candidates = await generate_candidates_async(launch, number_candidates, candidate_quorum, max_extra_candidates)
+    return {"code": code, "candidates": candidates.for_consensus(), "summary": candidates.summary()}
+
+  async def consensus_phase():
+    if selection["code"] is not None:
+      print(f"Candidates of the model {model_unit_name} agree, consensus skipped ({selection['summary']})")
+      return save_python_code(selection["code"], output_folder, main_file)
+    print(f"Selecting the best candidate for the model {model_unit_name} ({selection['summary']})...")
+    with telemetry_scope(model_unit_name, "consensus"):
+      return await create_consensus_python_async(api_key, py_consensus, big_model, selection["candidates"], main_file, helper_files, output_folder)
+
+  async def transpile_phase():
+    print(f"Transpiling each function into CyML of the model {model_unit_name}...")
+    with telemetry_scope(model_unit_name, "transpile"):
+      functions = await transpile_functions_async(code, algo, metadata, api_key, big_model, cyml_transpile, output_folder)
+    return {"functions": functions, "algo": algo}
+
+  print(f"Processing descriptive metadata and {number_candidates} candidates refactored python versions of the model {model_unit_name}...")
+  metadata, selection = await asyncio.gather(
+    run_phase_async(model_unit_name, "metadata", inputs["metadata"],
+                    lambda: scoped(create_unit_metadata_async(api_key, unit_meta, small_model, output_folder, main_file, helper_files), model_unit_name, "metadata"),
+                    lambda result: [metadata_path(output_folder, main_file)]),
+    run_phase_async(model_unit_name, "candidates", inputs["candidates"], candidates_phase)
+  )
+  code = await run_phase_async(model_unit_name, "consensus", inputs["consensus"] + [selection], consensus_phase,
+                               lambda result: [python_code_path(output_folder, main_file)])
+  algo = await run_phase_async(model_unit_name, "algo", inputs["algo"] + [code],
+                               lambda: scoped(create_algo_metadata_async(api_key, algo_meta, small_model, code, group), model_unit_name, "algo"))
+  transpiled = await run_phase_async(model_unit_name, "transpile", inputs["transpile"] + [code, algo, metadata], transpile_phase,
+                                     lambda result: result["functions"] or [])
+  functions, algo = transpiled["functions"], transpiled["algo"]
+
+  xml = write_unit_xml(model_unit_name, main_file, model_composite, output_folder, metadata, algo, log_file)
 
   print(f"{model_unit_name} generated successfully !")
 
   return xml, functions
 
 
+#-----------------------------------------------------------------
+# Function to transform all modelUnits in Crop2ML on a single event loop
+# At most max_requests requests are in flight at the same time, whatever the number of units.
+#-----------------------------------------------------------------
+async def process_units_async(api_key, unit_meta, py_refactor, algo_meta, cyml_transpile, py_consensus, 
+                              small_model, big_model, number_candidates, log_file, groups, model_composite, output_folder, max_requests,
+                              candidate_quorum=2, max_extra_candidates=2):
+  configure_async_concurrency(max_requests)
+  try:
+    return await asyncio.gather(*[
+      process_unit_async(api_key, unit_meta, py_refactor, algo_meta, cyml_transpile, py_consensus,
+                         small_model, big_model, number_candidates, log_file, group, model_composite, output_folder,
+                         candidate_quorum, max_extra_candidates)
+      for group in groups
+    ])
+  finally:
+    await close_async_clients()
+
+
+#-----------------------------------------------------------------
+# Function to create the metadata of a modelComposite in Crop2ML
+# The composite metadata is recorded in the checkpoint, and restored from it when the XML units did not change.
+#-----------------------------------------------------------------
+def create_composite(api_key, composite_meta, small_model, output_folder, xml_units, model_composite, first_file):
+  name = Path(model_composite or first_file).stem
+
+  def composite_phase():
+    print(f"Generating the composite model...")
+    with telemetry_scope(name, "composite"):
+      return create_composite_metadata(api_key, composite_meta, small_model, output_folder, xml_units, model_composite)
+
+  sources = xml_units if model_composite is None else xml_units + [model_composite]
+  return run_phase(name, "composite", [files_key(sources), get_agent(composite_meta).hash, small_model], composite_phase)
+
+
 #-----------------------------------------------------------------
 # Function to create a modelComposite in Crop2ML
 #-----------------------------------------------------------------
 def process_composite(api_key, composite_meta, small_model, output_folder, xml_units, model_composite, log_file, first_file):
-  composite_metadata = create_composite_metadata(api_key, composite_meta, small_model, output_folder, xml_units, model_composite)
+  composite_metadata = create_composite(api_key, composite_meta, small_model, output_folder, xml_units, model_composite, first_file)
   if model_composite is None :
     model_composite = first_file
   xml_composite = json_to_XML_composite(model_composite, output_folder, composite_metadata, xml_units, log_file)
@@ -84,6 +280,39 @@ def process_composite(api_key, composite_meta, small_model, output_folder, xml_u
   return composite_metadata, xml_composite, model_composite
 
 
+#-----------------------------------------------------------------
+# Function to transform all modelUnits and the modelComposite in Crop2ML as a single task graph
+# Each agent call starts as soon as its inputs exist : the composite metadata only waits for the draft XML of each unit,
+# so it runs while the last units are still transpiled, the composite XML waits for the XML of every unit.
+# Returns the XML and transpiled functions of each unit, in the order of the groups, and the composite.
+#-----------------------------------------------------------------
+def process_component(api_key, unit_meta, py_refactor, algo_meta, cyml_transpile, py_consensus, composite_meta,
+                      small_model, big_model, number_candidates, log_file, groups, model_composite, output_folder, max_workers,
+                      max_parallel_functions=4, candidate_quorum=2, max_extra_candidates=2):
+  graph = TaskGraph()
+  units = [
+    add_unit_tasks(graph, api_key, unit_meta, py_refactor, algo_meta, cyml_transpile, py_consensus,
+                   small_model, big_model, number_candidates, log_file, group, model_composite, output_folder,
+                   max_parallel_functions, candidate_quorum, max_extra_candidates)
+    for group in groups
+  ]
+  drafts = [draft for draft, _ in units]
+  finals = [final for _, final in units]
+  first_file = groups[0][0]
+
+  graph.add("composite:metadata",
+            lambda *xml_drafts: create_composite(api_key, composite_meta, small_model, output_folder, list(xml_drafts), model_composite, first_file),
+            drafts)
+  graph.add("composite:XML",
+            lambda composite_metadata, *unit_results: json_to_XML_composite(model_composite or first_file, output_folder, composite_metadata,
+                                                                             [xml for xml, _ in unit_results], log_file),
+            ["composite:metadata"] + finals)
+  results = graph.run(max_workers)
+
+  unit_results = [results[final] for final in finals]
+  return unit_results, results["composite:metadata"], results["composite:XML"], model_composite or first_file
+
+
 #-----------------------------------------------------------------
 # Function to create a Crop2ML package
 #-----------------------------------------------------------------
@@ -111,6 +340,8 @@ def create_crop2ml_package(cookiecutter_template, output_folder, model_composite
     for function in function_transpiled:
       shutil.copy(function, f"{output_folder}/{Path(model_composite).stem}/crop2ml/algo/pyx/")
 
+  # The log is written in the background, every message of the conversion must be in it before it is copied
+  flush_logs()
   shutil.copy(f"{output_folder}/{log_file}", f"{output_folder}/{Path(model_composite).stem}/")
 
   return project_dir
@@ -120,6 +351,14 @@ def create_crop2ml_package(cookiecutter_template, output_folder, model_composite
 # Transpile a Crop2ML component in the output folder for a specific language or  platform
 #-----------------------------------------------------------------
 def generate_component(model_package, language):
+  component = prepare_component(model_package)
+  emit_component(component, language)
+
+
+#-----------------------------------------------------------------
+# Parse a Crop2ML component and build its topology, the steps common to every language or platform
+#-----------------------------------------------------------------
+def prepare_component(model_package, write_tests=True):
   namep = model_package.split(os.path.sep)[-1]
   pkg = Path(model_package)
   models = model_parser(pkg)  # parse xml files and create python model object
@@ -131,9 +370,36 @@ def generate_component(model_package, language):
   if not dir_images.is_dir():
       dir_images.mkdir()
 
-  m2p = render_cyml.Model2Package(models, dir=output)
+  if write_tests:
+    m2p = render_cyml.Model2Package(models, dir=output)
+    m2p.write_tests()
+
+  # create topology of composite model
+  T = Topology(namep, model_package)
+  T.topologicalSort()
+
+  return {
+    'package': model_package,
+    'namep': namep,
+    'models': models,
+    'output': output,
+    'dir_test': dir_test,
+    'topology': T
+  }
+
+
+#-----------------------------------------------------------------
+# Transpile a parsed Crop2ML component for a specific language or platform
+#-----------------------------------------------------------------
+def emit_component(component, language):
+  namep = component['namep']
+  models = component['models']
+  output = component['output']
+  T = component['topology']
+  mc_name = T.model.name
+
   tg_rep1 = Path(os.path.join(output, language))  # target language models  directory in output
-  dir_test_lang = Path(os.path.join(dir_test, language))
+  dir_test_lang = Path(os.path.join(component['dir_test'], language))
   
   if not tg_rep1.is_dir():
     tg_rep1.mkdir()
@@ -146,13 +412,6 @@ def generate_component(model_package, language):
   if not dir_test_lang.is_dir():
     dir_test_lang.mkdir()
 
-  m2p.write_tests()
-
-  # create topology of composite model
-  T = Topology(namep, model_package)
-  T.topologicalSort()
-  mc_name = T.model.name
-
   # domain class
   if language in domain_class:
     getattr(getattr(pycropml.transpiler.generators, f'{NAMES[language]}Generator'), f'to_struct_{language}')([T.model], tg_rep, mc_name)
@@ -212,6 +471,54 @@ def generate_component(model_package, language):
       tg_file.write(code.encode("utf-8"))
 
 
+#-----------------------------------------------------------------
+# Transpile a Crop2ML component for several languages or platforms in a process pool
+# The component is parsed and its tests written once here, then once in each worker ; each language runs in its own
+# process so that a failure or a crash only affects that language.
+# The workers are started from a fork server, never forked from this process whose threads (other jobs of a batch,
+# HTTP clients, run log writer) may hold locks, and _component only exists in the workers.
+# Returns, in the order of the languages, the time spent and the error (None on success) of each language.
+#-----------------------------------------------------------------
+_component = {}
+
+def generate_components(model_package, languages, max_workers):
+  start = time.time()
+  try:
+    prepare_component(model_package)
+  except Exception as e:
+    error = f"{e}\n{traceback.format_exc()}"
+    return [(language, time.time() - start, error) for language in languages]
+
+  mp_context = multiprocessing.get_context("forkserver" if sys.platform.startswith("linux") else "spawn")
+  results = {}
+  with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context,
+                                              initializer=_init_component_worker, initargs=(model_package,)) as executor:
+    futures = {executor.submit(_emit_component_worker, language): language for language in languages}
+    for fut in concurrent.futures.as_completed(futures):
+      language = futures[fut]
+      try:
+        results[language] = fut.result()
+      except Exception as e:
+        results[language] = (0.0, f"{type(e).__name__}: {e}")
+
+  return [(language, *results[language]) for language in languages]
+
+
+# Each worker parses the component once, for all the languages it emits
+def _init_component_worker(model_package):
+  _component.clear()
+  _component.update(prepare_component(model_package, write_tests=False))
+
+
+def _emit_component_worker(language):
+  start = time.time()
+  try:
+    emit_component(_component, language)
+    return time.time() - start, None
+  except Exception as e:
+    return time.time() - start, f"{e}\n{traceback.format_exc()}"
+
+
 #-----------------------------------------------------------------
 # When the pyx code is fixed, parse and format it into the crop2ml folder
 #-----------------------------------------------------------------
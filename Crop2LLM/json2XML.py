@@ -1,4 +1,6 @@
 from pathlib import Path
+from dataclasses import dataclass
+import io
 import xml.dom.minidom
 import xml.etree.ElementTree as ET
 from utilities import extract_text, log_comments
@@ -76,7 +78,7 @@ def convert_unit(file_path, json_metadata, json_code):
   # Parametersets
   add_tests(root, tests, inputs)
 
-  return ET.tostring(root, encoding='utf-8')
+  return root
 
 
 #-----------------------------------------------------------------
@@ -218,6 +220,29 @@ def add_tests(root_XML, json_tests, json_inputs):
         ET.SubElement(test, 'OutputValue', name=test_output.get('name')).text = str(test_output.get('value'))
 
 
+#-----------------------------------------------------------------
+# Unit XML parsed once for the composite : its tree, its name and its Input and Output elements
+#-----------------------------------------------------------------
+@dataclass
+class UnitIndex:
+  path: str
+  root: ET.Element
+  name: str
+  inputs: list
+  outputs: list
+
+
+#-----------------------------------------------------------------
+# Function to parse each unit XML of a composite once, in the order of the units
+#-----------------------------------------------------------------
+def index_units(XML_units):
+  units = []
+  for unit_path in XML_units:
+    root_unit = ET.fromstring(extract_text(unit_path))
+    units.append(UnitIndex(unit_path, root_unit, root_unit.attrib.get("name"), root_unit.findall('.//Input'), root_unit.findall('.//Output')))
+  return units
+
+
 #-----------------------------------------------------------------
 # Function to convert JSON data to XML format
 # This function takes a file path and JSON data, then converts the data into a Crop2ML-friendly XML format.
@@ -245,14 +270,13 @@ def convert_composite(file_path, json_metadata, XML_units):
   ET.SubElement(desc, 'ShortDescription').text = metadata.get('Short description', '')
 
   # Composition section
+  units = index_units(XML_units)
   composition = ET.SubElement(root, 'Composition')
-  for unit_path in XML_units:
-    unit = extract_text(unit_path)
-    root_unit = ET.fromstring(unit)
+  for unit in units:
     ET.SubElement(composition, 'Model', {
-      'name': root_unit.attrib.get("name"),
-      'id': root_unit.attrib.get("modelid"),
-      'filename': f"unit.{root_unit.attrib.get('name')}.xml"
+      'name': unit.name,
+      'id': unit.root.attrib.get("modelid"),
+      'filename': f"unit.{unit.name}.xml"
     })
 
   links_elem = ET.SubElement(composition, 'Links')
@@ -263,15 +287,12 @@ def convert_composite(file_path, json_metadata, XML_units):
     internal_sources.add(link['Source variable name'])
     internal_targets.add(link['Target variable name'])
 
-  for unit_path in XML_units:
-    unit = extract_text(unit_path)
-    root_unit = ET.fromstring(unit)
-    unit_name = root_unit.attrib.get("name")
-    for input_elem in root_unit.findall('.//Input'):
+  for unit in units:
+    for input_elem in unit.inputs:
       input_name = input_elem.attrib.get('name')
       if input_name not in internal_sources:
         ET.SubElement(links_elem, 'InputLink', {
-          'target': f"{unit_name}.{input_name}", 
+          'target': f"{unit.name}.{input_name}", 
           'source': input_name
         })
 
@@ -281,31 +302,100 @@ def convert_composite(file_path, json_metadata, XML_units):
       'source': f"{link['Source model unit']}.{link['Source variable name']}" 
     })
   
-  for unit_path in XML_units:
-    unit = extract_text(unit_path)
-    root_unit = ET.fromstring(unit)
-    unit_name = root_unit.attrib.get("name")
-    for output_elem in root_unit.findall('.//Output'):
+  for unit in units:
+    for output_elem in unit.outputs:
       output_name = output_elem.attrib.get('name')
       if output_name not in internal_targets:
         ET.SubElement(links_elem, 'OutputLink', {
           'target': output_name,
-          'source': f"{unit_name}.{output_name}"
+          'source': f"{unit.name}.{output_name}"
         })
 
+  # The inputs set by an internal link become auxiliary variables of their unit, each modified unit is written once
+  by_stem = {}
+  for unit in units:
+    by_stem.setdefault(Path(unit.path).stem, []).append(unit)
+  modified = []
   for link in link_data:
-    for unit_path in XML_units:
-      if Path(unit_path).stem == f"unit.{link['Target model unit']}":
-        unit = extract_text(unit_path)
-        root_unit = ET.fromstring(unit)
-        for input_elem in root_unit.findall('.//Input'):
-          input_name = input_elem.attrib.get('name')
-          if input_name == link['Target variable name']:
-            input_elem.attrib['variablecategory'] = 'auxiliary'
-            with open(unit_path, 'wb') as f:
-              f.write(ET.tostring(root_unit, encoding='utf-8'))
+    for unit in by_stem.get(f"unit.{link['Target model unit']}", []):
+      for input_elem in unit.inputs:
+        if input_elem.attrib.get('name') == link['Target variable name']:
+          input_elem.attrib['variablecategory'] = 'auxiliary'
+          if unit not in modified:
+            modified.append(unit)
+  for unit in modified:
+    with open(unit.path, 'wb') as f:
+      f.write(ET.tostring(unit.root, encoding='utf-8'))
   
-  return ET.tostring(root, encoding='utf-8')
+  return root
+
+
+#-----------------------------------------------------------------
+# Pretty printing of an XML tree, in a single pass over the tree
+# The output is the same as the one of xml.dom.minidom.parseString(ET.tostring(root)).toprettyxml() : a tab per level,
+# elements with a single text on one line, the text nodes of mixed content on their own line.
+#-----------------------------------------------------------------
+def _escape(data):
+  return data.replace("&", "&amp;").replace("<", "&lt;").replace("\"", "&quot;").replace(">", "&gt;")
+
+
+def _text(data):
+  # Line ends of the text are normalized as an XML parser does
+  return data.replace("\r\n", "\n").replace("\r", "\n")
+
+
+def _write_element(write, elem, indent, addindent, newl):
+  write(indent + "<" + elem.tag)
+  for name, value in elem.attrib.items():
+    write(f' {name}="{_escape(value)}"')
+
+  children = [_text(elem.text)] if elem.text else []
+  for child in elem:
+    children.append(child)
+    if child.tail:
+      children.append(_text(child.tail))
+
+  if not children:
+    write("/>" + newl)
+    return
+  write(">")
+  if len(children) == 1 and isinstance(children[0], str):
+    write(_escape(children[0]))
+  else:
+    write(newl)
+    for child in children:
+      if isinstance(child, str):
+        write(_escape(indent + addindent + child + newl))
+      else:
+        _write_element(write, child, indent + addindent, addindent, newl)
+    write(indent)
+  write(f"</{elem.tag}>{newl}")
+
+
+def _write_xml(write, root):
+  # Namespaces and comments, never found in Crop2ML files, take the prefixes given by ElementTree through minidom
+  if any(not isinstance(elem.tag, str) or elem.tag.startswith("{") or any(name.startswith("{") for name in elem.attrib) for elem in root.iter()):
+    write(xml.dom.minidom.parseString(ET.tostring(root, encoding='utf-8')).toprettyxml())
+    return
+  write('<?xml version="1.0" ?>\n')
+  _write_element(write, root, "", "\t", "\n")
+
+
+#-----------------------------------------------------------------
+# Function to get the pretty printed text of an XML tree
+#-----------------------------------------------------------------
+def pretty_xml(root):
+  buffer = io.StringIO()
+  _write_xml(buffer.write, root)
+  return buffer.getvalue()
+
+
+#-----------------------------------------------------------------
+# Function to write an XML tree pretty printed in a file, as it is serialized
+#-----------------------------------------------------------------
+def write_xml(root, xml_path):
+  with open(xml_path, 'w', encoding='utf-8') as f:
+    _write_xml(f.write, root)
 
 
 #-----------------------------------------------------------------
@@ -315,12 +405,10 @@ def convert_composite(file_path, json_metadata, XML_units):
 def json_to_XML_unit(model_composite, output_path, json_metadata, json_algo, log_file):
   metadata = json_metadata['metadata']
   xml_path = output_path + "/" + "unit." + metadata['Title'] + ".xml"
-  xml_data = convert_unit(model_composite, json_metadata, json_algo)
-  dom = xml.dom.minidom.parseString(xml_data.decode('utf-8') if isinstance(xml_data, bytes) else xml_data)
-  with open(xml_path, 'w', encoding='utf-8') as f:
-    f.write(dom.toprettyxml())
+  write_xml(convert_unit(model_composite, json_metadata, json_algo), xml_path)
 
-  log_comments(json_algo, output_path, log_file, metadata['Title'])
+  if log_file is not None:
+    log_comments(json_algo, output_path, log_file, metadata['Title'])
 
   return xml_path
 
@@ -332,10 +420,7 @@ def json_to_XML_unit(model_composite, output_path, json_metadata, json_algo, log
 def json_to_XML_composite(model_composite, output_path, json_metadata, XML_units, log_file):
   base = Path(model_composite).stem
   xml_path = output_path + "/" + "composition." + base + ".xml"
-  xml_data = convert_composite(model_composite, json_metadata, XML_units)
-  dom = xml.dom.minidom.parseString(xml_data.decode('utf-8') if isinstance(xml_data, bytes) else xml_data)
-  with open(xml_path, 'w', encoding='utf-8') as f:
-    f.write(dom.toprettyxml())
+  write_xml(convert_composite(model_composite, json_metadata, XML_units), xml_path)
 
   log_comments(json_metadata, output_path, log_file, "Composite model")
 
@@ -392,5 +477,5 @@ def format_xml(xml_data):
           except ValueError:
             attrs[attr_key] = ""
   
-  # Return the formatted XML as string
-  return ET.tostring(root, encoding='utf-8')
\ No newline at end of file
+  # Return the formatted XML tree
+  return root
\ No newline at end of file
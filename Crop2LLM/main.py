@@ -1,10 +1,23 @@
 import argparse
 import os
 import sys
-from utilities import check_files
-from generation import maj_component, process_unit, process_composite, create_crop2ml_package, generate_component
+from utilities import check_files, configure_text_cache
+from response_cache import configure_cache, cache_stats
+from openAI_interaction import configure_client_pool, summarize_code
+from generation import maj_component, process_component, process_units_async, process_composite, create_crop2ml_package, generate_components
 from verification import check_code_composite, debug_code, debug_xml, generate_pyx_composite, generate_pyx_unit, check_code_unit
+from session import PackageSession
+from telemetry import configure_telemetry, summary_table
+from scheduler import configure_rate_limits
+from agents import load_agents
+from checkpoint import configure_checkpoint, checkpoint_stats
+from context_budget import configure_context_budget
+from batch import load_manifest, run_batch, write_batch_report
+from run_log import log_block
+from recording import configure_recording
+import asyncio
 import concurrent.futures
+import atexit
 import time
 
 #-----------------------------------------------------------------
@@ -16,10 +29,39 @@ SMALL_MODEL = "gpt-5-mini"
 COOKIE_CUTTER_TEMPLATE = "./config/cookiecutter-crop2ml/"
 LOG_FILE = "Crop2LLM_report.txt"
 REPORT_FILE = "Transformation_report.txt"
+TRACE_FILE = "Crop2LLM_trace.jsonl"
+CHECKPOINT_FILE = "Crop2LLM_checkpoint.json"
+BATCH_REPORT_SUFFIX = "_report.json"
 LANGUAGES = ['r', 'cs', 'py', 'f90', 'apsim', 'dssat', 'stics', 'bioma', 'sirius', 'java', 'openalea', 'simplace','cpp']
 NUMBER_CANDIDATES = 3
+# Number of AST-equivalent candidates needed to skip the consensus, and of extra candidates when the quorum is not reached
+CANDIDATE_QUORUM = 2
+MAX_EXTRA_CANDIDATES = 2
 MAX_PARALLEL_UNITS = 5
+# Tasks of the unit graph running at the same time, the metadata and the candidates of a unit run together
+MAX_PARALLEL_TASKS = 2 * MAX_PARALLEL_UNITS
+MAX_PARALLEL_FUNCTIONS = 4
+MAX_PARALLEL_LANGUAGES = os.cpu_count()
+MAX_PARALLEL_REPAIRS = 5
+# Jobs of a batch manifest converted at the same time
+MAX_PARALLEL_JOBS = 3
+MAX_CONCURRENT_REQUESTS = 50
 NUMBER_ITERATIONS = 20
+CACHE_FOLDER = "./config/cache/"
+CACHE_MAX_SIZE = 500 * 1024 * 1024
+CACHE_MAX_AGE = 30 * 24 * 3600
+# Characters of source, XML and instruction files kept in memory between prompts
+TEXT_CACHE_MAX_SIZE = 64 * 1024 * 1024
+# Requests and tokens per minute of each model, set them to the limits of your OpenAI tier
+RATE_LIMITS = {
+  BIG_MODEL: (500, 500000),
+  SMALL_MODEL: (500, 500000),
+}
+MAX_RETRIES = 6
+# Estimated tokens of the sources in a prompt, of the code given to one summary call and of the summaries kept
+MAX_SOURCE_TOKENS = 40000
+CHUNK_TOKENS = 8000
+SUMMARY_TOKENS = 8000
 
 UNIT_META = "./config/Agents/Agent-UnitMeta.txt"
 COMPOSITE_META = "./config/Agents/Agent-CompositeMeta.txt"
@@ -32,8 +74,9 @@ DEBUG_XML = "./config/Agents/Agent-DebugXML.txt"
 APPLY_CODE = "./config/Agents/Agent-ApplyCode.txt"
 APPLY_XML = "./config/Agents/Agent-ApplyXML.txt"
 CODE_OR_XML = "./config/Agents/Agent-CodeOrXML.txt"
-CONFIG_FILES = [
-  API_KEY_PATH,
+SUMMARIZE = "./config/Agents/Agent-Summarize.txt"
+AGENTS_OVERRIDES = "./config/Agents/overrides/"
+AGENT_FILES = [
   UNIT_META,
   COMPOSITE_META,
   PY_REFACTOR,
@@ -44,8 +87,193 @@ CONFIG_FILES = [
   DEBUG_XML,
   APPLY_CODE,
   APPLY_XML,
-  CODE_OR_XML
+  CODE_OR_XML,
+  SUMMARIZE
 ]
+CONFIG_FILES = [API_KEY_PATH]
+
+#-----------------------------------------------------------------
+# Function to print the tokens and latency of the agent calls per unit and phase at the end of the run
+#-----------------------------------------------------------------
+def print_telemetry_summary(trace_path):
+  print("\nAgent calls per unit and phase :")
+  print(summary_table())
+  print("\nAgent calls per agent :")
+  print(summary_table(("agent", "model")))
+  print(f"Detailed trace of every call in {trace_path}")
+
+
+#-----------------------------------------------------------------
+# Function to convert crop model units, and their composite, into a Crop2ML package in the output folder
+# Returns the folder of the generated package.
+#-----------------------------------------------------------------
+def convert_units(model_units, model_composite, output_folder, use_asyncio=False, resume=False):
+  XML_units = []
+  functions_transpiled = []
+
+  check_files(*model_units, comp=model_composite, config_files=CONFIG_FILES, log_file=LOG_FILE, output_folder=output_folder)
+
+  configure_checkpoint(os.path.join(output_folder, CHECKPOINT_FILE), resume)
+
+  print("Generating modelunits...")
+  if use_asyncio:
+    # Process each model unit concurrently, then the model composite
+    results = asyncio.run(process_units_async(API_KEY_PATH, UNIT_META, PY_REFACTOR, ALGO_META, CYML_TRANSPILE, PY_CONSENSUS,
+                                              SMALL_MODEL, BIG_MODEL, NUMBER_CANDIDATES, LOG_FILE, model_units, model_composite,
+                                              output_folder, MAX_CONCURRENT_REQUESTS, CANDIDATE_QUORUM, MAX_EXTRA_CANDIDATES))
+    print(f"Generating the composite model...")
+    composite_metadata, xml_composite, model_composite = process_composite(API_KEY_PATH, COMPOSITE_META, SMALL_MODEL, output_folder, [xml for xml, _ in results], model_composite, LOG_FILE, model_units[0][0])
+  else:
+    # Process the model units and the model composite as one task graph, each agent call starting once its inputs exist
+    results, composite_metadata, xml_composite, model_composite = process_component(
+      API_KEY_PATH, UNIT_META, PY_REFACTOR, ALGO_META, CYML_TRANSPILE, PY_CONSENSUS, COMPOSITE_META,
+      SMALL_MODEL, BIG_MODEL, NUMBER_CANDIDATES, LOG_FILE, model_units, model_composite, output_folder,
+      MAX_PARALLEL_TASKS, MAX_PARALLEL_FUNCTIONS, CANDIDATE_QUORUM, MAX_EXTRA_CANDIDATES)
+  # Results are in the order of the units so that the package is stable between runs
+  for xml, functions in results:
+    XML_units.append(xml)
+    functions_transpiled.append(functions)
+
+  # Create cookiecutter project
+  print(f"Generating Crop2ML project for the model component...")
+  project_dir = create_crop2ml_package(COOKIE_CUTTER_TEMPLATE, output_folder, model_composite, composite_metadata, XML_units, xml_composite, functions_transpiled, LOG_FILE)
+
+  print(f"Crop2ML package generated successfully in {project_dir} !")
+  print(f"Check {LOG_FILE} for more details during the automatic transformation !")
+
+  stats = checkpoint_stats()
+  print(f"Checkpoint : {stats['restored']} phases restored, {stats['recorded']} recorded in {CHECKPOINT_FILE}.")
+  return project_dir
+
+
+#-----------------------------------------------------------------
+# Function to verify the pyx code of a Crop2ML package
+# The XML and the code of the package are repaired by the agents until they can be generated and verified.
+# Returns False when they could not be repaired in NUMBER_ITERATIONS attempts.
+#-----------------------------------------------------------------
+def verify_package(package):
+  verif_result = False
+  code_generated = False
+  iteration = 0
+  report_path = os.path.join(package, REPORT_FILE)
+
+  check_files([], comp=None, config_files=CONFIG_FILES, log_file=REPORT_FILE, output_folder=package)
+
+  # Parsed models, topology and pyx sources shared by every attempt of the repair loops
+  session = PackageSession(package)
+
+  print("Checking code generated...")
+  while not code_generated and iteration < NUMBER_ITERATIONS:
+    iteration += 1
+    with log_block(report_path) as rf:
+      rf.write(f"GENERATING PYX CODE --- ATTEMPT {iteration} ---\n\n")
+    errors = []
+    try:
+      errors = generate_pyx_unit(package, report_path, session)
+      code_generated = not errors
+    except Exception as e:
+      print("Error during code generation, trying to fix it...")
+    if not code_generated:
+      debug_xml(API_KEY_PATH, DEBUG_XML, APPLY_XML, BIG_MODEL, package, report_path, errors, iteration < NUMBER_ITERATIONS, session, MAX_PARALLEL_REPAIRS)
+
+  if not code_generated:
+    print("Code generation failed. Please check the report for details.")
+    return False
+
+  iteration = 0
+  while not verif_result and iteration < NUMBER_ITERATIONS:
+    iteration += 1
+    with log_block(report_path) as rf:
+      rf.write(f"CHECKING CODE GENERATED --- ATTEMPT {iteration} ---\n\n")
+    errors = []
+    try:
+      errors = check_code_unit(package, report_path, session)
+      verif_result = not errors
+    except Exception as e:
+      print("Error during code verification, trying to fix it...")
+    if not verif_result:
+      debug_code(API_KEY_PATH, DEBUG_CYML, APPLY_XML, APPLY_CODE, CODE_OR_XML, BIG_MODEL, package, report_path, errors, iteration < NUMBER_ITERATIONS, session, MAX_PARALLEL_REPAIRS)
+
+  if not verif_result:
+    print("Code verification failed. Please check the report for details.")
+    return False
+
+  iteration = 0
+  code_generated = False
+  while not code_generated and iteration < NUMBER_ITERATIONS:
+    iteration += 1
+    with log_block(report_path) as rf:
+      rf.write(f"GENERATING COMPOSITE CODE --- ATTEMPT {iteration} ---\n\n")
+    errors = []
+    try:
+      errors = generate_pyx_composite(package, report_path, session)
+      code_generated = not errors
+    except Exception as e:
+      print("Error during code composite generation, trying to fix it...")
+    if not code_generated:
+      debug_xml(API_KEY_PATH, DEBUG_XML, APPLY_XML, BIG_MODEL, package, report_path, errors, iteration < NUMBER_ITERATIONS, session, MAX_PARALLEL_REPAIRS)
+
+  if not code_generated:
+    print("Code generation failed. Please check the report for details.")
+    return False
+
+  iteration = 0
+  verif_result = False
+  while not verif_result and iteration < NUMBER_ITERATIONS:
+    iteration += 1
+    with log_block(report_path) as rf:
+      rf.write(f"CHECKING CODE COMPOSITE GENERATED --- ATTEMPT {iteration} ---\n\n")
+    errors = []
+    try:
+      errors = check_code_composite(package, report_path, session)
+      verif_result = not errors
+    except Exception as e:
+      print("Error during code verification, trying to fix it...")
+    if not verif_result:
+      debug_code(API_KEY_PATH, DEBUG_CYML, APPLY_XML, APPLY_CODE, CODE_OR_XML, BIG_MODEL, package, report_path, errors, iteration < NUMBER_ITERATIONS, session, MAX_PARALLEL_REPAIRS)
+
+  if not verif_result:
+    print("Code verification failed. Please check the report for details.")
+    return False
+
+  print("All files parsed and AST generated successfully.")
+  return True
+
+
+#-----------------------------------------------------------------
+# Function to convert a Crop2ML package into every language and platform supported, once its code is verified
+# Returns False when the package could not be verified.
+#-----------------------------------------------------------------
+def convert_package(package):
+  if not verify_package(package):
+    return False
+
+  report_path = os.path.join(package, REPORT_FILE)
+  pyx_folder = os.path.join(package, 'src', 'pyx')
+  crop2ml_folder = os.path.join(package, 'crop2ml')
+  maj_component(package, pyx_folder, crop2ml_folder)
+
+  print(f"Transpiling into {', '.join(LANGUAGES)}...")
+  results = generate_components(package, LANGUAGES, MAX_PARALLEL_LANGUAGES)
+  with log_block(report_path) as rf:
+    for language, elapsed, error in results:
+      if error is None:
+        rf.write(f"Component generated successfully in {language} ({elapsed:.1f} s).\n")
+      else:
+        rf.write(f"Error occurred while generating component for {language} ({elapsed:.1f} s): \n{error}\n")
+  for language, elapsed, error in results:
+    print(f"  {language:<10} {'OK' if error is None else 'FAILED':<7} {elapsed:6.1f} s")
+  return True
+
+
+#-----------------------------------------------------------------
+# Function to run a job of a batch manifest
+#-----------------------------------------------------------------
+def convert_job(job):
+  if job.kind == "package":
+    return convert_package(job.package)
+  return convert_units(job.units, job.composite, job.output, job.asyncio, job.resume)
+
 
 #-----------------------------------------------------------------
 # Simulation section
@@ -57,162 +285,84 @@ if __name__ == "__main__":
   parser.add_argument('-c', '--composite', required=False, help='Model composite file')
   parser.add_argument('-o', '--output', required=False, help='Output folder')
   parser.add_argument('-p', '--package', required=False, help='Model package directory')
+  parser.add_argument('-b', '--batch', required=False, help='Manifest (JSON or YAML) of the conversions to run together')
+  parser.add_argument('--no-cache', action='store_true', help='Do not read nor write the response cache')
+  parser.add_argument('--refresh-cache', action='store_true', help='Send every request again and overwrite the response cache')
+  parser.add_argument('--asyncio', action='store_true', help='Process the model units on a single event loop instead of threads')
+  parser.add_argument('--resume', action='store_true', help='Restore the phases already completed in the output folder instead of running them again')
+  parser.add_argument('--agents', required=False, default=AGENTS_OVERRIDES, help='Folder of agent instructions replacing the default ones of the same name')
+  parser.add_argument('--record', required=False, help='Append every agent call and its response to this recording, to be replayed by benchmarks/stub_server.py')
+  parser.add_argument('--base-url', required=False, help='URL of an OpenAI compatible server to send the requests to, such as the stub server')
   args = parser.parse_args()
 
-  if args.unit is not None :
-    if args.package is not None :
-      parser.error("You must choose between --unit and --package, not both.")
+  if sum(arg is not None for arg in (args.unit, args.package, args.batch)) > 1:
+    parser.error("You must choose between --unit, --package and --batch.")
+
+  if args.no_cache:
+    configure_cache(CACHE_FOLDER, CACHE_MAX_SIZE, CACHE_MAX_AGE, mode="bypass")
+  elif args.refresh_cache:
+    configure_cache(CACHE_FOLDER, CACHE_MAX_SIZE, CACHE_MAX_AGE, mode="refresh")
+  else:
+    configure_cache(CACHE_FOLDER, CACHE_MAX_SIZE, CACHE_MAX_AGE, mode="use")
+
+  configure_text_cache(TEXT_CACHE_MAX_SIZE)
+  # Instructions of every agent, read once and reused by all the calls
+  load_agents(AGENT_FILES, args.agents if os.path.isdir(args.agents) else None)
 
-    elif args.output is None:
+  # One connection per request that can be in flight : units processed in parallel times their candidates or functions, and their metadata
+  # The jobs of a batch share the pool and the rate limits, they are not multiplied by the number of jobs
+  configure_client_pool(MAX_PARALLEL_UNITS * (max(NUMBER_CANDIDATES, MAX_PARALLEL_FUNCTIONS) + 1), base_url=args.base_url)
+  configure_recording(args.record)
+  configure_rate_limits(RATE_LIMITS, MAX_RETRIES)
+  configure_context_budget(MAX_SOURCE_TOKENS, CHUNK_TOKENS, SUMMARY_TOKENS,
+                           summarize=lambda chunk: summarize_code(API_KEY_PATH, SUMMARIZE, SMALL_MODEL, chunk))
+
+  #-----------------------------------------------------------------
+  # SECTION : From crop model component to Crop2ML 
+  if args.unit is not None :
+    if args.output is None:
       parser.error("Output folder must be specified when using --unit.")
 
-    #-----------------------------------------------------------------
-    # SECTION : From crop model component to Crop2ML 
-    else :
-      model_units = args.unit
-      model_composite = args.composite
-      output_folder = args.output
-      XML_units = []
-      codes = []
-      functions_transpiled = []
-
-      check_files(*model_units, comp=model_composite, config_files=CONFIG_FILES, log_file=LOG_FILE, output_folder=output_folder)
-
-      # Process each model unit concurrently
-      print("Generating modelunits...")
-      with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_PARALLEL_UNITS) as executor:
-        futures = [
-          executor.submit(process_unit, API_KEY_PATH, UNIT_META, PY_REFACTOR, ALGO_META, CYML_TRANSPILE, PY_CONSENSUS,
-                          SMALL_MODEL, BIG_MODEL, NUMBER_CANDIDATES, LOG_FILE, grp, model_composite, output_folder)
-          for idx, grp in enumerate(model_units)
-        ]
-        for fut in concurrent.futures.as_completed(futures):
-          xml, functions = fut.result()
-          XML_units.append(xml)
-          functions_transpiled.append(functions)
-
-      # To delete
-      start = time.time()
-
-      # Process model composite
-      print(f"Generating the composite model...")
-      composite_metadata, xml_composite, model_composite = process_composite(API_KEY_PATH, COMPOSITE_META, SMALL_MODEL, output_folder, XML_units, model_composite, LOG_FILE, model_units[0][0])
-      
-      # To delete
-      end = time.time()
-      print(f"Time elapsed for processing composite: {end - start} seconds")
-      
-      # Create cookiecutter project
-      print(f"Generating Crop2ML project for the model component...")
-      project_dir = create_crop2ml_package(COOKIE_CUTTER_TEMPLATE, output_folder, model_composite, composite_metadata, XML_units, xml_composite, functions_transpiled, LOG_FILE)
-
-      print(f"Crop2ML package generated successfully in {project_dir} !")
-      print(f"Check {LOG_FILE} for more details during the automatic transformation !")
+    configure_telemetry(os.path.join(args.output, TRACE_FILE))
+    atexit.register(print_telemetry_summary, os.path.join(args.output, TRACE_FILE))
+
+    convert_units(args.unit, args.composite, args.output, args.asyncio, args.resume)
+
+    stats = cache_stats()
+    print(f"Response cache ({stats['mode']}) : {stats['hits']} hits, {stats['misses']} misses, {stats['stores']} stored.")
 
   #-----------------------------------------------------------------
   # SECTION : From Crop2ML to crop model component
   elif args.package is not None:
-    package = args.package
-    verif_result = False
-    code_generated = False
-    iteration = 0
-    report_path = os.path.join(package, REPORT_FILE)
-
-    check_files([], comp=None, config_files=CONFIG_FILES, log_file=REPORT_FILE, output_folder=package)
-
-    # To delete
-    start = time.time()
-
-    print("Checking code generated...")
-    while not code_generated and iteration < NUMBER_ITERATIONS:
-      iteration += 1
-      with open(report_path, 'a') as rf:
-        rf.write(f"GENERATING PYX CODE --- ATTEMPT {iteration} ---\n\n")
-      try:
-        code_generated = generate_pyx_unit(package, report_path)
-      except Exception as e:
-        print("Error during code generation, trying to fix it...")
-      if not code_generated:
-        debug_xml(API_KEY_PATH, DEBUG_XML, APPLY_XML, BIG_MODEL, package, report_path, iteration < NUMBER_ITERATIONS)
+    configure_telemetry(os.path.join(args.package, TRACE_FILE))
+    atexit.register(print_telemetry_summary, os.path.join(args.package, TRACE_FILE))
 
-    if not code_generated:
-      print("Code generation failed. Please check the report for details.")
-      sys.exit()
-    
-    iteration = 0
-    while not verif_result and iteration < NUMBER_ITERATIONS:
-      iteration += 1
-      with open(report_path, 'a') as rf:
-        rf.write(f"CHECKING CODE GENERATED --- ATTEMPT {iteration} ---\n\n")
-      try:
-        verif_result = check_code_unit(package, report_path)
-      except Exception as e:
-        print("Error during code verification, trying to fix it...")
-      if not verif_result:
-        debug_code(API_KEY_PATH, DEBUG_CYML, APPLY_XML, APPLY_CODE, CODE_OR_XML, BIG_MODEL, package, report_path, iteration < NUMBER_ITERATIONS)
-      
-    if not verif_result:
-      print("Code verification failed. Please check the report for details.")
+    if not convert_package(args.package):
       sys.exit()
 
-    iteration = 0
-    code_generated = False
-    while not code_generated and iteration < NUMBER_ITERATIONS:
-      iteration += 1
-      with open(report_path, 'a') as rf:
-        rf.write(f"GENERATING COMPOSITE CODE --- ATTEMPT {iteration} ---\n\n")
-      try:
-        code_generated = generate_pyx_composite(package, report_path)
-      except Exception as e:
-        print("Error during code composite generation, trying to fix it...")
-      if not code_generated:
-        debug_xml(API_KEY_PATH, DEBUG_CYML, DEBUG_XML, APPLY_XML, APPLY_CODE, CODE_OR_XML, BIG_MODEL, package, report_path, iteration < NUMBER_ITERATIONS)
-      
-    if not code_generated:
-      print("Code generation failed. Please check the report for details.")
-      sys.exit()
+  #-----------------------------------------------------------------
+  # SECTION : Batch of conversions sharing the workers and the rate limits
+  elif args.batch is not None:
+    jobs = load_manifest(args.batch)
+    report_path = f"{os.path.splitext(args.batch)[0]}{BATCH_REPORT_SUFFIX}"
+    trace_path = f"{os.path.splitext(args.batch)[0]}_{TRACE_FILE}"
+    configure_telemetry(trace_path)
+    atexit.register(print_telemetry_summary, trace_path)
 
-    iteration = 0
-    verif_result = False
-    while not verif_result and iteration < NUMBER_ITERATIONS:
-      iteration += 1
-      with open(report_path, 'a') as rf:
-        rf.write(f"CHECKING CODE COMPOSITE GENERATED --- ATTEMPT {iteration} ---\n\n")
-      try:
-        verif_result = check_code_composite(package, report_path)
-      except Exception as e:
-        print("Error during code verification, trying to fix it...")
-      if not verif_result:
-        debug_code(API_KEY_PATH, DEBUG_CYML, APPLY_XML, APPLY_CODE, CODE_OR_XML, BIG_MODEL, package, report_path, iteration < NUMBER_ITERATIONS)
-      
-    if not verif_result:
-      print("Code verification failed. Please check the report for details.")
-      sys.exit()
+    print(f"Running {len(jobs)} jobs of {args.batch}, {MAX_PARALLEL_JOBS} at a time...")
+    start = time.perf_counter()
+    results = run_batch(jobs, convert_job, MAX_PARALLEL_JOBS)
+    print(write_batch_report(results, report_path, time.perf_counter() - start))
+    print(f"Consolidated report of the batch in {report_path}")
 
-    else:
-      print("All files parsed and AST generated successfully.")
-      pyx_folder = os.path.join(package, 'src', 'pyx')
-      crop2ml_folder = os.path.join(package, 'crop2ml')
-      maj_component(package, pyx_folder, crop2ml_folder)
-
-      for language in LANGUAGES:
-        print(f"Transpiling into {language}...")
-        try:
-          generate_component(package, language)
-          with open(report_path, 'a') as rf:
-            rf.write(f"Component generated successfully in {language}.\n")
-        except Exception as e:
-          with open(report_path, 'a') as rf:
-            rf.write(f"Error occurred while generating component for {language}: \n{e}\n")
-          continue
-    
-    # To delete
-      end = time.time()
-      print(f"Time elapsed for debugging: {end - start} seconds")
+    stats = cache_stats()
+    print(f"Response cache ({stats['mode']}) : {stats['hits']} hits, {stats['misses']} misses, {stats['stores']} stored.")
+    if any(r.status != "ok" for r in results):
+      sys.exit(1)
 
   else:
-    parser.error("At least one of --unit or --package must be provided.")
+    parser.error("At least one of --unit, --package or --batch must be provided.")
 
 
 
-  #generate_component(package, "bioma")
\ No newline at end of file
+  #generate_component(package, "bioma")
@@ -1,10 +1,56 @@
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
+import httpx
+import asyncio
 import os
+import threading
+import time
 from pathlib import Path
 import json
 from utilities import extract_text, extract_extension, language
+from response_cache import cache_key, get_cached_response, store_response
+from telemetry import agent_name, record_call, usage_tokens
+from recording import record_exchange, request_headers
+from agents import DRAFT_SETTINGS, get_agent
+from static_interface import extract_interface, merge_interface
+from scheduler import PRIORITY_BULK, PRIORITY_REPAIR, schedule, schedule_async, settle
 from prompt_creation import prompt_apply_code_unit, prompt_apply_xml, prompt_choose, prompt_debug_code_unit, prompt_debug_xml_composite, prompt_debug_xml_unit, prompt_unit
-from prompt_creation import prompt_composite, prompt_refactor, prompt_transpile, prompt_debug_composite, prompt_consensus_JSON, prompt_consensus_python
+from prompt_creation import prompt_algo_draft, prompt_summarize, prompt_composite, prompt_refactor, prompt_transpile, prompt_debug_composite, prompt_consensus_JSON, prompt_consensus_python
+
+_clients = {}
+_clients_lock = threading.Lock()
+_client_pool = {"max_connections": 20, "base_url": None}
+
+
+#-----------------------------------------------------------------
+# Function to configure the HTTP connection pool shared by the OpenAI clients
+# The pool should be sized on the number of requests that can be sent at the same time.
+#-----------------------------------------------------------------
+def configure_client_pool(max_connections, base_url=None):
+  with _clients_lock:
+    _client_pool["max_connections"] = max_connections
+    _client_pool["base_url"] = base_url
+    for client in _clients.values():
+      client.close()
+    _clients.clear()
+
+
+#-----------------------------------------------------------------
+# Function to get the OpenAI client of an API key
+# Clients are created once per API key and reused by every agent, so that connections stay warm.
+#-----------------------------------------------------------------
+def get_client(api_key):
+  with _clients_lock:
+    client = _clients.get(api_key)
+    if client is None:
+      max_connections = _client_pool["max_connections"]
+      http_client = DefaultHttpxClient(
+        limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+      )
+      # Retries are done by the scheduler, which knows about the budgets of each model
+      client = OpenAI(api_key = api_key, base_url = _client_pool["base_url"], http_client = http_client, max_retries = 0)
+      _clients[api_key] = client
+  return client
+
 
 #-----------------------------------------------------------------
 # Function to connect to OpenAI's API
@@ -13,7 +59,7 @@ from prompt_creation import prompt_composite, prompt_refactor, prompt_transpile,
 def extract_api_key(API_KEY_PATH):
   api_key = extract_text(API_KEY_PATH)
   try:
-    OpenAI(api_key = api_key)
+    get_client(api_key)
   except Exception as e:
     print(f"An error occurred while connecting to OpenAI: {e}")
     return None
@@ -21,13 +67,10 @@ def extract_api_key(API_KEY_PATH):
 
 
 #-----------------------------------------------------------------
-# Function to send instructions and prompt to OpenAI's model
-# This function takes instructions, a prompt, an API key, and a model name and returns the response from the model.
+# Function to build the parameters of a request to OpenAI's Responses API
 #-----------------------------------------------------------------
-def send_to_gpt(instructions, prompt, api_key, model, reasoning_effort, text_format, verbosity):
-  client = OpenAI(api_key = api_key)
-
-  response = client.responses.create(
+def request_params(instructions, prompt, model, reasoning_effort, text_format, verbosity):
+  return dict(
     model=model,
     reasoning={"effort": reasoning_effort},
     store=True,
@@ -46,11 +89,59 @@ def send_to_gpt(instructions, prompt, api_key, model, reasoning_effort, text_for
     ],
   )
 
-  response = response.output_text
+
+#-----------------------------------------------------------------
+# Function to estimate the tokens of a request before sending it, about 4 characters per token
+# The scheduler corrects the budget of the model with the real usage once the response is received.
+#-----------------------------------------------------------------
+def estimate_tokens(chars):
+  return chars // 4 + 1
+
+
+#-----------------------------------------------------------------
+# Function to remove the markdown fences around a response
+#-----------------------------------------------------------------
+def clean_response(response):
   if response.startswith("```json"):
     response = response[7:].lstrip()
   if response.endswith("```"):
     response = response[:-3].rstrip()
+  return response
+
+
+#-----------------------------------------------------------------
+# Function to send instructions and prompt to OpenAI's model
+# This function takes instructions, a prompt, an API key, and a model name and returns the response from the model.
+# Responses are read from and stored in the response cache unless use_cache is False.
+# instructions_hash is the hash of the instructions when it is already known, such as the one of a registered agent.
+# Each call is recorded by the telemetry under the name of its agent.
+# Requests go through the scheduler : they wait for the budget of their model, in their priority lane, and are retried when throttled.
+# In record mode the request and its response are appended to the recording replayed by the stub server.
+#-----------------------------------------------------------------
+def send_to_gpt(instructions, prompt, api_key, model, reasoning_effort, text_format, verbosity, use_cache=True, cache_variant=0, agent=None,
+                priority=PRIORITY_BULK, instructions_hash=None):
+  start = time.perf_counter()
+  prompt_chars = len(instructions) + len(prompt)
+  if use_cache:
+    key = cache_key(model, reasoning_effort, text_format, verbosity, instructions, prompt, cache_variant, instructions_hash)
+    cached = get_cached_response(key)
+    if cached is not None:
+      record_call(agent, model, reasoning_effort, prompt_chars, None, time.perf_counter() - start, cached=True)
+      record_exchange(agent, model, instructions, prompt, cache_variant, cached, (0, 0, 0))
+      return cached
+
+  client = get_client(api_key)
+  params = request_params(instructions, prompt, model, reasoning_effort, text_format, verbosity)
+  headers = request_headers(agent, cache_variant)
+  raw, retries = schedule(lambda: client.responses.with_raw_response.create(**params, extra_headers=headers), model, estimate_tokens(prompt_chars), priority)
+  response = raw.parse()
+  settle(model, estimate_tokens(prompt_chars), sum(usage_tokens(response.usage)[:2]))
+  record_call(agent, model, reasoning_effort, prompt_chars, response.usage, time.perf_counter() - start, retries)
+  record_exchange(agent, model, instructions, prompt, cache_variant, response.output_text, usage_tokens(response.usage))
+  response = clean_response(response.output_text)
+
+  if use_cache:
+    store_response(key, response, model)
   return(response)
 
 
@@ -62,11 +153,18 @@ def create_unit_metadata(api_key_path, agent_descmeta, model, output_path, main_
   api_key = extract_api_key(api_key_path)
   extension = extract_extension(main_file)
   language_name = language(extension)
-  instructions_metadata = extract_text(agent_descmeta)
+  metadata_agent = get_agent(agent_descmeta)
 
   prompt = prompt_unit(main_file, language_name, helper_files)
-  response_metadata = send_to_gpt(instructions_metadata, prompt, api_key, model, "medium", "json_object", "low")
+  response_metadata = send_to_gpt(metadata_agent.text, prompt, api_key, model, metadata_agent.reasoning_effort, "json_object", metadata_agent.verbosity, agent=metadata_agent.name, instructions_hash=metadata_agent.hash)
+
+  return save_unit_metadata(response_metadata, output_path, main_file)
+
 
+#-----------------------------------------------------------------
+# Function to save the metadata JSON file of a unit model
+#-----------------------------------------------------------------
+def save_unit_metadata(response_metadata, output_path, main_file):
   os.makedirs(output_path, exist_ok=True)
   base = Path(main_file).stem
   json_metadata_path = output_path + "/" + base + "_metadata.json"
@@ -83,9 +181,9 @@ def create_unit_metadata(api_key_path, agent_descmeta, model, output_path, main_
 #-----------------------------------------------------------------
 def create_composite_metadata(api_key_path, agent_compositemeta, model, output_path, modelunits, main_file):
   api_key = extract_api_key(api_key_path)
-  instructions_metadata = extract_text(agent_compositemeta)
+  metadata_agent = get_agent(agent_compositemeta)
   prompt = prompt_composite(modelunits, main_file)
-  response_metadata = send_to_gpt(instructions_metadata, prompt, api_key, model, "high", "json_object", "low")
+  response_metadata = send_to_gpt(metadata_agent.text, prompt, api_key, model, metadata_agent.reasoning_effort, "json_object", metadata_agent.verbosity, agent=metadata_agent.name, instructions_hash=metadata_agent.hash)
 
   os.makedirs(output_path, exist_ok=True)
   if (main_file is None):
@@ -102,16 +200,27 @@ def create_composite_metadata(api_key_path, agent_compositemeta, model, output_p
 #-----------------------------------------------------------------
 # Function to create algorithm metadata JSON file
 # This function generates a algorithm metadata for a given code file and saves it as a JSON file.
+# The interface is first extracted statically from the code and the source files of the unit : the agent is not
+# called when every field is found, and only completes the draft otherwise, with the effort of DRAFT_SETTINGS.
 #-----------------------------------------------------------------
-def create_algo_metadata(api_key_path, agent_algometa, model, python_code):
+def create_algo_metadata(api_key_path, agent_algometa, model, python_code, source_files=()):
+  draft, unresolved = extract_interface(python_code, source_files)
+  if draft is not None and not unresolved:
+    print(f"Interface resolved statically, {agent_name(agent_algometa)} skipped")
+    return draft
+
   api_key = extract_api_key(api_key_path)
-  instructions_json = extract_text(agent_algometa)
+  json_agent = get_agent(agent_algometa)
 
-  prompt = prompt_refactor(python_code)
-  response = send_to_gpt(instructions_json, prompt, api_key, model, "high", "json_object", "low")
-  json_code = json.loads(response)
+  if draft is None:
+    prompt = prompt_refactor(python_code)
+    response = send_to_gpt(json_agent.text, prompt, api_key, model, json_agent.reasoning_effort, "json_object", json_agent.verbosity, agent=json_agent.name, instructions_hash=json_agent.hash)
+    return json.loads(response)
 
-  return json_code
+  reasoning_effort, verbosity = DRAFT_SETTINGS.get(json_agent.name, (json_agent.reasoning_effort, json_agent.verbosity))
+  prompt = prompt_algo_draft(python_code, draft, unresolved)
+  response = send_to_gpt(json_agent.text, prompt, api_key, model, reasoning_effort, "json_object", verbosity, agent=json_agent.name, instructions_hash=json_agent.hash)
+  return merge_interface(draft, json.loads(response))
 
 
 #-----------------------------------------------------------------
@@ -123,10 +232,10 @@ def create_consensus_JSON(api_key_path, agent_algo_consensus, model, jsons, main
   extension = extract_extension(main_file)
   language_name = language(extension)
 
-  instructions_algo_consensus = extract_text(agent_algo_consensus)
+  algo_consensus_agent = get_agent(agent_algo_consensus)
 
   prompt = prompt_consensus_JSON(jsons, main_file, language_name)
-  response = send_to_gpt(instructions_algo_consensus, prompt, api_key, model, "high", "json_object", "low")
+  response = send_to_gpt(algo_consensus_agent.text, prompt, api_key, model, algo_consensus_agent.reasoning_effort, "json_object", algo_consensus_agent.verbosity, agent=algo_consensus_agent.name, instructions_hash=algo_consensus_agent.hash)
 
   os.makedirs(output_path, exist_ok=True)
   base = Path(main_file).stem
@@ -139,18 +248,31 @@ def create_consensus_JSON(api_key_path, agent_algo_consensus, model, jsons, main
   return json_code
 
 
+#-----------------------------------------------------------------
+# Function to summarize a chunk of source code too big to be given as it is to the agents
+# This function is used by the context budget to summarize the code moved out of the prompts.
+#-----------------------------------------------------------------
+def summarize_code(api_key_path, agent_summarize, model, chunk):
+  api_key = extract_api_key(api_key_path)
+  summarize_agent = get_agent(agent_summarize)
+
+  prompt = prompt_summarize(chunk)
+  return send_to_gpt(summarize_agent.text, prompt, api_key, model, summarize_agent.reasoning_effort, "text", summarize_agent.verbosity, agent=summarize_agent.name, instructions_hash=summarize_agent.hash)
+
+
 #-----------------------------------------------------------------
 # Function to create python code
 # This function generates a refactored python module for a given code file and saves it.
+# The candidate index keeps each candidate in its own cache entry.
 #-----------------------------------------------------------------
-def create_python_code(api_key_path, agent_pyrefactor, model, main_file, helper_files):
+def create_python_code(api_key_path, agent_pyrefactor, model, main_file, helper_files, candidate=0):
   api_key = extract_api_key(api_key_path)
   extension = extract_extension(main_file)
   language_name = language(extension)
-  instructions_refactor = extract_text(agent_pyrefactor)
+  refactor_agent = get_agent(agent_pyrefactor)
 
   prompt = prompt_unit(main_file, language_name, helper_files)
-  response_refactored = send_to_gpt(instructions_refactor, prompt, api_key, model, "high", "text", "low")
+  response_refactored = send_to_gpt(refactor_agent.text, prompt, api_key, model, refactor_agent.reasoning_effort, "text", refactor_agent.verbosity, cache_variant=candidate, agent=refactor_agent.name, instructions_hash=refactor_agent.hash)
 
   return response_refactored
 
@@ -164,18 +286,25 @@ def create_consensus_python(api_key_path, agent_py_consensus, model, codes, main
   extension = extract_extension(main_file)
   language_name = language(extension)
 
-  instructions_py_consensus = extract_text(agent_py_consensus)
+  py_consensus_agent = get_agent(agent_py_consensus)
 
   prompt = prompt_consensus_python(codes, main_file, language_name, helper_files)
-  response = send_to_gpt(instructions_py_consensus, prompt, api_key, model, "high", "text", "low")
+  response = send_to_gpt(py_consensus_agent.text, prompt, api_key, model, py_consensus_agent.reasoning_effort, "text", py_consensus_agent.verbosity, agent=py_consensus_agent.name, instructions_hash=py_consensus_agent.hash)
+
+  return save_python_code(response, output_path, main_file)
 
+
+#-----------------------------------------------------------------
+# Function to save the refactored python module of a unit model
+#-----------------------------------------------------------------
+def save_python_code(code, output_path, main_file):
   os.makedirs(output_path, exist_ok=True)
   base = Path(main_file).stem
   python_code_path = output_path + "/" + base + "_code.py"
 
   with open(python_code_path, "w", encoding="utf-8") as f:
-    f.write(response)
-  return response
+    f.write(code)
+  return code
 
 
 #-----------------------------------------------------------------
@@ -184,10 +313,10 @@ def create_consensus_python(api_key_path, agent_py_consensus, model, codes, main
 #-----------------------------------------------------------------
 def create_cyml_code(api_key_path, agent_cymltranspile, model, python_module, algo_meta):
   api_key = extract_api_key(api_key_path)
-  instructions_transpile = extract_text(agent_cymltranspile)
+  transpile_agent = get_agent(agent_cymltranspile)
 
   prompt_transpiled = prompt_transpile(python_module, algo_meta)
-  response_cyml = send_to_gpt(instructions_transpile, prompt_transpiled, api_key, model, "high", "text", "low")
+  response_cyml = send_to_gpt(transpile_agent.text, prompt_transpiled, api_key, model, transpile_agent.reasoning_effort, "text", transpile_agent.verbosity, agent=transpile_agent.name, instructions_hash=transpile_agent.hash)
 
   return response_cyml
 
@@ -200,31 +329,31 @@ def create_debug_code_unit(api_key_path, agent_debug_code, agent_choose, agent_a
                     model, cyml_module, algo_meta, error_msg, apply_correction):
   
   api_key = extract_api_key(api_key_path)
-  instructions_debug = extract_text(agent_debug_code)
+  debug_agent = get_agent(agent_debug_code)
 
   prompt_debug = prompt_debug_code_unit(cyml_module, algo_meta, error_msg)
-  response = send_to_gpt(instructions_debug, prompt_debug, api_key, model, "high", "text", "medium")
+  response = send_to_gpt(debug_agent.text, prompt_debug, api_key, model, debug_agent.reasoning_effort, "text", debug_agent.verbosity, use_cache=False, priority=PRIORITY_REPAIR, agent=debug_agent.name, instructions_hash=debug_agent.hash)
   file_to_modify = ""
   response_xml = ""
   response_code = ""
 
   if apply_correction:
-    instructions_choose = extract_text(agent_choose)
+    choose_agent = get_agent(agent_choose)
     prompt_code_or_xml = prompt_choose(response)
-    response_choose = send_to_gpt(instructions_choose, prompt_code_or_xml, api_key, model, "medium", "json_object", "low")
+    response_choose = send_to_gpt(choose_agent.text, prompt_code_or_xml, api_key, model, choose_agent.reasoning_effort, "json_object", choose_agent.verbosity, use_cache=False, priority=PRIORITY_REPAIR, agent=choose_agent.name, instructions_hash=choose_agent.hash)
     json_response = json.loads(response_choose)
 
     file_to_modify = json_response.get("modifs").get("type", "")
 
     if file_to_modify == "XML" or file_to_modify == "BOTH":
-      instructions_apply = extract_text(agent_apply_xml)
+      apply_agent = get_agent(agent_apply_xml)
       prompt_apply = prompt_apply_xml(algo_meta, response)
-      response_xml = send_to_gpt(instructions_apply, prompt_apply, api_key, model, "medium", "text", "low")
+      response_xml = send_to_gpt(apply_agent.text, prompt_apply, api_key, model, apply_agent.reasoning_effort, "text", apply_agent.verbosity, use_cache=False, priority=PRIORITY_REPAIR, agent=apply_agent.name, instructions_hash=apply_agent.hash)
 
     if file_to_modify == "CODEBASE" or file_to_modify == "BOTH":
-      instructions_apply = extract_text(agent_apply_code)
+      apply_agent = get_agent(agent_apply_code)
       prompt_apply = prompt_apply_code_unit(cyml_module, error_msg, response)
-      response_code = send_to_gpt(instructions_apply, prompt_apply, api_key, model, "medium", "text", "low")   
+      response_code = send_to_gpt(apply_agent.text, prompt_apply, api_key, model, apply_agent.reasoning_effort, "text", apply_agent.verbosity, use_cache=False, priority=PRIORITY_REPAIR, agent=apply_agent.name, instructions_hash=apply_agent.hash)   
 
   return response, response_xml, response_code, file_to_modify
 
@@ -235,15 +364,15 @@ def create_debug_code_unit(api_key_path, agent_debug_code, agent_choose, agent_a
 #-----------------------------------------------------------------
 def create_debug_xml_unit(api_key_path, agent_debug, agent_apply, model, algo_meta, error_msg, apply_correction):
   api_key = extract_api_key(api_key_path)
-  instructions_debug = extract_text(agent_debug)
+  debug_agent = get_agent(agent_debug)
 
   prompt_debug = prompt_debug_xml_unit(algo_meta, error_msg)
-  response = send_to_gpt(instructions_debug, prompt_debug, api_key, model, "high", "text", "medium")
+  response = send_to_gpt(debug_agent.text, prompt_debug, api_key, model, debug_agent.reasoning_effort, "text", debug_agent.verbosity, use_cache=False, priority=PRIORITY_REPAIR, agent=debug_agent.name, instructions_hash=debug_agent.hash)
 
   if apply_correction:
-    instructions_apply = extract_text(agent_apply)
+    apply_agent = get_agent(agent_apply)
     prompt_apply = prompt_apply_xml(algo_meta, response)
-    response = send_to_gpt(instructions_apply, prompt_apply, api_key, model, "medium", "text", "low")
+    response = send_to_gpt(apply_agent.text, prompt_apply, api_key, model, apply_agent.reasoning_effort, "text", apply_agent.verbosity, use_cache=False, priority=PRIORITY_REPAIR, agent=apply_agent.name, instructions_hash=apply_agent.hash)
 
   return response
 
@@ -254,15 +383,15 @@ def create_debug_xml_unit(api_key_path, agent_debug, agent_apply, model, algo_me
 #-----------------------------------------------------------------
 def create_debug_xml_composite(api_key_path, agent_debug, agent_apply, model, algo_meta, algo_metas, error_msg, apply_correction):
   api_key = extract_api_key(api_key_path)
-  instructions_debug = extract_text(agent_debug)
+  debug_agent = get_agent(agent_debug)
 
   prompt_debug = prompt_debug_xml_composite(algo_meta, algo_metas, error_msg)
-  response = send_to_gpt(instructions_debug, prompt_debug, api_key, model, "high", "text", "medium")
+  response = send_to_gpt(debug_agent.text, prompt_debug, api_key, model, debug_agent.reasoning_effort, "text", debug_agent.verbosity, use_cache=False, priority=PRIORITY_REPAIR, agent=debug_agent.name, instructions_hash=debug_agent.hash)
 
   if apply_correction:
-    instructions_apply = extract_text(agent_apply)
+    apply_agent = get_agent(agent_apply)
     prompt_apply = prompt_apply_xml(algo_meta, response)
-    response = send_to_gpt(instructions_apply, prompt_apply, api_key, model, "medium", "text", "low")
+    response = send_to_gpt(apply_agent.text, prompt_apply, api_key, model, apply_agent.reasoning_effort, "text", apply_agent.verbosity, use_cache=False, priority=PRIORITY_REPAIR, agent=apply_agent.name, instructions_hash=apply_agent.hash)
 
   return response
 
@@ -274,34 +403,207 @@ def create_debug_xml_composite(api_key_path, agent_debug, agent_apply, model, al
 def create_debug_code_composite(api_key_path, agent_debug_code, agent_choose, agent_apply_code, agent_apply_xml, 
                     model, cyml_module, composite_meta, algo_metas, error_msg, apply_correction):
   api_key = extract_api_key(api_key_path)
-  instructions_debug = extract_text(agent_debug_code)
+  debug_agent = get_agent(agent_debug_code)
 
   prompt_debug = prompt_debug_composite(cyml_module, composite_meta, algo_metas, error_msg)
-  response = send_to_gpt(instructions_debug, prompt_debug, api_key, model, "high", "text", "medium")
+  response = send_to_gpt(debug_agent.text, prompt_debug, api_key, model, debug_agent.reasoning_effort, "text", debug_agent.verbosity, use_cache=False, priority=PRIORITY_REPAIR, agent=debug_agent.name, instructions_hash=debug_agent.hash)
 
   file_to_modify = ""
   response_xml = ""
   response_code = ""
 
   if apply_correction:
-    instructions_choose = extract_text(agent_choose)
+    choose_agent = get_agent(agent_choose)
     prompt_code_or_xml = prompt_choose(response)
-    response_choose = send_to_gpt(instructions_choose, prompt_code_or_xml, api_key, model, "medium", "json_object", "low")
+    response_choose = send_to_gpt(choose_agent.text, prompt_code_or_xml, api_key, model, choose_agent.reasoning_effort, "json_object", choose_agent.verbosity, use_cache=False, priority=PRIORITY_REPAIR, agent=choose_agent.name, instructions_hash=choose_agent.hash)
     json_response = json.loads(response_choose)
 
     file_to_modify = json_response.get("modifs").get("type", "")
 
     if file_to_modify == "XML" or file_to_modify == "BOTH":
-      instructions_apply = extract_text(agent_apply_xml)
+      apply_agent = get_agent(agent_apply_xml)
       prompt_apply = prompt_apply_xml(composite_meta, response)
-      response_xml = send_to_gpt(instructions_apply, prompt_apply, api_key, model, "medium", "text", "low")
+      response_xml = send_to_gpt(apply_agent.text, prompt_apply, api_key, model, apply_agent.reasoning_effort, "text", apply_agent.verbosity, use_cache=False, priority=PRIORITY_REPAIR, agent=apply_agent.name, instructions_hash=apply_agent.hash)
       
     if file_to_modify == "CODEBASE" or file_to_modify == "BOTH":
-      instructions_apply = extract_text(agent_apply_code)
+      apply_agent = get_agent(agent_apply_code)
       prompt_apply = prompt_apply_code_unit(cyml_module, error_msg, response)
-      response_code = send_to_gpt(instructions_apply, prompt_apply, api_key, model, "medium", "text", "low")   
+      response_code = send_to_gpt(apply_agent.text, prompt_apply, api_key, model, apply_agent.reasoning_effort, "text", apply_agent.verbosity, use_cache=False, priority=PRIORITY_REPAIR, agent=apply_agent.name, instructions_hash=apply_agent.hash)   
 
   return response, response_xml, response_code, file_to_modify
 
 
-  
+#-----------------------------------------------------------------
+# ASYNCHRONOUS INTERACTION
+# Asynchronous counterparts of the agents used by process_unit, all run by a single event loop.
+# Every request of an event loop waits on the semaphore of that loop, so the number of requests in flight is bounded
+# whatever the number of units. The semaphore and the clients belong to the loop that created them : the jobs of a
+# batch run their own event loops in their own threads and never share them.
+#-----------------------------------------------------------------
+_async_lock = threading.Lock()
+_async_limits = {"max_requests": 50}
+_async_loops = {}
+
+
+#-----------------------------------------------------------------
+# Function to get the semaphore and the clients of the running event loop
+#-----------------------------------------------------------------
+def _loop_state():
+  loop = asyncio.get_running_loop()
+  with _async_lock:
+    state = _async_loops.get(loop)
+    if state is None:
+      max_requests = _async_limits["max_requests"]
+      state = _async_loops[loop] = {"max_requests": max_requests, "semaphore": asyncio.Semaphore(max_requests), "clients": {}}
+  return state
+
+
+#-----------------------------------------------------------------
+# Function to set the maximum number of requests in flight
+# Called from an event loop, it sets the limit of that loop, otherwise the limit of the loops started later.
+#-----------------------------------------------------------------
+def configure_async_concurrency(max_requests):
+  try:
+    asyncio.get_running_loop()
+  except RuntimeError:
+    _async_limits["max_requests"] = max_requests
+    return
+  state = _loop_state()
+  state["max_requests"] = max_requests
+  state["semaphore"] = asyncio.Semaphore(max_requests)
+
+
+#-----------------------------------------------------------------
+# Function to get the asynchronous OpenAI client of an API key for the running event loop
+#-----------------------------------------------------------------
+def get_async_client(api_key):
+  state = _loop_state()
+  client = state["clients"].get(api_key)
+  if client is None:
+    max_requests = state["max_requests"]
+    http_client = DefaultAsyncHttpxClient(
+      limits=httpx.Limits(max_connections=max_requests, max_keepalive_connections=max_requests)
+    )
+    client = AsyncOpenAI(api_key = api_key, base_url = _client_pool["base_url"], http_client = http_client, max_retries = 0)
+    state["clients"][api_key] = client
+  return client
+
+
+#-----------------------------------------------------------------
+# Function to close the asynchronous clients of the running event loop before it ends
+#-----------------------------------------------------------------
+async def close_async_clients():
+  loop = asyncio.get_running_loop()
+  with _async_lock:
+    state = _async_loops.pop(loop, None)
+  if state is None:
+    return
+  for client in state["clients"].values():
+    await client.close()
+
+
+#-----------------------------------------------------------------
+# Function to send instructions and prompt to OpenAI's model without blocking the event loop
+#-----------------------------------------------------------------
+async def send_to_gpt_async(instructions, prompt, api_key, model, reasoning_effort, text_format, verbosity, use_cache=True, cache_variant=0, agent=None,
+                            priority=PRIORITY_BULK, instructions_hash=None):
+  start = time.perf_counter()
+  prompt_chars = len(instructions) + len(prompt)
+  if use_cache:
+    key = cache_key(model, reasoning_effort, text_format, verbosity, instructions, prompt, cache_variant, instructions_hash)
+    cached = get_cached_response(key)
+    if cached is not None:
+      record_call(agent, model, reasoning_effort, prompt_chars, None, time.perf_counter() - start, cached=True)
+      record_exchange(agent, model, instructions, prompt, cache_variant, cached, (0, 0, 0))
+      return cached
+
+  semaphore = _loop_state()["semaphore"]
+  client = get_async_client(api_key)
+  params = request_params(instructions, prompt, model, reasoning_effort, text_format, verbosity)
+  headers = request_headers(agent, cache_variant)
+  async with semaphore:
+    raw, retries = await schedule_async(lambda: client.responses.with_raw_response.create(**params, extra_headers=headers), model, estimate_tokens(prompt_chars), priority)
+  response = raw.parse()
+  settle(model, estimate_tokens(prompt_chars), sum(usage_tokens(response.usage)[:2]))
+  record_call(agent, model, reasoning_effort, prompt_chars, response.usage, time.perf_counter() - start, retries)
+  record_exchange(agent, model, instructions, prompt, cache_variant, response.output_text, usage_tokens(response.usage))
+  response = clean_response(response.output_text)
+
+  if use_cache:
+    store_response(key, response, model)
+  return(response)
+
+
+#-----------------------------------------------------------------
+# Asynchronous version of create_unit_metadata, the sources are budgeted with asyncio.to_thread
+#-----------------------------------------------------------------
+async def create_unit_metadata_async(api_key_path, agent_descmeta, model, output_path, main_file, helper_files):
+  api_key = extract_text(api_key_path)
+  language_name = language(extract_extension(main_file))
+  metadata_agent = get_agent(agent_descmeta)
+
+  # The sources of the unit may be summarized by blocking calls, they are budgeted out of the event loop
+  prompt = await asyncio.to_thread(prompt_unit, main_file, language_name, helper_files)
+  response_metadata = await send_to_gpt_async(metadata_agent.text, prompt, api_key, model, metadata_agent.reasoning_effort, "json_object", metadata_agent.verbosity, agent=metadata_agent.name, instructions_hash=metadata_agent.hash)
+
+  return save_unit_metadata(response_metadata, output_path, main_file)
+
+
+#-----------------------------------------------------------------
+# Asynchronous version of create_python_code, the sources are budgeted with asyncio.to_thread
+#-----------------------------------------------------------------
+async def create_python_code_async(api_key_path, agent_pyrefactor, model, main_file, helper_files, candidate=0):
+  api_key = extract_text(api_key_path)
+  language_name = language(extract_extension(main_file))
+  refactor_agent = get_agent(agent_pyrefactor)
+
+  prompt = await asyncio.to_thread(prompt_unit, main_file, language_name, helper_files)
+  return await send_to_gpt_async(refactor_agent.text, prompt, api_key, model, refactor_agent.reasoning_effort, "text", refactor_agent.verbosity, cache_variant=candidate, agent=refactor_agent.name, instructions_hash=refactor_agent.hash)
+
+
+#-----------------------------------------------------------------
+# Asynchronous version of create_consensus_python, the sources are budgeted with asyncio.to_thread
+#-----------------------------------------------------------------
+async def create_consensus_python_async(api_key_path, agent_py_consensus, model, codes, main_file, helper_files, output_path):
+  api_key = extract_text(api_key_path)
+  language_name = language(extract_extension(main_file))
+  py_consensus_agent = get_agent(agent_py_consensus)
+
+  prompt = await asyncio.to_thread(prompt_consensus_python, codes, main_file, language_name, helper_files)
+  response = await send_to_gpt_async(py_consensus_agent.text, prompt, api_key, model, py_consensus_agent.reasoning_effort, "text", py_consensus_agent.verbosity, agent=py_consensus_agent.name, instructions_hash=py_consensus_agent.hash)
+
+  return save_python_code(response, output_path, main_file)
+
+
+#-----------------------------------------------------------------
+# Asynchronous version of create_algo_metadata, the agent is only called for the fields the static extraction missed
+#-----------------------------------------------------------------
+async def create_algo_metadata_async(api_key_path, agent_algometa, model, python_code, source_files=()):
+  draft, unresolved = extract_interface(python_code, source_files)
+  if draft is not None and not unresolved:
+    print(f"Interface resolved statically, {agent_name(agent_algometa)} skipped")
+    return draft
+
+  api_key = extract_text(api_key_path)
+  json_agent = get_agent(agent_algometa)
+
+  if draft is None:
+    prompt = prompt_refactor(python_code)
+    response = await send_to_gpt_async(json_agent.text, prompt, api_key, model, json_agent.reasoning_effort, "json_object", json_agent.verbosity, agent=json_agent.name, instructions_hash=json_agent.hash)
+    return json.loads(response)
+
+  reasoning_effort, verbosity = DRAFT_SETTINGS.get(json_agent.name, (json_agent.reasoning_effort, json_agent.verbosity))
+  prompt = prompt_algo_draft(python_code, draft, unresolved)
+  response = await send_to_gpt_async(json_agent.text, prompt, api_key, model, reasoning_effort, "json_object", verbosity, agent=json_agent.name, instructions_hash=json_agent.hash)
+  return merge_interface(draft, json.loads(response))
+
+
+#-----------------------------------------------------------------
+# Asynchronous version of create_cyml_code
+#-----------------------------------------------------------------
+async def create_cyml_code_async(api_key_path, agent_cymltranspile, model, python_module, algo_meta):
+  api_key = extract_text(api_key_path)
+  transpile_agent = get_agent(agent_cymltranspile)
+
+  prompt_transpiled = prompt_transpile(python_module, algo_meta)
+  return await send_to_gpt_async(transpile_agent.text, prompt_transpiled, api_key, model, transpile_agent.reasoning_effort, "text", transpile_agent.verbosity, agent=transpile_agent.name, instructions_hash=transpile_agent.hash)
@@ -1,6 +1,7 @@
 import os
 import json
 from utilities import extract_text
+from context_budget import unit_sources
 
 #-----------------------------------------------------------------
 # Function to create a prompt adapted to Agent-DescMeta/Agent-PyRefactor
@@ -15,13 +16,49 @@ def prompt_unit(main_file, language_name, helper_files):
     prompt += f"Additional files are provided to give more context about the model.\n"
     prompt += f"Each helper file is marked clearly with --- START HELPER FILE N--- at the start and --- END HELPER FILE N --- at the end.\n"
   prompt += f"Follow the system instructions.\n\n"
-  prompt += f"--- START MAIN FILE ---\n{extract_text(main_file)}\n--- END MAIN FILE ---"
+  sources = unit_sources(main_file, helper_files)
+  prompt += prompt_budget_notes(sources)
+  prompt += f"--- START MAIN FILE ---\n{sources.texts[main_file]}\n--- END MAIN FILE ---"
   for i, helper_file in enumerate(helper_files):
-    prompt += f"\n\n--- START HELPER FILE {i+1} ---\n{extract_text(helper_file)}\n--- END HELPER FILE {i+1} ---"
+    prompt += f"\n\n--- START HELPER FILE {i+1} ---\n{sources.texts[helper_file]}\n--- END HELPER FILE {i+1} ---"
+  prompt += prompt_summaries(sources)
   
   return prompt
 
 
+#-----------------------------------------------------------------
+# Function to explain how the sources of a unit were reduced to fit in the context budget, empty when they were not
+#-----------------------------------------------------------------
+def prompt_budget_notes(sources):
+  if not sources.notes:
+    return ""
+  prompt = f"The sources were reduced to fit in the context : {', '.join(sources.notes)}.\n"
+  if sources.summaries:
+    prompt += f"The code moved out of the files is summarized in the sections marked --- START SUMMARY N --- and --- END SUMMARY N ---.\n"
+  return prompt + "\n"
+
+
+#-----------------------------------------------------------------
+# Function to add the summaries of the code moved out of the sources of a unit
+#-----------------------------------------------------------------
+def prompt_summaries(sources):
+  prompt = ""
+  for i, summary in enumerate(sources.summaries):
+    prompt += f"\n\n--- START SUMMARY {i+1} ---\n{summary}\n--- END SUMMARY {i+1} ---"
+  return prompt
+
+
+#-----------------------------------------------------------------
+# Function to create a prompt adapted to Agent-Summarize
+# This function constructs a prompt based on a chunk of source code too big to be given as it is.
+#-----------------------------------------------------------------
+def prompt_summarize(chunk):
+  prompt = f"Summarize the following part of a crop model source code and follow the system instructions.\n"
+  prompt += f"The code is marked clearly with --- START CODE --- at the start and --- END CODE --- at the end.\n\n"
+  prompt += f"--- START CODE ---\n{chunk}\n--- END CODE ---"
+  return prompt
+
+
 #-----------------------------------------------------------------
 # Function to create a prompt adapted to Agent-AlgoMeta
 # This function constructs a prompt based on the refactored code.
@@ -33,6 +70,20 @@ def prompt_refactor(code_refactored):
   return prompt
 
 
+#-----------------------------------------------------------------
+# Function to create a prompt adapted to Agent-AlgoMeta when a draft of the JSON was extracted statically
+# Only the entries completed or corrected are asked for, they are merged into the draft.
+#-----------------------------------------------------------------
+def prompt_algo_draft(code_refactored, draft, unresolved):
+  prompt = prompt_refactor(code_refactored) + "\n\n"
+  prompt += f"A draft of the JSON was extracted from the function signatures and returns of the code and from the documentation of the original sources.\n"
+  prompt += f"The fields that could not be found are marked \"?\" : {', '.join(unresolved)}.\n"
+  prompt += f"Output a JSON object with the same schema containing only the init or process if they change, the inputs, outputs, functions and tests whose fields you complete or correct, with all their fields, and the inputs or outputs missing from the draft.\n"
+  prompt += f"The entries you do not output are kept as in the draft.\n\n"
+  prompt += f"--- START DRAFT ---\n{json.dumps(draft, indent=1)}\n--- END DRAFT ---"
+  return prompt
+
+
 #-----------------------------------------------------------------
 # Function to create a prompt adapted to Agent-AlgoConsensus
 # This function constructs a prompt based on the JSON candidates.
@@ -43,10 +94,13 @@ def prompt_consensus_JSON(jsons, main_file, language_name):
   prompt += f"The source file is marked clearly with --- SOURCE CODE FILE: filename --- at the start and --- END SOURCE CODE FILE --- at the end.\n"
   prompt += f"Each JSON file is marked clearly with --- JSON FILE --- at the start and --- END JSON FILE --- at the end.\n"
   prompt += f"Follow the system instructions.\n\n"
-  prompt += f"--- SOURCE CODE FILE: {main_file_name} ---\n{extract_text(main_file)}\n--- END FILE ---"
+  sources = unit_sources(main_file, [])
+  prompt += prompt_budget_notes(sources)
+  prompt += f"--- SOURCE CODE FILE: {main_file_name} ---\n{sources.texts[main_file]}\n--- END FILE ---"
  
   for i, candidate in enumerate(jsons):
     prompt += f"\n\n--- JSON FILE {i+1} ---\n{candidate}\n--- END FILE ---"
+  prompt += prompt_summaries(sources)
   
   return prompt
 
@@ -65,10 +119,13 @@ def prompt_consensus_python(codes, main_file, language_name, helper_files):
     prompt += f"Each helper file is marked clearly with --- START HELPER FILE N--- at the start and --- END HELPER FILE N --- at the end.\n"
   prompt += f"Each python module is marked clearly with --- PYTHON MODULE N --- at the start and --- END PYTHON MODULE N --- at the end.\n"
   prompt += f"Follow the system instructions.\n\n"
-  prompt += f"--- SOURCE CODE FILE: {main_file_name} ---\n{extract_text(main_file)}\n--- END SOURCE CODE FILE ---"
+  sources = unit_sources(main_file, helper_files)
+  prompt += prompt_budget_notes(sources)
+  prompt += f"--- SOURCE CODE FILE: {main_file_name} ---\n{sources.texts[main_file]}\n--- END SOURCE CODE FILE ---"
  
   for i, helper_file in enumerate(helper_files):
-    prompt += f"\n\n--- START HELPER FILE {i+1} ---\n{extract_text(helper_file)}\n--- END HELPER FILE {i+1} ---"
+    prompt += f"\n\n--- START HELPER FILE {i+1} ---\n{sources.texts[helper_file]}\n--- END HELPER FILE {i+1} ---"
+  prompt += prompt_summaries(sources)
   for i, code in enumerate(codes):
     prompt += f"\n\n--- PYTHON MODULE {i+1} ---\n{code}\n--- END PYTHON MODULE {i+1} ---"
   
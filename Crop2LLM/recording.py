@@ -0,0 +1,86 @@
+import os
+import json
+import hashlib
+import threading
+
+#-----------------------------------------------------------------
+# Recording of the agent calls
+# In record mode, every request sent by send_to_gpt is appended to a JSONL recording with its response and usage, so
+# that the stub server of benchmarks/ can replay a real run offline. A response is keyed by the hash of the instructions
+# of its agent, the hash of its prompt and its candidate variant, which the client sends in the headers of the request.
+#-----------------------------------------------------------------
+AGENT_HEADER = "X-Crop2LLM-Agent"
+VARIANT_HEADER = "X-Crop2LLM-Variant"
+
+_lock = threading.Lock()
+_state = {"path": None, "records": 0}
+
+
+#-----------------------------------------------------------------
+# Function to set the recording file, the calls are appended to it so that several runs can be recorded together
+# None stops the recording.
+#-----------------------------------------------------------------
+def configure_recording(recording_path):
+  with _lock:
+    _state["path"] = recording_path
+    _state["records"] = 0
+    if recording_path is not None:
+      os.makedirs(os.path.dirname(os.path.abspath(recording_path)), exist_ok=True)
+
+
+def recording_stats():
+  with _lock:
+    return {"path": _state["path"], "records": _state["records"]}
+
+
+#-----------------------------------------------------------------
+# Function to compute the key of a response from the texts of its request
+#-----------------------------------------------------------------
+def recording_key(instructions, prompt, variant=0):
+  instructions_hash = hashlib.sha256(instructions.encode("utf-8")).hexdigest()
+  prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+  return f"{instructions_hash}:{prompt_hash}:{variant}"
+
+
+#-----------------------------------------------------------------
+# Function to get the headers identifying the agent and the variant of a request
+#-----------------------------------------------------------------
+def request_headers(agent, variant=0):
+  return {AGENT_HEADER: agent or "-", VARIANT_HEADER: str(variant)}
+
+
+#-----------------------------------------------------------------
+# Function to append a call to the recording, when one is configured
+# text is the output text of the model before any cleaning, tokens its (input, output, reasoning) usage.
+#-----------------------------------------------------------------
+def record_exchange(agent, model, instructions, prompt, variant, text, tokens):
+  if _state["path"] is None:
+    return
+  record = {
+    "key": recording_key(instructions, prompt, variant),
+    "agent": agent or "-",
+    "model": model,
+    "text": text,
+    "input_tokens": tokens[0],
+    "output_tokens": tokens[1],
+    "reasoning_tokens": tokens[2],
+  }
+  with _lock:
+    if _state["path"] is None:
+      return
+    with open(_state["path"], 'a', encoding='utf-8') as f:
+      f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    _state["records"] += 1
+
+
+#-----------------------------------------------------------------
+# Function to read a recording, returns the last record of each key
+#-----------------------------------------------------------------
+def load_recording(recording_path):
+  records = {}
+  with open(recording_path, 'r', encoding='utf-8') as f:
+    for line in f:
+      if line.strip():
+        record = json.loads(line)
+        records[record["key"]] = record
+  return records
@@ -0,0 +1,178 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+#-----------------------------------------------------------------
+# Persistent cache of the responses returned by OpenAI's models
+# Each response is stored in its own JSON file, named after the hash of everything that defines the request.
+#-----------------------------------------------------------------
+CACHE_MODES = ["use", "refresh", "bypass"]
+
+_lock = threading.Lock()
+_state = {
+  "folder": None,
+  "max_size": 0,
+  "max_age": 0,
+  "mode": "bypass",
+  "size": 0,
+  "hits": 0,
+  "misses": 0,
+  "stores": 0,
+  "evictions": 0
+}
+
+
+#-----------------------------------------------------------------
+# Function to configure the response cache
+# mode "use" reads and writes the cache, "refresh" only writes it and "bypass" disables it.
+#-----------------------------------------------------------------
+def configure_cache(cache_folder, max_size, max_age, mode="use"):
+  if mode not in CACHE_MODES:
+    raise ValueError(f"Unknown cache mode {mode}, choose between {CACHE_MODES}")
+
+  with _lock:
+    _state["folder"] = cache_folder
+    _state["max_size"] = max_size
+    _state["max_age"] = max_age
+    _state["mode"] = mode
+    _state["hits"] = 0
+    _state["misses"] = 0
+    _state["stores"] = 0
+    _state["evictions"] = 0
+
+  if mode != "bypass":
+    os.makedirs(cache_folder, exist_ok=True)
+    evict_cache()
+
+
+#-----------------------------------------------------------------
+# Function to compute the key of a request
+# The instructions and the prompt are hashed separately so that a change in an agent file invalidates its entries.
+# The variant distinguishes requests sent several times on purpose, such as the refactoring candidates.
+# The hash of the instructions can be given when it is already known, it must be the sha256 of the instructions.
+#-----------------------------------------------------------------
+def cache_key(model, reasoning_effort, text_format, verbosity, instructions, prompt, variant=0, instructions_hash=None):
+  if instructions_hash is None:
+    instructions_hash = hashlib.sha256(instructions.encode("utf-8")).hexdigest()
+  prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+  key = "\n".join([model, reasoning_effort, text_format, verbosity, instructions_hash, prompt_hash, str(variant)])
+  return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def _entry_path(key):
+  return os.path.join(_state["folder"], key[:2], key + ".json")
+
+
+#-----------------------------------------------------------------
+# Function to read a response from the cache
+# Returns None when the entry is missing, unused for longer than the maximum age or when the cache is not read.
+#-----------------------------------------------------------------
+def get_cached_response(key):
+  if _state["mode"] != "use":
+    return None
+
+  entry_path = _entry_path(key)
+  try:
+    expired = _state["max_age"] and time.time() - os.path.getmtime(entry_path) > _state["max_age"]
+    if not expired:
+      with open(entry_path, "r", encoding="utf-8") as f:
+        entry = json.load(f)
+  except (OSError, ValueError):
+    expired = True
+
+  if expired:
+    with _lock:
+      _state["misses"] += 1
+    return None
+
+  # Mark the entry as recently used for the eviction policy
+  try:
+    os.utime(entry_path)
+  except OSError:
+    pass
+  with _lock:
+    _state["hits"] += 1
+  return entry["response"]
+
+
+#-----------------------------------------------------------------
+# Function to store a response in the cache
+#-----------------------------------------------------------------
+def store_response(key, response, model):
+  if _state["mode"] == "bypass":
+    return
+
+  entry_path = _entry_path(key)
+  os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+  entry = {"model": model, "created": time.time(), "response": response}
+  tmp_path = f"{entry_path}.{threading.get_ident()}.tmp"
+  with open(tmp_path, "w", encoding="utf-8") as f:
+    json.dump(entry, f, ensure_ascii=False)
+  os.replace(tmp_path, entry_path)
+
+  with _lock:
+    _state["stores"] += 1
+    _state["size"] += os.path.getsize(entry_path)
+    over_size = _state["max_size"] and _state["size"] > _state["max_size"]
+  if over_size:
+    evict_cache()
+
+
+#-----------------------------------------------------------------
+# Function to evict entries from the cache
+# Entries unused for longer than the maximum age are removed first, then the least recently used ones until the cache fits in its maximum size.
+#-----------------------------------------------------------------
+def evict_cache():
+  if _state["folder"] is None or not os.path.isdir(_state["folder"]):
+    return
+
+  with _lock:
+    now = time.time()
+    entries = []
+    for dirpath, _, filenames in os.walk(_state["folder"]):
+      for filename in filenames:
+        if not filename.endswith(".json"):
+          continue
+        path = os.path.join(dirpath, filename)
+        try:
+          stat = os.stat(path)
+        except OSError:
+          continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    total_size = 0
+    kept = []
+    for mtime, size, path in entries:
+      if _state["max_age"] and now - mtime > _state["max_age"]:
+        _remove_entry(path)
+      else:
+        kept.append((mtime, size, path))
+        total_size += size
+
+    if _state["max_size"]:
+      kept.sort()
+      for mtime, size, path in kept:
+        if total_size <= _state["max_size"]:
+          break
+        _remove_entry(path)
+        total_size -= size
+
+    _state["size"] = total_size
+
+
+def _remove_entry(path):
+  try:
+    os.remove(path)
+    _state["evictions"] += 1
+  except OSError:
+    pass
+
+
+#-----------------------------------------------------------------
+# Function to get the hit/miss counters of the cache
+#-----------------------------------------------------------------
+def cache_stats():
+  with _lock:
+    return {k: _state[k] for k in ["mode", "hits", "misses", "stores", "evictions", "size"]}
@@ -0,0 +1,483 @@
+import os
+import ast
+import copy
+import math
+import tempfile
+from pycropml.transpiler.main import Main
+
+#-----------------------------------------------------------------
+# Rule-based transpilation of Python functions into CyML
+# The straight-line numeric functions of a refactored module are transpiled without any agent, from their ast and the
+# datatypes of the algo metadata : arithmetic, if/elif/else, for loops over range, while loops, indexing and append on
+# typed lists, the functions of math, abs, min, max, len, calls to the other functions of the module, and a single
+# return at the end of the function. The type of each local is inferred from all its assignments (int and float
+# give float), and declared with cdef.
+# Any other construct, or a type that cannot be known, leaves the function to Agent-CyMLTranspile. The CyML produced
+# is parsed and converted to the AST of pycropml before being used, the function is also left to the agent otherwise.
+#-----------------------------------------------------------------
+INDENT = "    "
+DATATYPES = {"INT": "int", "INTEGER": "int", "DOUBLE": "float", "FLOAT": "float", "BOOLEAN": "bool", "BOOL": "bool", "STRING": "str",
+             "INTLIST": "intlist", "INTEGERLIST": "intlist", "DOUBLELIST": "floatlist", "STRINGLIST": "strlist", "BOOLEANLIST": "boollist",
+             "INTARRAY": "intarray", "INTEGERARRAY": "intarray", "DOUBLEARRAY": "floatarray"}
+ANNOTATIONS = {"int": "int", "float": "float", "bool": "bool", "str": "str",
+               "list[int]": "intlist", "List[int]": "intlist", "list[float]": "floatlist", "List[float]": "floatlist",
+               "list[str]": "strlist", "List[str]": "strlist", "list[bool]": "boollist", "List[bool]": "boollist"}
+ELEMENTS = {"intlist": "int", "floatlist": "float", "strlist": "str", "boollist": "bool", "intarray": "int", "floatarray": "float"}
+LISTS = {"int": "intlist", "float": "floatlist", "str": "strlist", "bool": "boollist"}
+NUMERIC = ("int", "float")
+MATH_FUNCTIONS = ("log", "sin", "cos", "tan", "acos", "asin", "atan", "sqrt", "ceil", "exp", "floor")
+MATH_CONSTANTS = {"pi": math.pi, "e": math.e}
+COMPARISONS = (ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE)
+MAX_PASSES = 8
+
+
+class Unsupported(Exception):
+  pass
+
+
+def join(first, second):
+  if first is None or first == second:
+    return second
+  if second is None:
+    return first
+  if first in NUMERIC and second in NUMERIC:
+    return "float"
+  raise Unsupported(f"{first} and {second} mixed")
+
+
+def assignable(target, value):
+  return value is None or target == value or (target == "float" and value == "int")
+
+
+def annotation_type(annotation):
+  if annotation is None:
+    return None
+  text = ast.unparse(annotation).strip("'\"").replace(" ", "")
+  if text not in ANNOTATIONS:
+    raise Unsupported(f"annotation {text}")
+  return ANNOTATIONS[text]
+
+
+def documented_types(algo_meta):
+  types = {}
+  for variable in algo_meta.get('inputs', []) + algo_meta.get('outputs', []):
+    if isinstance(variable, dict) and variable.get('name', '-') != '-':
+      types[variable['name']] = DATATYPES.get(str(variable.get('datatype', '')).strip().upper())
+  return types
+
+
+def is_math(node):
+  return isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id == "math"
+
+
+#-----------------------------------------------------------------
+# Rewriting of the expressions into CyML : math.sqrt(x) becomes sqrt(x) and math.pi its value
+#-----------------------------------------------------------------
+class MathNames(ast.NodeTransformer):
+  def visit_Attribute(self, node):
+    if is_math(node) and node.attr in MATH_CONSTANTS:
+      return ast.Constant(MATH_CONSTANTS[node.attr])
+    if is_math(node) and node.attr in MATH_FUNCTIONS:
+      return ast.Name(node.attr, ast.Load())
+    return self.generic_visit(node)
+
+
+def render(node):
+  return ast.unparse(MathNames().visit(copy.deepcopy(node)))
+
+
+#-----------------------------------------------------------------
+# Analysis of one function
+# The body is walked until the types of the locals no longer change, then once more to write the CyML : during the
+# first walks a name whose type is not known yet gives None, during the last one it makes the function unsupported.
+#-----------------------------------------------------------------
+class FunctionAnalysis:
+  def __init__(self, node, fixed, signature_of, documented, is_unit):
+    self.node = node
+    self.fixed = fixed
+    self.signature_of = signature_of
+    self.documented = documented
+    self.is_unit = is_unit
+    self.locals = {}
+    self.order = []
+    self.strict = False
+
+  def type_of(self, name):
+    if name in self.fixed:
+      return self.fixed[name]
+    if name in self.locals:
+      return self.locals[name]
+    if self.strict:
+      raise Unsupported(f"type of {name}")
+    return None
+
+  def assign(self, name, value_type):
+    if name in self.fixed:
+      if not assignable(self.fixed[name], value_type):
+        raise Unsupported(f"{value_type} assigned to {name}")
+      return
+    if name in self.documented:
+      raise Unsupported(f"local {name} documented in the algo metadata")
+    if name not in self.order:
+      self.order.append(name)
+    self.locals[name] = join(self.locals.get(name), value_type)
+
+  def known(self, *types):
+    if None in types:
+      if self.strict:
+        raise Unsupported("unknown type")
+      return False
+    return True
+
+  #-----------------------------------------------------------------
+  # Function to get the CyML type of an expression
+  #-----------------------------------------------------------------
+  def expression(self, node):
+    if isinstance(node, ast.Constant):
+      for python_type, cyml_type in ((bool, "bool"), (int, "int"), (float, "float"), (str, "str")):
+        if isinstance(node.value, python_type):
+          return cyml_type
+      raise Unsupported(f"constant {node.value!r}")
+
+    if isinstance(node, ast.Name):
+      return self.type_of(node.id)
+
+    if is_math(node) and node.attr in MATH_CONSTANTS:
+      return "float"
+
+    if isinstance(node, ast.UnaryOp):
+      operand = self.expression(node.operand)
+      if isinstance(node.op, ast.Not):
+        if self.known(operand) and operand != "bool":
+          raise Unsupported("not on a non boolean")
+        return "bool"
+      if isinstance(node.op, (ast.USub, ast.UAdd)) and operand in NUMERIC + (None,):
+        return operand
+      raise Unsupported(ast.dump(node.op))
+
+    if isinstance(node, ast.BinOp):
+      return self.binary(node.op, self.expression(node.left), self.expression(node.right))
+
+    if isinstance(node, ast.BoolOp):
+      for value in node.values:
+        value_type = self.expression(value)
+        if self.known(value_type) and value_type != "bool":
+          raise Unsupported("and/or on a non boolean")
+      return "bool"
+
+    if isinstance(node, ast.Compare):
+      if len(node.ops) != 1 or not isinstance(node.ops[0], COMPARISONS):
+        raise Unsupported("comparison")
+      left, right = self.expression(node.left), self.expression(node.comparators[0])
+      if self.known(left, right) and left != right and not (left in NUMERIC and right in NUMERIC):
+        raise Unsupported(f"{left} compared with {right}")
+      return "bool"
+
+    if isinstance(node, ast.Subscript):
+      # Negative indices count from the end in Python only
+      if isinstance(node.slice, ast.UnaryOp) and isinstance(node.slice.op, ast.USub):
+        raise Unsupported("negative index")
+      container = self.expression(node.value)
+      index = self.expression(node.slice)
+      if not self.known(container, index):
+        return None
+      if container not in ELEMENTS or index != "int":
+        raise Unsupported("subscript")
+      return ELEMENTS[container]
+
+    if isinstance(node, ast.Call):
+      return self.call(node)
+
+    raise Unsupported(type(node).__name__)
+
+  def binary(self, op, left, right):
+    if isinstance(op, (ast.Add, ast.Sub, ast.Mult)):
+      if left not in NUMERIC + (None,) or right not in NUMERIC + (None,):
+        raise Unsupported("arithmetic on a non number")
+      return join(left, right) if self.known(left, right) else None
+    if isinstance(op, (ast.Div, ast.Pow)):
+      if left not in NUMERIC + (None,) or right not in NUMERIC + (None,):
+        raise Unsupported("arithmetic on a non number")
+      # The division and the power of two int differ between Python and the generated languages
+      if left == "int" and right == "int":
+        raise Unsupported("division or power of two int")
+      return "float" if self.known(left, right) else None
+    raise Unsupported(type(op).__name__)
+
+  def call(self, node):
+    if node.keywords or any(isinstance(arg, ast.Starred) for arg in node.args):
+      raise Unsupported("keyword or starred arguments")
+    args = [self.expression(arg) for arg in node.args]
+    func = node.func
+
+    name = func.attr if is_math(func) else func.id if isinstance(func, ast.Name) else None
+    if name in MATH_FUNCTIONS and (is_math(func) or name not in self.signature_of.names):
+      if len(args) != 1 or args[0] not in NUMERIC + (None,):
+        raise Unsupported(f"{name} arguments")
+      return "float"
+    if not isinstance(func, ast.Name):
+      raise Unsupported("method or attribute call")
+
+    if name in self.signature_of.names:
+      parameters, returned = self.signature_of(name)
+      if len(args) != len(parameters) or not all(assignable(p, a) for p, a in zip(parameters, args)):
+        raise Unsupported(f"arguments of {name}")
+      return returned
+    if name == "abs" and len(args) == 1 and args[0] in NUMERIC + (None,):
+      return args[0]
+    if name in ("min", "max") and len(args) >= 2 and all(a in NUMERIC + (None,) for a in args):
+      return None if None in args else "float" if "float" in args else "int"
+    if name == "len" and len(args) == 1 and args[0] in tuple(ELEMENTS) + (None,):
+      return "int"
+    raise Unsupported(f"call to {name}")
+
+  #-----------------------------------------------------------------
+  # Function to walk a block of statements, the CyML lines are added to lines during the last walk
+  #-----------------------------------------------------------------
+  def block(self, statements, lines, depth):
+    statements = [s for s in statements if not isinstance(s, ast.Pass)]
+    if not statements:
+      raise Unsupported("empty block")
+    for statement in statements:
+      self.statement(statement, lines, depth)
+
+  def emit(self, lines, depth, text):
+    if self.strict:
+      lines.append(INDENT * depth + text)
+
+  def statement(self, node, lines, depth):
+    if isinstance(node, ast.Assign):
+      if len(node.targets) != 1:
+        raise Unsupported("chained assignment")
+      self.assignment(node.targets[0], node.value)
+      self.emit(lines, depth, f"{render(node.targets[0])} = {render(node.value)}")
+
+    elif isinstance(node, ast.AnnAssign):
+      if node.value is None or not isinstance(node.target, ast.Name):
+        raise Unsupported("annotated declaration")
+      if node.target.id not in self.fixed:
+        self.assign(node.target.id, annotation_type(node.annotation))
+      self.assignment(node.target, node.value)
+      self.emit(lines, depth, f"{node.target.id} = {render(node.value)}")
+
+    elif isinstance(node, ast.AugAssign):
+      if not isinstance(node.target, (ast.Name, ast.Subscript)):
+        raise Unsupported("augmented assignment")
+      load = copy.deepcopy(node.target)
+      load.ctx = ast.Load()
+      value = ast.BinOp(load, node.op, node.value)
+      self.assignment(node.target, value)
+      self.emit(lines, depth, f"{render(node.target)} = {render(value)}")
+
+    elif isinstance(node, ast.If):
+      self.condition(node.test)
+      self.emit(lines, depth, f"if {render(node.test)}:")
+      self.block(node.body, lines, depth + 1)
+      orelse = [] if all(isinstance(s, ast.Pass) for s in node.orelse) else node.orelse
+      while len(orelse) == 1 and isinstance(orelse[0], ast.If):
+        branch = orelse[0]
+        self.condition(branch.test)
+        self.emit(lines, depth, f"elif {render(branch.test)}:")
+        self.block(branch.body, lines, depth + 1)
+        orelse = [] if all(isinstance(s, ast.Pass) for s in branch.orelse) else branch.orelse
+      if orelse:
+        self.emit(lines, depth, "else:")
+        self.block(orelse, lines, depth + 1)
+
+    elif isinstance(node, ast.For):
+      iterator = node.iter
+      if node.orelse or not isinstance(node.target, ast.Name) or not (isinstance(iterator, ast.Call) and isinstance(iterator.func, ast.Name)
+                                                                       and iterator.func.id == "range" and 1 <= len(iterator.args) <= 3 and not iterator.keywords):
+        raise Unsupported("for loop other than over range")
+      for arg in iterator.args:
+        arg_type = self.expression(arg)
+        if self.known(arg_type) and arg_type != "int":
+          raise Unsupported("range of a non int")
+      self.assign(node.target.id, "int")
+      self.emit(lines, depth, f"for {node.target.id} in {render(iterator)}:")
+      self.block(node.body, lines, depth + 1)
+
+    elif isinstance(node, ast.While):
+      if node.orelse:
+        raise Unsupported("while else")
+      self.condition(node.test)
+      self.emit(lines, depth, f"while {render(node.test)}:")
+      self.block(node.body, lines, depth + 1)
+
+    elif isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant) and isinstance(node.value.value, str):
+      pass
+
+    elif isinstance(node, ast.Expr) and isinstance(node.value, ast.Call) and isinstance(node.value.func, ast.Attribute) \
+         and node.value.func.attr == "append" and isinstance(node.value.func.value, ast.Name) and len(node.value.args) == 1:
+      name = node.value.func.value.id
+      value_type = self.expression(node.value.args[0])
+      container = self.type_of(name)
+      if container is None and value_type is not None:
+        self.assign(name, LISTS.get(value_type))
+      elif container is not None and (container not in ELEMENTS or not assignable(ELEMENTS[container], value_type)):
+        raise Unsupported(f"append to {name}")
+      self.emit(lines, depth, render(node.value))
+
+    else:
+      raise Unsupported(type(node).__name__)
+
+  def condition(self, test):
+    test_type = self.expression(test)
+    if self.known(test_type) and test_type != "bool":
+      raise Unsupported("condition on a non boolean")
+
+  def assignment(self, target, value):
+    if isinstance(target, ast.Name):
+      if isinstance(value, ast.List):
+        elements = None
+        for element in value.elts:
+          elements = join(elements, self.expression(element))
+        if value.elts and self.known(elements) and elements not in LISTS:
+          raise Unsupported("list of non scalars")
+        value_type = LISTS.get(elements)
+      else:
+        value_type = self.expression(value)
+      self.assign(target.id, value_type)
+    elif isinstance(target, ast.Subscript) and isinstance(target.value, ast.Name):
+      element = self.expression(ast.Subscript(target.value, target.slice, ast.Load()))
+      if element is not None and not assignable(element, self.expression(value)):
+        raise Unsupported("assignment to an element")
+    else:
+      raise Unsupported("assignment target")
+
+  #-----------------------------------------------------------------
+  # Function to analyse the whole function, returns its CyML and its return type
+  #-----------------------------------------------------------------
+  def transpile(self):
+    body = self.node.body
+    returns = [n for n in ast.walk(self.node) if isinstance(n, ast.Return)]
+    if not body or not isinstance(body[-1], ast.Return) or len(returns) != 1 or body[-1].value is None:
+      raise Unsupported("a single return at the end of the function is required")
+    returned = body[-1].value
+    if any(isinstance(n, (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda, ast.Global, ast.Nonlocal)) for n in ast.walk(self.node) if n is not self.node):
+      raise Unsupported("nested scope")
+
+    # An expression returned by a supporting function is assigned to a local first, as the agent does
+    statements = body[:-1]
+    if isinstance(returned, ast.Tuple) and self.is_unit and all(isinstance(v, ast.Name) for v in returned.elts):
+      returned_names = [v.id for v in returned.elts]
+    elif isinstance(returned, ast.Name):
+      returned_names = [returned.id]
+    elif not self.is_unit and not isinstance(returned, ast.Tuple):
+      if any(isinstance(n, ast.Name) and n.id == "result" for n in ast.walk(self.node)):
+        raise Unsupported("result already used")
+      statements = statements + [ast.Assign([ast.Name("result", ast.Store())], returned)]
+      returned_names = ["result"]
+    else:
+      raise Unsupported("returned value")
+
+    lines = []
+    for _ in range(MAX_PASSES):
+      before = dict(self.locals)
+      self.block(statements, lines, 1)
+      if self.locals == before:
+        break
+    else:
+      raise Unsupported("types of the locals do not settle")
+
+    self.strict = True
+    self.block(statements, lines, 1)
+    return_types = [self.type_of(name) for name in returned_names]
+    if any(t is None for t in return_types) or any(self.locals[name] is None for name in self.order):
+      raise Unsupported("type of a local")
+
+    parameters = " ".join(f"{self.fixed[a.arg]} {a.arg}," for a in self.node.args.args).rstrip(",")
+    header = [f"def {self.node.name}({parameters}):"]
+    header += [f"{INDENT}cdef {self.locals[name]} {name}" for name in self.order]
+    return "\n".join(header + lines + [f"{INDENT}return {', '.join(returned_names)}"]), return_types
+
+
+#-----------------------------------------------------------------
+# Signatures of the functions of the module, computed on demand so that a function can call one defined after it
+#-----------------------------------------------------------------
+class Signatures:
+  def __init__(self, tree, documented, units):
+    self.nodes = {n.name: n for n in tree.body if isinstance(n, ast.FunctionDef)}
+    self.names = set(self.nodes)
+    self.documented = documented
+    self.units = units
+    self.done = {}
+    self.running = set()
+
+  def __call__(self, name):
+    if name not in self.done:
+      if name in self.running or name in self.units:
+        raise Unsupported(f"call to {name}")
+      self.running.add(name)
+      try:
+        self.done[name] = analyse(self.nodes[name], self, self.documented, False)
+      finally:
+        self.running.discard(name)
+    cyml, parameters, return_types = self.done[name]
+    if len(return_types) != 1:
+      raise Unsupported(f"{name} returns several values")
+    return parameters, return_types[0]
+
+
+def analyse(node, signatures, documented, is_unit):
+  arguments = node.args
+  if arguments.vararg or arguments.kwarg or arguments.kwonlyargs or arguments.posonlyargs:
+    raise Unsupported("variable or keyword only arguments")
+  if arguments.defaults and not is_unit:
+    raise Unsupported("default values")
+  if node.decorator_list:
+    raise Unsupported("decorators")
+
+  fixed = dict(documented) if is_unit else {}
+  for argument in arguments.args:
+    argument_type = annotation_type(argument.annotation) or documented.get(argument.arg)
+    if argument_type is None:
+      raise Unsupported(f"type of the argument {argument.arg}")
+    fixed[argument.arg] = argument_type
+  fixed = {name: t for name, t in fixed.items() if t is not None}
+
+  analysis = FunctionAnalysis(node, fixed, signatures, documented, is_unit)
+  cyml, return_types = analysis.transpile()
+  return cyml, [fixed[a.arg] for a in arguments.args], return_types
+
+
+#-----------------------------------------------------------------
+# Function to check a CyML function with pycropml, as the package verification does
+#-----------------------------------------------------------------
+def validate_cyml(cyml):
+  with tempfile.TemporaryDirectory() as folder:
+    path = os.path.join(folder, "rule_transpiled.pyx")
+    with open(path, 'w', encoding='utf-8') as f:
+      f.write(cyml)
+    try:
+      test = Main(path, 'cs')
+      test.parse()
+      test.to_ast(cyml)
+    except Exception:
+      return False
+  return True
+
+
+#-----------------------------------------------------------------
+# Function to transpile a function of the refactored Python module into CyML without any agent
+# Returns None when the function uses a construct outside of the rules, or when pycropml rejects the result.
+#-----------------------------------------------------------------
+def rule_transpile(python_code, function_name, algo_meta):
+  try:
+    tree = ast.parse(python_code)
+  except SyntaxError:
+    return None
+
+  units = [algo_meta.get('process', {}).get('name')]
+  if algo_meta.get('init', {}) != '-' and algo_meta.get('init', {}) != []:
+    units.append(algo_meta.get('init', {}).get('name'))
+  documented = documented_types(algo_meta)
+  signatures = Signatures(tree, documented, units)
+  if function_name not in signatures.nodes:
+    return None
+
+  try:
+    cyml, _, _ = analyse(signatures.nodes[function_name], signatures, documented, function_name in units)
+  except (Unsupported, RecursionError):
+    return None
+  return cyml if validate_cyml(cyml) else None
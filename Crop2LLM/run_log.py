@@ -0,0 +1,149 @@
+import io
+import atexit
+import queue
+import threading
+from contextlib import contextmanager
+
+#-----------------------------------------------------------------
+# Run log
+# The report and log files are written by one background thread, fed by a queue, which keeps each file open and
+# flushes it once the queue is empty, instead of opening, appending and closing the file for every message.
+# The text written in a log_block is queued as a single message when the block ends, so the section of a unit is never
+# interleaved with the messages of the units processed at the same time. The messages of a file are written in the
+# order their blocks ended. The logs are flushed and closed when the program exits.
+#-----------------------------------------------------------------
+_lock = threading.Lock()
+_state = {"queue": None, "thread": None, "messages": 0, "batches": 0}
+
+
+#-----------------------------------------------------------------
+# Message waited for by its sender, with the error met by the writer when it handled it
+#-----------------------------------------------------------------
+class _Waiter:
+  def __init__(self):
+    self.event = threading.Event()
+    self.error = None
+
+  def wait(self):
+    self.event.wait()
+    if self.error is not None:
+      raise self.error
+
+
+def _write(files, path, text):
+  f = files.get(path)
+  if f is None:
+    f = files[path] = open(path, 'a', encoding='utf-8')
+  f.write(text)
+
+
+def _writer(messages):
+  files = {}
+  running = True
+  while running:
+    batch = [messages.get()]
+    while True:
+      try:
+        batch.append(messages.get_nowait())
+      except queue.Empty:
+        break
+
+    for kind, path, payload in batch:
+      try:
+        if kind == "write":
+          _write(files, path, payload)
+        elif kind == "reset":
+          if path in files:
+            files.pop(path).close()
+          files[path] = open(path, 'w', encoding='utf-8')
+          payload.event.set()
+        elif kind in ("flush", "stop"):
+          running = running and kind != "stop"
+          for f in files.values():
+            f.flush()
+          if kind == "stop":
+            for f in files.values():
+              f.close()
+            files.clear()
+          payload.event.set()
+      except Exception as e:
+        # Any error is reported, the writer keeps running so that the senders never wait for it forever
+        if isinstance(payload, _Waiter):
+          payload.error = e
+          payload.event.set()
+        else:
+          print(f"Cannot write the log {path}: {e}")
+
+    for f in files.values():
+      try:
+        f.flush()
+      except Exception as e:
+        print(f"Cannot write the log {f.name}: {e}")
+    with _lock:
+      _state["batches"] += 1
+
+
+def _put(kind, path, payload=None):
+  with _lock:
+    if _state["thread"] is None:
+      _state["queue"] = queue.Queue()
+      _state["thread"] = threading.Thread(target=_writer, args=(_state["queue"],), name="run-log", daemon=True)
+      _state["thread"].start()
+    if kind == "write":
+      _state["messages"] += 1
+    _state["queue"].put((kind, path, payload))
+
+
+#-----------------------------------------------------------------
+# Function to create or clear a log file, messages queued before it are written first
+# Waits for the file to be created, the error is raised when it cannot be (missing folder, permissions).
+#-----------------------------------------------------------------
+def reset_log(path):
+  done = _Waiter()
+  _put("reset", str(path), done)
+  done.wait()
+
+
+#-----------------------------------------------------------------
+# Function to write a block of text in a log, used as open(path, 'a')
+# The text is queued as one message when the block ends, also when it ends with an error.
+#-----------------------------------------------------------------
+@contextmanager
+def log_block(path):
+  buffer = io.StringIO()
+  try:
+    yield buffer
+  finally:
+    text = buffer.getvalue()
+    if text:
+      _put("write", str(path), text)
+
+
+#-----------------------------------------------------------------
+# Function to wait until every message queued is written in its file, before reading or copying a log
+#-----------------------------------------------------------------
+def flush_logs():
+  done = _Waiter()
+  _put("flush", None, done)
+  done.wait()
+
+
+#-----------------------------------------------------------------
+# Function to write the messages left and close the logs, called when the program exits
+#-----------------------------------------------------------------
+def close_logs():
+  with _lock:
+    thread, messages = _state["thread"], _state["queue"]
+    _state["thread"] = _state["queue"] = None
+  if thread is None:
+    return
+  messages.put(("stop", None, _Waiter()))
+  thread.join()
+
+
+def log_stats():
+  with _lock:
+    return {"messages": _state["messages"], "batches": _state["batches"]}
+
+
+atexit.register(close_logs)
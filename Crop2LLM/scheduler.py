@@ -0,0 +1,229 @@
+import time
+import heapq
+import random
+import asyncio
+import itertools
+import threading
+import openai
+
+#-----------------------------------------------------------------
+# Scheduler of the requests sent to OpenAI's API
+# Each model has two token buckets, one for the requests and one for the tokens per minute. A request waits until
+# both buckets of its model have enough budget, the waiting requests of a model being served by priority lane then
+# in arrival order, so the calls of the repair loops go before the bulk generation of candidates.
+# Throttled (429), failed (5xx) and dropped requests are retried with a jittered exponential backoff.
+#-----------------------------------------------------------------
+PRIORITY_REPAIR = 0
+PRIORITY_BULK = 1
+
+_lock = threading.Lock()
+_condition = threading.Condition(_lock)
+_tickets = itertools.count()
+_state = {
+  "limits": {},
+  "buckets": {},
+  "waiting": {},
+  "blocked_until": {},
+  "max_retries": 6,
+  "base_delay": 1.0,
+  "max_delay": 60.0,
+}
+
+
+#-----------------------------------------------------------------
+# Bucket refilled continuously at rate_per_minute, holding at most one minute of budget
+# The budget may go negative when a request used more tokens than estimated, the next requests then wait for it to refill.
+#-----------------------------------------------------------------
+class TokenBucket:
+
+  def __init__(self, rate_per_minute):
+    self.rate = rate_per_minute / 60.0
+    self.capacity = rate_per_minute
+    self.level = rate_per_minute
+    self.updated = time.monotonic()
+
+  def refill(self, now):
+    self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+    self.updated = now
+
+  #-----------------------------------------------------------------
+  # Function to get the time to wait before amount can be taken, 0 when it can be taken now
+  # A request bigger than the capacity only waits for a full bucket.
+  #-----------------------------------------------------------------
+  def delay(self, amount, now):
+    self.refill(now)
+    missing = min(amount, self.capacity) - self.level
+    return 0 if missing <= 0 else missing / self.rate
+
+  def take(self, amount):
+    self.level -= amount
+
+
+#-----------------------------------------------------------------
+# Function to set the budgets per model, limits maps a model to (requests per minute, tokens per minute)
+# Models without limits are not throttled by the scheduler, only retried.
+#-----------------------------------------------------------------
+def configure_rate_limits(limits, max_retries=6, base_delay=1.0, max_delay=60.0):
+  with _lock:
+    _state["limits"] = dict(limits)
+    _state["buckets"] = {}
+    _state["blocked_until"] = {}
+    _state["max_retries"] = max_retries
+    _state["base_delay"] = base_delay
+    _state["max_delay"] = max_delay
+
+
+def _buckets(model):
+  buckets = _state["buckets"].get(model)
+  if buckets is None and model in _state["limits"]:
+    rpm, tpm = _state["limits"][model]
+    buckets = (TokenBucket(rpm), TokenBucket(tpm))
+    _state["buckets"][model] = buckets
+  return buckets
+
+
+#-----------------------------------------------------------------
+# Function to try to take the budget of a request, must be called with the lock held
+# Returns 0 when the budget was taken, else the time to wait before trying again (None to wait for a notification).
+#-----------------------------------------------------------------
+def _try_take(model, tokens, ticket):
+  waiting = _state["waiting"][model]
+  if waiting[0] != ticket:
+    return None
+  now = time.monotonic()
+  delay = _state["blocked_until"].get(model, 0) - now
+  buckets = _buckets(model)
+  if buckets is not None:
+    delay = max(delay, buckets[0].delay(1, now), buckets[1].delay(tokens, now))
+  if delay > 0:
+    return delay
+  if buckets is not None:
+    buckets[0].take(1)
+    buckets[1].take(tokens)
+  return 0
+
+
+def _enter(model, priority):
+  ticket = (priority, next(_tickets))
+  heapq.heappush(_state["waiting"].setdefault(model, []), ticket)
+  return ticket
+
+
+def _leave(model, ticket):
+  waiting = _state["waiting"][model]
+  waiting.remove(ticket)
+  heapq.heapify(waiting)
+  _condition.notify_all()
+
+
+#-----------------------------------------------------------------
+# Function to wait for the budget of a request of about tokens tokens
+#-----------------------------------------------------------------
+def acquire(model, tokens, priority=PRIORITY_BULK):
+  with _condition:
+    ticket = _enter(model, priority)
+    try:
+      while True:
+        delay = _try_take(model, tokens, ticket)
+        if delay == 0:
+          return
+        _condition.wait(delay)
+    finally:
+      _leave(model, ticket)
+
+
+#-----------------------------------------------------------------
+# Asynchronous version of acquire, the event loop is not blocked while waiting
+#-----------------------------------------------------------------
+async def acquire_async(model, tokens, priority=PRIORITY_BULK):
+  with _condition:
+    ticket = _enter(model, priority)
+  try:
+    while True:
+      with _condition:
+        delay = _try_take(model, tokens, ticket)
+      if delay == 0:
+        return
+      await asyncio.sleep(0.05 if delay is None else delay)
+  finally:
+    with _condition:
+      _leave(model, ticket)
+
+
+#-----------------------------------------------------------------
+# Function to correct the tokens budget once the real usage of a request is known
+#-----------------------------------------------------------------
+def settle(model, estimated_tokens, used_tokens):
+  with _condition:
+    buckets = _buckets(model)
+    if buckets is not None:
+      buckets[1].take(used_tokens - estimated_tokens)
+      _condition.notify_all()
+
+
+#-----------------------------------------------------------------
+# Function to tell if an error of the API is worth retrying, and after how long the server asked to wait
+#-----------------------------------------------------------------
+def retry_after(error):
+  if isinstance(error, openai.APIStatusError):
+    retry = error.status_code in (408, 409, 429) or error.status_code >= 500
+  else:
+    retry = isinstance(error, openai.APIConnectionError)
+  if not retry:
+    return False, None
+
+  response = getattr(error, "response", None)
+  header = response.headers.get("retry-after") if response is not None else None
+  try:
+    return True, float(header) if header is not None else None
+  except ValueError:
+    return True, None
+
+
+#-----------------------------------------------------------------
+# Function to get the delay before the next attempt : exponential backoff with full jitter, or the delay asked by the server
+# A throttled model is blocked for everyone until the delay asked by the server is over.
+#-----------------------------------------------------------------
+def backoff_delay(model, attempt, server_delay):
+  if server_delay is not None:
+    delay = min(server_delay, _state["max_delay"])
+    with _condition:
+      _state["blocked_until"][model] = max(_state["blocked_until"].get(model, 0), time.monotonic() + delay)
+    return delay
+  return random.uniform(0, min(_state["max_delay"], _state["base_delay"] * 2 ** attempt))
+
+
+#-----------------------------------------------------------------
+# Function to send a request through the scheduler
+# call sends the request and returns the raw response, it is called again on each retry.
+# Returns the raw response and the number of retries.
+#-----------------------------------------------------------------
+def schedule(call, model, tokens, priority=PRIORITY_BULK):
+  attempt = 0
+  while True:
+    acquire(model, tokens, priority)
+    try:
+      return call(), attempt
+    except Exception as e:
+      retry, server_delay = retry_after(e)
+      if not retry or attempt >= _state["max_retries"]:
+        raise
+      time.sleep(backoff_delay(model, attempt, server_delay))
+      attempt += 1
+
+
+#-----------------------------------------------------------------
+# Asynchronous version of schedule, call returns a coroutine
+#-----------------------------------------------------------------
+async def schedule_async(call, model, tokens, priority=PRIORITY_BULK):
+  attempt = 0
+  while True:
+    await acquire_async(model, tokens, priority)
+    try:
+      return await call(), attempt
+    except Exception as e:
+      retry, server_delay = retry_after(e)
+      if not retry or attempt >= _state["max_retries"]:
+        raise
+      await asyncio.sleep(backoff_delay(model, attempt, server_delay))
+      attempt += 1
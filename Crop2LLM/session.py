@@ -0,0 +1,122 @@
+import os
+import hashlib
+from path import Path
+from pycropml.pparse import model_parser
+from pycropml.topology import Topology
+
+#-----------------------------------------------------------------
+# Session over a Crop2ML package, shared by the repair loops of the --package path
+# The parsed models, the topology and the pyx sources are cached and only rebuilt when the files they come from change.
+# A file is considered changed when its mtime or size changes and its content hash differs from the cached one.
+#-----------------------------------------------------------------
+class PackageSession:
+
+  def __init__(self, model_package):
+    self.package = model_package
+    self.name = model_package.split(os.path.sep)[-1]
+    self.crop2ml_folder = os.path.join(model_package, 'crop2ml')
+    self._signatures = {}
+    self._units = {}
+    self._model_digests = {}
+    self._verdicts = {}
+    self._topology = None
+    self._topology_key = None
+    self._sources = {}
+
+  #-----------------------------------------------------------------
+  # Function to get the signature of a file, (mtime, size, content hash)
+  # The content is only hashed again when the mtime or the size changed.
+  #-----------------------------------------------------------------
+  def signature(self, file_path):
+    stat = os.stat(file_path)
+    cached = self._signatures.get(file_path)
+    if cached is not None and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+      return cached
+    with open(file_path, 'rb') as f:
+      digest = hashlib.sha256(f.read()).hexdigest()
+    signature = (stat.st_mtime_ns, stat.st_size, digest)
+    self._signatures[file_path] = signature
+    return signature
+
+  #-----------------------------------------------------------------
+  # Function to list the XML files of the model units
+  #-----------------------------------------------------------------
+  def unit_files(self):
+    return sorted(os.path.join(self.crop2ml_folder, f) for f in os.listdir(self.crop2ml_folder)
+                  if f.startswith("unit") and f.endswith(".xml"))
+
+  #-----------------------------------------------------------------
+  # Function to get the models of the package
+  # Only the XML files changed since the last call are parsed again.
+  #-----------------------------------------------------------------
+  def models(self):
+    unit_files = self.unit_files()
+    for removed in set(self._units) - set(unit_files):
+      del self._units[removed]
+
+    models = []
+    for unit_file in unit_files:
+      digest = self.signature(unit_file)[2]
+      cached = self._units.get(unit_file)
+      if cached is None or cached[0] != digest:
+        cached = (digest, model_parser(Path(unit_file)))
+        self._units[unit_file] = cached
+      for model in cached[1]:
+        self._model_digests[id(model)] = digest
+      models.extend(cached[1])
+    return models
+
+  #-----------------------------------------------------------------
+  # Function to get the content hash of the XML file a model was parsed from
+  #-----------------------------------------------------------------
+  def model_digest(self, model):
+    return self._model_digests.get(id(model))
+
+  #-----------------------------------------------------------------
+  # Function to get the topology of the composite model
+  # The topology is built again only when one of the XML files of the package changed.
+  #-----------------------------------------------------------------
+  def topology(self):
+    xml_files = sorted(os.path.join(self.crop2ml_folder, f) for f in os.listdir(self.crop2ml_folder) if f.endswith(".xml"))
+    key = tuple((xml_file, self.signature(xml_file)[2]) for xml_file in xml_files)
+    if self._topology is None or self._topology_key != key:
+      self._topology = Topology(self.name, self.package)
+      self._topology_key = key
+    return self._topology
+
+  #-----------------------------------------------------------------
+  # Function to get the content of a source file of the package
+  #-----------------------------------------------------------------
+  def source(self, file_path):
+    digest = self.signature(file_path)[2]
+    cached = self._sources.get(file_path)
+    if cached is None or cached[0] != digest:
+      with open(file_path, 'r') as fi:
+        cached = (digest, fi.read())
+      self._sources[file_path] = cached
+    return cached[1]
+
+  #-----------------------------------------------------------------
+  # Functions to keep the last verdict of the verification of a file
+  # The key identifies everything the verdict depends on, a verdict recorded with another key is ignored.
+  #-----------------------------------------------------------------
+  def verdict(self, file_path, key):
+    cached = self._verdicts.get(file_path)
+    if cached is None or cached[0] != key:
+      return None
+    return cached[1]
+
+  def record_verdict(self, file_path, key, verdict):
+    self._verdicts[file_path] = (key, verdict)
+
+  #-----------------------------------------------------------------
+  # Function to forget a file rewritten by the repair agents
+  # Its signature is computed again on next access, even if the rewrite kept the same mtime and size.
+  #-----------------------------------------------------------------
+  def invalidate(self, file_path):
+    self._signatures.pop(file_path, None)
+    self._sources.pop(file_path, None)
+    self._units.pop(file_path, None)
+    self._verdicts.pop(file_path, None)
+    if file_path.endswith(".xml"):
+      self._topology = None
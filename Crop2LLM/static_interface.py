@@ -0,0 +1,287 @@
+import os
+import re
+import ast
+from utilities import extract_text
+
+#-----------------------------------------------------------------
+# Static extraction of the interface of a unit
+# The algo metadata of a unit (init, process, supporting functions, inputs, outputs) is drafted without any agent :
+# - from the refactored Python module, with the ast : the functions, the parameters of init and process with their
+#   annotations and defaults, the names returned by process ;
+# - from the documentation of the original sources : the CyML description blocks of the models already generated by
+#   Crop2ML, in any language, and the VarInfo of the BioMA and SiriusQuality domain classes.
+# The fields that cannot be found are marked UNRESOLVED, the agent only completes them.
+#-----------------------------------------------------------------
+UNRESOLVED = "?"
+INIT_NAMES = re.compile(r"^(init|initiali[sz]e|reset|setup)", re.IGNORECASE)
+TEST_NAMES = re.compile(r"^test", re.IGNORECASE)
+ANNOTATION_TYPES = {"int": "INT", "float": "DOUBLE", "str": "STRING", "date": "DATE", "datetime": "DATE",
+                    "datetime.date": "DATE", "datetime.datetime": "DATE"}
+# Fields of an input or an output that must be known to skip the agent, the others are "-" when not documented
+REQUIRED_INPUT_FIELDS = ("description", "inputtype", "category", "datatype")
+REQUIRED_OUTPUT_FIELDS = ("description", "datatype")
+INPUT_FIELDS = ("description", "inputtype", "category", "datatype", "len", "min", "max", "default", "unit", "uri")
+OUTPUT_FIELDS = ("description", "datatype", "category", "len", "min", "max", "default", "unit", "uri")
+
+CYML_NAME = re.compile(r"^\*\s*name\s*:\s*(\S+)")
+CYML_FIELD = re.compile(r"^\*\*\s*(\w+)\s*:\s*(.*)$")
+CYML_MODEL_FIELD = re.compile(r"^\*\s*(Abstract|ExtendedDescription|ShortDescription)\s*:\s*(.*)$", re.IGNORECASE)
+VARINFO_FIELD = re.compile(r"\b(\w+)\.(Name|Description|MaxValue|MinValue|DefaultValue|Units|URL)\s*=\s*(.+?)\s*;")
+VARINFO_FIELDS = {"Description": "description", "MaxValue": "max", "MinValue": "min", "DefaultValue": "default", "Units": "unit", "URL": "uri"}
+VARINFO_CATEGORIES = (("Exogenous", "exogenous"), ("Auxiliary", "auxiliary"), ("Rate", "rate"), ("State", "state"))
+
+
+#-----------------------------------------------------------------
+# Function to get the Crop2ML datatype of a Python annotation, None for the collections whose length is not known
+#-----------------------------------------------------------------
+def annotation_type(annotation):
+  if annotation is None:
+    return None
+  text = ast.unparse(annotation).strip("'\"")
+  return ANNOTATION_TYPES.get(text)
+
+
+def literal(node):
+  try:
+    value = ast.literal_eval(node)
+  except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError):
+    return None
+  return str(value) if isinstance(value, (int, float, str)) and not isinstance(value, bool) else None
+
+
+def docstring(function):
+  text = ast.get_docstring(function)
+  return text.strip().split("\n")[0].strip() if text else None
+
+
+def returned_names(function):
+  names = None
+  for node in ast.walk(function):
+    if isinstance(node, ast.Return) and node.value is not None:
+      values = node.value.elts if isinstance(node.value, ast.Tuple) else [node.value]
+      if not all(isinstance(v, ast.Name) for v in values):
+        return None
+      current = [v.id for v in values]
+      if names is not None and current != names:
+        return None
+      names = current
+  return names
+
+
+#-----------------------------------------------------------------
+# Function to get the functions, the inputs and the outputs of the refactored Python module
+# Returns None when the module does not parse.
+#-----------------------------------------------------------------
+def python_interface(python_code):
+  try:
+    tree = ast.parse(python_code)
+  except SyntaxError:
+    return None
+
+  functions = [node for node in tree.body if isinstance(node, ast.FunctionDef)]
+  tests = [f for f in functions if TEST_NAMES.match(f.name)]
+  inits = [f for f in functions if INIT_NAMES.match(f.name) and f not in tests]
+  others = [f for f in functions if f not in tests and f not in inits]
+
+  # The process is the only function that the other ones do not call
+  names = {f.name for f in others}
+  called = set()
+  for f in others + inits:
+    for node in ast.walk(f):
+      if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in names and node.func.id != f.name:
+        called.add(node.func.id)
+  roots = [f for f in others if f.name not in called]
+
+  init = inits[0] if len(inits) == 1 else None
+  process = roots[0] if len(roots) == 1 else None
+
+  inputs = {}
+  for f in [init, process]:
+    if f is None:
+      continue
+    arguments = f.args.posonlyargs + f.args.args + f.args.kwonlyargs
+    defaults = [None] * (len(f.args.posonlyargs + f.args.args) - len(f.args.defaults)) + list(f.args.defaults) + list(f.args.kw_defaults)
+    for argument, default in zip(arguments, defaults):
+      inputs.setdefault(argument.arg, {"datatype": annotation_type(argument.annotation), "default": literal(default) if default is not None else None})
+
+  outputs = {}
+  if process is not None:
+    local_types = {node.target.id: annotation_type(node.annotation) for node in ast.walk(process)
+                   if isinstance(node, ast.AnnAssign) and isinstance(node.target, ast.Name)}
+    returns = process.returns
+    return_types = [annotation_type(e) for e in returns.slice.elts] if isinstance(returns, ast.Subscript) and isinstance(returns.slice, ast.Tuple) else []
+    for i, name in enumerate(returned_names(process) or []):
+      datatype = inputs.get(name, {}).get("datatype") or local_types.get(name) or (return_types[i] if i < len(return_types) else None)
+      outputs[name] = {"datatype": datatype}
+
+  return {
+    "init": init,
+    "process": process,
+    "functions": [f for f in others if f is not process],
+    "tests": tests,
+    "inputs": inputs,
+    "outputs": outputs,
+    "returns_known": process is not None and returned_names(process) is not None,
+  }
+
+
+#-----------------------------------------------------------------
+# Function to strip the comment markers of the lines of a CyML description block
+#-----------------------------------------------------------------
+def comment_text(line):
+  line = line.strip()
+  for marker in ("//", "/*", "*/", "!", "#", "'"):
+    if line.startswith(marker) and not line.startswith("**") and not line.startswith("* "):
+      line = line[len(marker):].strip()
+  return line
+
+
+#-----------------------------------------------------------------
+# Function to get the documentation of the variables of the original sources
+# Returns the fields of each variable by name, and the description of the model when a CyML block gives one.
+#-----------------------------------------------------------------
+def source_documentation(source_files):
+  variables = {}
+  model = {}
+  for source_file in source_files:
+    try:
+      text = extract_text(source_file)
+    except Exception:
+      continue
+
+    # CyML description blocks, written in the comments of the models generated by Crop2ML
+    for block in re.findall(r"CyML Description Begin(.*?)CyML Description End", text, re.DOTALL):
+      section, current = None, None
+      for line in block.splitlines():
+        line = comment_text(line)
+        if re.match(r"^-\s*inputs\s*:", line, re.IGNORECASE):
+          section = "inputs"
+        elif re.match(r"^-\s*outputs\s*:", line, re.IGNORECASE):
+          section = "outputs"
+        elif CYML_MODEL_FIELD.match(line) and section is None:
+          key, value = CYML_MODEL_FIELD.match(line).groups()
+          model.setdefault(key.lower(), value.strip())
+        elif CYML_NAME.match(line) and section is not None:
+          current = variables.setdefault(CYML_NAME.match(line).group(1), {})
+        elif CYML_FIELD.match(line) and current is not None:
+          key, value = CYML_FIELD.match(line).groups()
+          key = "category" if key.lower() in ("variablecategory", "parametercategory") else key.lower()
+          if value.strip() and key not in current:
+            current[key] = value.strip()
+
+    # VarInfo of the domain classes, their category is the one of their class
+    owners = {}
+    for owner, field, value in VARINFO_FIELD.findall(text):
+      value = value.strip().strip('"').strip()
+      if re.fullmatch(r"-?[\d.]+(e-?\d+)?[DdFfMm]?", value):
+        value = value.rstrip("DdFfMm")
+      owners.setdefault(owner, {})[field] = value
+    class_name = os.path.splitext(os.path.basename(source_file))[0]
+    category = next((c for key, c in VARINFO_CATEGORIES if class_name.endswith(f"{key}VarInfo")), None)
+    for owner, fields in owners.items():
+      name = fields.get("Name") or re.sub(r"VarInfo$", "", owner).lstrip("_")
+      documentation = variables.setdefault(name, {})
+      for field, key in VARINFO_FIELDS.items():
+        if fields.get(field) and key not in documentation:
+          documentation[key] = fields[field]
+      if category is not None:
+        documentation.setdefault("inputtype", "variable")
+        documentation.setdefault("category", category)
+  return variables, model
+
+
+#-----------------------------------------------------------------
+# Function to fill the fields of an input or an output from its documentation
+# Returns the entry and the required fields that are still unresolved.
+#-----------------------------------------------------------------
+def interface_entry(name, found, documentation, fields, required):
+  entry = {"name": name}
+  for field in fields:
+    value = documentation.get(field)
+    if value is None or value == "":
+      value = found.get(field)
+    entry[field] = UNRESOLVED if value is None and field in required else (value if value is not None else "-")
+  if "ARRAY" in str(entry["datatype"]).upper() and entry.get("len") in (None, "-"):
+    entry["len"] = UNRESOLVED
+  return entry, [field for field in fields if entry[field] == UNRESOLVED]
+
+
+#-----------------------------------------------------------------
+# Function to draft the algo metadata of a unit
+# Returns the draft, in the format of Agent-AlgoMeta, and the list of its unresolved fields, as "inputs.name.field".
+# The draft is None when the refactored module does not parse.
+#-----------------------------------------------------------------
+def extract_interface(python_code, source_files=()):
+  interface = python_interface(python_code)
+  if interface is None:
+    return None, ["python"]
+  variables, model = source_documentation(source_files)
+  unresolved = []
+
+  init, process = interface["init"], interface["process"]
+  draft = {"init": {"name": init.name} if init is not None else "-"}
+  if process is None:
+    draft["process"] = {"name": UNRESOLVED, "description": UNRESOLVED}
+    unresolved.append("process")
+  else:
+    description = docstring(process) or model.get("abstract") or model.get("shortdescription") or model.get("extendeddescription")
+    draft["process"] = {"name": process.name, "description": description or UNRESOLVED}
+    if description is None:
+      unresolved.append("process.description")
+
+  draft["inputs"] = []
+  for name, found in interface["inputs"].items():
+    entry, missing = interface_entry(name, found, variables.get(name, {}), INPUT_FIELDS, REQUIRED_INPUT_FIELDS)
+    draft["inputs"].append(entry)
+    unresolved += [f"inputs.{name}.{field}" for field in missing]
+
+  draft["outputs"] = []
+  for name, found in interface["outputs"].items():
+    entry, missing = interface_entry(name, dict(found, category="state"), dict(variables.get(name, {}), category="state"), OUTPUT_FIELDS, REQUIRED_OUTPUT_FIELDS)
+    draft["outputs"].append(entry)
+    unresolved += [f"outputs.{name}.{field}" for field in missing]
+  if not interface["returns_known"]:
+    unresolved.append("outputs")
+
+  draft["functions"] = [{"name": f.name, "description": docstring(f) or "-"} for f in interface["functions"]] or "-"
+  draft["tests"] = [{"name": f.name, "description": docstring(f) or "-", "inputs": [], "outputs": []} for f in interface["tests"]] or "-"
+  draft["comments"] = [{"comment": "Functions, inputs and outputs extracted statically from the code and the documentation of the original sources."}]
+  return draft, unresolved
+
+
+#-----------------------------------------------------------------
+# Function to merge the answer of Agent-AlgoMeta into the draft
+# The entries of the answer replace the ones of the draft with the same name, the others are added, the fields still
+# unresolved become "-".
+#-----------------------------------------------------------------
+def merge_interface(draft, answer):
+  merged = dict(draft)
+  for key in ("init", "process"):
+    if isinstance(answer.get(key), dict) or answer.get(key) == "-":
+      merged[key] = answer[key]
+  for key in ("inputs", "outputs", "functions", "tests"):
+    entries = answer.get(key)
+    if not isinstance(entries, list):
+      continue
+    current = merged[key] if isinstance(merged[key], list) else []
+    by_name = {entry.get("name"): i for i, entry in enumerate(current)}
+    current = list(current)
+    for entry in entries:
+      if not isinstance(entry, dict) or entry.get("name") in (None, "-"):
+        continue
+      if entry["name"] in by_name:
+        current[by_name[entry["name"]]] = dict(current[by_name[entry["name"]]], **entry)
+      else:
+        current.append(entry)
+    merged[key] = current or "-"
+  merged["comments"] = list(draft.get("comments", [])) + [c for c in answer.get("comments", []) if isinstance(c, dict)]
+
+  for key in ("inputs", "outputs"):
+    for entry in merged[key] if isinstance(merged[key], list) else []:
+      for field, value in entry.items():
+        if value == UNRESOLVED:
+          entry[field] = "-"
+  for key in ("init", "process"):
+    if isinstance(merged[key], dict):
+      merged[key] = {field: "-" if value == UNRESOLVED else value for field, value in merged[key].items()}
+  return merged
@@ -0,0 +1,170 @@
+import os
+import json
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+
+#-----------------------------------------------------------------
+# Telemetry of the agent calls
+# Every call of send_to_gpt is recorded with the agent, the model, the reasoning effort, the size of the prompt,
+# the tokens used, the latency and the retries of the client. Records are appended to a JSONL trace as they arrive
+# and aggregated per unit and phase at the end of the run.
+# The unit and the phase are taken from the context of the call, set with telemetry_scope.
+#-----------------------------------------------------------------
+_lock = threading.Lock()
+_state = {"trace_path": None, "records": []}
+_unit = contextvars.ContextVar("telemetry_unit", default="-")
+_phase = contextvars.ContextVar("telemetry_phase", default="-")
+
+
+#-----------------------------------------------------------------
+# Function to set the JSONL trace file, the trace is started again from an empty file
+#-----------------------------------------------------------------
+def configure_telemetry(trace_path):
+  with _lock:
+    _state["trace_path"] = trace_path
+    _state["records"] = []
+    if trace_path is not None:
+      os.makedirs(os.path.dirname(os.path.abspath(trace_path)), exist_ok=True)
+      open(trace_path, 'w').close()
+
+
+#-----------------------------------------------------------------
+# Function to get the name of an agent from its instruction file, config/Agents/Agent-UnitMeta.txt gives UnitMeta
+#-----------------------------------------------------------------
+def agent_name(agent_path):
+  name = os.path.splitext(os.path.basename(agent_path))[0]
+  if name.startswith("Agent-"):
+    name = name[len("Agent-"):]
+  return name
+
+
+#-----------------------------------------------------------------
+# Context manager setting the unit and/or the phase of the calls made inside it
+# Thread pools must run their tasks in a copy of the context (contextvars.copy_context().run) to inherit it,
+# asyncio tasks inherit it when they are created.
+#-----------------------------------------------------------------
+@contextmanager
+def telemetry_scope(unit=None, phase=None):
+  tokens = []
+  if unit is not None:
+    tokens.append((_unit, _unit.set(unit)))
+  if phase is not None:
+    tokens.append((_phase, _phase.set(phase)))
+  try:
+    yield
+  finally:
+    for var, token in reversed(tokens):
+      var.reset(token)
+
+
+#-----------------------------------------------------------------
+# Function to await a coroutine inside a telemetry scope, for the coroutines given to asyncio.gather
+#-----------------------------------------------------------------
+async def scoped(coro, unit=None, phase=None):
+  with telemetry_scope(unit, phase):
+    return await coro
+
+
+#-----------------------------------------------------------------
+# Function to read the tokens from the usage of a response, missing fields count as 0
+#-----------------------------------------------------------------
+def usage_tokens(usage):
+  if usage is None:
+    return 0, 0, 0
+  input_tokens = getattr(usage, "input_tokens", 0) or 0
+  output_tokens = getattr(usage, "output_tokens", 0) or 0
+  details = getattr(usage, "output_tokens_details", None)
+  reasoning_tokens = getattr(details, "reasoning_tokens", 0) or 0
+  return input_tokens, output_tokens, reasoning_tokens
+
+
+#-----------------------------------------------------------------
+# Function to record an agent call
+# cached is True when the response came from the response cache, no request was sent.
+#-----------------------------------------------------------------
+def record_call(agent, model, reasoning_effort, prompt_chars, usage, latency, retries=0, cached=False):
+  input_tokens, output_tokens, reasoning_tokens = usage_tokens(usage)
+  record = {
+    "time": time.time(),
+    "unit": _unit.get(),
+    "phase": _phase.get(),
+    "agent": agent or "-",
+    "model": model,
+    "reasoning_effort": reasoning_effort,
+    "prompt_chars": prompt_chars,
+    "input_tokens": input_tokens,
+    "output_tokens": output_tokens,
+    "reasoning_tokens": reasoning_tokens,
+    "latency": round(latency, 3),
+    "retries": retries,
+    "cached": cached,
+  }
+  with _lock:
+    _state["records"].append(record)
+    if _state["trace_path"] is not None:
+      with open(_state["trace_path"], 'a', encoding='utf-8') as f:
+        f.write(json.dumps(record) + "\n")
+  return record
+
+
+#-----------------------------------------------------------------
+# Function to get the records of the calls since the telemetry was configured
+#-----------------------------------------------------------------
+def call_records():
+  with _lock:
+    return list(_state["records"])
+
+
+#-----------------------------------------------------------------
+# Function to aggregate the records, all of them or the ones given, per (unit, phase) by default
+#-----------------------------------------------------------------
+def summarize(keys=("unit", "phase"), records=None):
+  if records is None:
+    records = call_records()
+
+  summary = {}
+  for record in records:
+    key = tuple(record[k] for k in keys)
+    row = summary.setdefault(key, {"calls": 0, "cached": 0, "retries": 0, "input_tokens": 0,
+                                   "output_tokens": 0, "reasoning_tokens": 0, "latency": 0.0})
+    row["calls"] += 1
+    row["cached"] += int(record["cached"])
+    row["retries"] += record["retries"]
+    row["input_tokens"] += record["input_tokens"]
+    row["output_tokens"] += record["output_tokens"]
+    row["reasoning_tokens"] += record["reasoning_tokens"]
+    row["latency"] += record["latency"]
+  return summary
+
+
+#-----------------------------------------------------------------
+# Function to format the summary as a table, the rows are sorted by cumulated latency
+# Latencies of concurrent calls add up, so the column is the time spent waiting for the agents, not the wall-clock.
+#-----------------------------------------------------------------
+def summary_table(keys=("unit", "phase")):
+  summary = summarize(keys)
+  if not summary:
+    return "No agent call recorded."
+
+  widths = [max([len(k)] + [len(str(key[i])) for key in summary]) for i, k in enumerate(keys)]
+  header = "  ".join(k.ljust(w) for k, w in zip(keys, widths))
+  header += f"  {'calls':>5}  {'cached':>6}  {'retries':>7}  {'input':>9}  {'output':>9}  {'reasoning':>9}  {'latency (s)':>11}"
+  lines = [header, "-" * len(header)]
+  totals = {"calls": 0, "cached": 0, "retries": 0, "input_tokens": 0, "output_tokens": 0, "reasoning_tokens": 0, "latency": 0.0}
+
+  for key, row in sorted(summary.items(), key=lambda item: -item[1]["latency"]):
+    line = "  ".join(str(k).ljust(w) for k, w in zip(key, widths))
+    line += (f"  {row['calls']:>5}  {row['cached']:>6}  {row['retries']:>7}  {row['input_tokens']:>9}"
+             f"  {row['output_tokens']:>9}  {row['reasoning_tokens']:>9}  {row['latency']:>11.1f}")
+    lines.append(line)
+    for k in totals:
+      totals[k] += row[k]
+
+  line = "  ".join(("total" if i == 0 else "").ljust(w) for i, w in enumerate(widths))
+  line += (f"  {totals['calls']:>5}  {totals['cached']:>6}  {totals['retries']:>7}  {totals['input_tokens']:>9}"
+           f"  {totals['output_tokens']:>9}  {totals['reasoning_tokens']:>9}  {totals['latency']:>11.1f}")
+  lines.append("-" * len(header))
+  lines.append(line)
+  return "\n".join(lines)
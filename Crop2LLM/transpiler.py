@@ -1,6 +1,11 @@
 import os
 import ast
-from openAI_interaction import create_cyml_code
+import asyncio
+import contextvars
+import concurrent.futures
+from openAI_interaction import create_cyml_code, create_cyml_code_async
+from rule_transpiler import rule_transpile
+from telemetry import agent_name
 
 #-----------------------------------------------------------------
 # Function to dedent code by one level
@@ -40,29 +45,28 @@ def format(code, algo_meta, desc_meta):
   for input in algo_meta.get('inputs', []):
     if input.get('name', '') != '-' :
       for line in code.splitlines():
-        if line.strip().startswith("cdef") and line.strip().endswith(input['name']):
+        if line.strip().startswith("cdef") and line.split()[-1] == input['name']:
           code = code.replace(line + '\n', '').replace(line, '')
 
   for output in algo_meta.get('outputs', []):
     if output.get('name', '') != '-' :
       for line in code.splitlines():
-        if line.strip().startswith("cdef") and line.strip().endswith(output['name']):
+        if line.strip().startswith("cdef") and line.split()[-1] == output['name']:
           code = code.replace(line + '\n', '').replace(line, '')
   return code
 
 
 #-----------------------------------------------------------------
-# Function to extract functions from a Python code string and transpile each to a separate file
-# This function parses the Python code string, detects each function definition, and transpiles them in a new file containing only that function.
+# Function to extract the functions to transpile from a Python code string
+# This function parses the Python code string and returns the name and source of each function documented in the algo metadata.
 #-----------------------------------------------------------------
-def transpile_functions(python_code, algo_meta, desc_meta, api_key_path, model, agent_cymltranspile, output_folder):
+def functions_to_transpile(python_code, algo_meta):
   try:
     tree = ast.parse(python_code)
   except SyntaxError as e:
     print(f"Syntax error in code: {e}")
-    return
-  
-  functions_transpiled = []
+    return None
+
   functions = []
   functions.append(algo_meta.get('process', {}).get('name'))
   if algo_meta.get('init', {}) != '-' and algo_meta.get('init', {}) != []:
@@ -71,6 +75,7 @@ def transpile_functions(python_code, algo_meta, desc_meta, api_key_path, model,
     for func in algo_meta.get('functions', {}):
       functions.append(func.get('name'))
 
+  selected = []
   lines = python_code.splitlines()
   for node in ast.walk(tree):
     if isinstance(node, ast.FunctionDef):
@@ -80,27 +85,99 @@ def transpile_functions(python_code, algo_meta, desc_meta, api_key_path, model,
 
       if function_name in functions:
         function_code = '\n'.join(lines[start_line:end_line])
-        cyml = create_cyml_code(api_key_path, agent_cymltranspile, model, function_code, algo_meta)
-        
-        if algo_meta.get('init', {}) != '-' and algo_meta.get('init', {}) != [] and function_name == algo_meta.get('init', {}).get('name') :
-          file_name = f"init_{desc_meta.get('metadata', {}).get('Title')}"
-          cyml = dedent_one_level(cyml)
-        elif function_name == algo_meta.get('process', {}).get('name'):
-          file_name = desc_meta.get('metadata', {}).get('Title')
-          cyml = dedent_one_level(cyml)
-        else:
-          file_name = function_name
-
-        if cyml and cyml.strip() and any(line.strip() and not line.strip().startswith('#') for line in cyml.split('\n')):
-          cyml = format(cyml, algo_meta, desc_meta)
-          file_path = os.path.join(output_folder, f"{file_name}.pyx")
-          functions_transpiled.append(file_path)
-          with open(file_path, 'w', encoding='utf-8') as f:
-            f.write(cyml)
-        else:
-          if function_name == algo_meta.get('init', {}).get('name'):
-            algo_meta['init'] = '-'
-          else:
-            algo_meta['functions'] = [f for f in algo_meta['functions'] if f.get('name') != function_name]
-            
-  return functions_transpiled
\ No newline at end of file
+        selected.append((function_name, function_code))
+  return selected
+
+
+#-----------------------------------------------------------------
+# Function to transpile the functions that the rules support, without any agent
+# Returns the CyML of each function, None for the functions left to the agent.
+#-----------------------------------------------------------------
+def transpile_by_rules(python_code, functions, algo_meta, agent_cymltranspile):
+  cymls = []
+  for function_name, _ in functions:
+    cyml = rule_transpile(python_code, function_name, algo_meta)
+    if cyml is not None:
+      print(f"Function {function_name} transpiled by rules, {agent_name(agent_cymltranspile)} skipped")
+    cymls.append(cyml)
+  return cymls
+
+
+#-----------------------------------------------------------------
+# Function to save a transpiled function in the output folder
+# Empty transpilations are not saved and the function is removed from the algo metadata.
+#-----------------------------------------------------------------
+def save_transpiled(function_name, cyml, algo_meta, desc_meta, output_folder, functions_transpiled):
+  if algo_meta.get('init', {}) != '-' and algo_meta.get('init', {}) != [] and function_name == algo_meta.get('init', {}).get('name') :
+    file_name = f"init_{desc_meta.get('metadata', {}).get('Title')}"
+    cyml = dedent_one_level(cyml)
+  elif function_name == algo_meta.get('process', {}).get('name'):
+    file_name = desc_meta.get('metadata', {}).get('Title')
+    cyml = dedent_one_level(cyml)
+  else:
+    file_name = function_name
+
+  if cyml and cyml.strip() and any(line.strip() and not line.strip().startswith('#') for line in cyml.split('\n')):
+    cyml = format(cyml, algo_meta, desc_meta)
+    file_path = os.path.join(output_folder, f"{file_name}.pyx")
+    functions_transpiled.append(file_path)
+    with open(file_path, 'w', encoding='utf-8') as f:
+      f.write(cyml)
+  else:
+    if algo_meta.get('init', {}) != '-' and algo_meta.get('init', {}) != [] and function_name == algo_meta.get('init', {}).get('name'):
+      algo_meta['init'] = '-'
+    else:
+      algo_meta['functions'] = [f for f in algo_meta['functions'] if f.get('name') != function_name]
+
+
+#-----------------------------------------------------------------
+# Function to extract functions from a Python code string and transpile each to a separate file
+# This function parses the Python code string, detects each function definition, and transpiles them in a new file containing only that function.
+# The functions supported by the rules of rule_transpiler are transpiled first, only the others are sent to the agent.
+# At most max_workers functions are transpiled at the same time. All requests see the same algo metadata,
+# and the results are saved in the order of the source code, so the files and the pruning of the algo metadata do not depend on timing.
+#-----------------------------------------------------------------
+def transpile_functions(python_code, algo_meta, desc_meta, api_key_path, model, agent_cymltranspile, output_folder, max_workers=4):
+  functions = functions_to_transpile(python_code, algo_meta)
+  if functions is None:
+    return
+
+  cymls = transpile_by_rules(python_code, functions, algo_meta, agent_cymltranspile)
+  with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+    futures = {
+      i: executor.submit(contextvars.copy_context().run, create_cyml_code, api_key_path, agent_cymltranspile, model, function_code, algo_meta)
+      for i, (_, function_code) in enumerate(functions) if cymls[i] is None
+    }
+    for i, fut in futures.items():
+      cymls[i] = fut.result()
+
+  functions_transpiled = []
+  for (function_name, _), cyml in zip(functions, cymls):
+    save_transpiled(function_name, cyml, algo_meta, desc_meta, output_folder, functions_transpiled)
+
+  return functions_transpiled
+
+
+#-----------------------------------------------------------------
+# Asynchronous version of transpile_functions
+# The functions not supported by the rules are transpiled concurrently, then all are saved in the order of the source code.
+#-----------------------------------------------------------------
+async def transpile_functions_async(python_code, algo_meta, desc_meta, api_key_path, model, agent_cymltranspile, output_folder):
+  functions = functions_to_transpile(python_code, algo_meta)
+  if functions is None:
+    return
+
+  cymls = transpile_by_rules(python_code, functions, algo_meta, agent_cymltranspile)
+  pending = [i for i, cyml in enumerate(cymls) if cyml is None]
+  answers = await asyncio.gather(*[
+    create_cyml_code_async(api_key_path, agent_cymltranspile, model, functions[i][1], algo_meta)
+    for i in pending
+  ])
+  for i, cyml in zip(pending, answers):
+    cymls[i] = cyml
+
+  functions_transpiled = []
+  for (function_name, _), cyml in zip(functions, cymls):
+    save_transpiled(function_name, cyml, algo_meta, desc_meta, output_folder, functions_transpiled)
+
+  return functions_transpiled
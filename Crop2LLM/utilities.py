@@ -1,13 +1,75 @@
 import os
+import threading
+from collections import OrderedDict
 from pathlib import Path
+from run_log import log_block, reset_log
+
+_text_lock = threading.Lock()
+_text_cache = {"max_size": 64 * 1024 * 1024, "size": 0, "entries": OrderedDict(), "hits": 0, "reads": 0}
+
+
+#-----------------------------------------------------------------
+# Function to configure the memory bound of the file content cache, in characters
+#-----------------------------------------------------------------
+def configure_text_cache(max_size):
+  with _text_lock:
+    _text_cache["max_size"] = max_size
+    _text_cache["entries"].clear()
+    _text_cache["size"] = 0
+
+
+#-----------------------------------------------------------------
+# Function to forget the content of a file, to be called after writing it
+#-----------------------------------------------------------------
+def invalidate_text(file_path):
+  with _text_lock:
+    entry = _text_cache["entries"].pop(os.path.abspath(file_path), None)
+    if entry is not None:
+      _text_cache["size"] -= len(entry[1])
+
+
+#-----------------------------------------------------------------
+# Function to get the number of reads saved by the file content cache
+#-----------------------------------------------------------------
+def text_cache_stats():
+  with _text_lock:
+    return {"hits": _text_cache["hits"], "reads": _text_cache["reads"], "files": len(_text_cache["entries"]), "size": _text_cache["size"]}
+
 
 #-----------------------------------------------------------------
 # Function to extract text from a file
 # This function reads the content of a file and returns it as a string.
+# Contents are kept in a process-wide cache and read again only when the modification time or size of the file changed.
+# The least recently used files are dropped when the cache grows beyond its memory bound.
+# Invalid UTF-8 is replaced, unless errors is "strict" : the decoding error is then raised, a content cached by a
+# replacing read is not used for a strict one.
 #-----------------------------------------------------------------
-def extract_text(file_path):
-  with open(file_path, "r", encoding="utf-8", errors="replace") as file:
-    return file.read()
+def extract_text(file_path, errors="replace"):
+  key = os.path.abspath(file_path)
+  stat = os.stat(key)
+  version = (stat.st_mtime_ns, stat.st_size)
+  with _text_lock:
+    entry = _text_cache["entries"].get(key)
+    if entry is not None and entry[0] == version and (errors != "strict" or entry[2] == "strict"):
+      _text_cache["entries"].move_to_end(key)
+      _text_cache["hits"] += 1
+      return entry[1]
+
+  with open(key, "r", encoding="utf-8", errors=errors) as file:
+    text = file.read()
+
+  with _text_lock:
+    _text_cache["reads"] += 1
+    old = _text_cache["entries"].pop(key, None)
+    if old is not None:
+      _text_cache["size"] -= len(old[1])
+    if len(text) <= _text_cache["max_size"]:
+      _text_cache["entries"][key] = (version, text, errors)
+      _text_cache["size"] += len(text)
+      while _text_cache["size"] > _text_cache["max_size"]:
+        _, (_, dropped, _) = _text_cache["entries"].popitem(last=False)
+        _text_cache["size"] -= len(dropped)
+  return text
 
 
 #-----------------------------------------------------------------
@@ -59,8 +121,7 @@ def check_files(*args, comp, config_files, log_file, output_folder):
     if not os.path.exists(file_path):
       raise FileNotFoundError(f"File {file_path} does not exist")
     try:
-      with open(file_path, 'r', encoding='utf-8') as f:
-        f.read()
+      extract_text(file_path, errors="strict")
     except Exception as e:
       raise ValueError(f"Cannot read file {file_path}: {e}")
 
@@ -69,8 +130,7 @@ def check_files(*args, comp, config_files, log_file, output_folder):
     if not os.path.exists(comp):
       raise FileNotFoundError(f"File {comp} does not exist")
     try:
-      with open(comp, 'r', encoding='utf-8') as f:
-        f.read()
+      extract_text(comp, errors="strict")
     except Exception as e:
       raise ValueError(f"Cannot read file {comp}: {e}")
   
@@ -78,16 +138,12 @@ def check_files(*args, comp, config_files, log_file, output_folder):
     if not os.path.exists(file_path):
       raise FileNotFoundError(f"Configuration file {file_path} does not exist")
     try:
-      with open(file_path, 'r', encoding='utf-8') as f:
-        f.read()
+      extract_text(file_path, errors="strict")
     except Exception as e:
       raise ValueError(f"Cannot read configuration file {file_path}: {e}")
     
   # Create or clear log file
-  log_file_path = os.path.join(output_folder, log_file)
-  with open(log_file_path, 'w', encoding='utf-8') as f:
-    f.write("")
-    pass
+  reset_log(os.path.join(output_folder, log_file))
 
 
 #-----------------------------------------------------------------
@@ -96,7 +152,7 @@ def check_files(*args, comp, config_files, log_file, output_folder):
 def log_comments(json, output_path, log_file, model_name):
   comments = json.get('comments', [])
   log_path = os.path.join(output_path, log_file)
-  with open(log_path, 'a', encoding='utf-8') as lf:
+  with log_block(log_path) as lf:
     lf.write(f"--- {model_name} ---\n")
     for c in comments:
       if isinstance(c, dict):
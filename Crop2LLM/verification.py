@@ -1,44 +1,92 @@
 import os
-import xml
+import traceback
+import concurrent.futures
+from dataclasses import dataclass
 from path import Path
-from pycropml.topology import Topology
-from pycropml.pparse import model_parser
 from pycropml.cyml import prefix
 from pycropml import render_cyml
 from pycropml.transpiler.main import Main
 from openAI_interaction import create_debug_code_composite, create_debug_code_unit, create_debug_xml_composite, create_debug_xml_unit
-from json2XML import format_xml
+from json2XML import format_xml, write_xml
+from session import PackageSession
+from telemetry import telemetry_scope
+from utilities import invalidate_text
+from run_log import log_block
+
+#-----------------------------------------------------------------
+# Error found while generating or checking the pyx code of a package
+# kind is one of ModelUnit-Generation, ModelComposite-Generation, ModelUnit and ModelComposite.
+# file is the path of the file the error was found in : the XML documentation for generation errors, the pyx code otherwise.
+#-----------------------------------------------------------------
+@dataclass
+class CheckError:
+  kind: str
+  file: str
+  model: str
+  message: str
+  traceback: str
+
+  #-----------------------------------------------------------------
+  # Function to format the error for the repair agents, the traceback locates the failure in pycropml
+  #-----------------------------------------------------------------
+  def describe(self):
+    text = f"{self.kind} error in {os.path.basename(self.file)} (model {self.model}) :\n{self.message}\n"
+    if self.traceback and self.traceback.strip() != "NoneType: None":
+      text += f"\nTraceback :\n{self.traceback}"
+    return text
+
+
+def _check_error(kind, file, model, e):
+  return CheckError(kind, str(file), model, f"{e}", traceback.format_exc())
+
 
 #-----------------------------------------------------------------
 # Function to check if the pyx code of each model unit can be generated
+# The session caches the parsed package between the attempts of the repair loops.
+# Every model unit is tried, so all the failing units are reported in one pass.
+# Returns the errors found, an empty list when the code was generated.
 #-----------------------------------------------------------------
-def generate_pyx_unit(model_package, report_path):
-  code_generated = False
+def generate_pyx_unit(model_package, report_path, session=None):
+  if session is None:
+    session = PackageSession(model_package)
+  errors = []
   pkg = Path(model_package)
   output = Path(os.path.join(pkg, 'src'))
-  models = model_parser(pkg)
+  models = session.models()
   m2p = render_cyml.Model2Package(models, dir=output)
 
-  try:
-    for model in models:          
+  for model in models:
+    try:
       m2p.generate_component(model)
+    except Exception as e:
+      with log_block(report_path) as rf:
+        rf.write(f"ERROR ModelUnit-Generation when generating pyx code --- {model.name} ---:\n{e}\n\n")
+      xml_path = os.path.join(model_package, 'crop2ml', f"unit.{model.name}.xml")
+      errors.append(_check_error("ModelUnit-Generation", xml_path, model.name, e))
+  if errors:
+    return errors
+
+  try:
     m2p.generate_package()  # generate cyml models in "pyx" directory
-    with open(report_path, 'a') as rf:
+    with log_block(report_path) as rf:
       rf.write(f"Successfully generated pyx code of each model units.\n")
-      code_generated = True
   except Exception as e:
-    with open(report_path, 'a') as rf:
+    with log_block(report_path) as rf:
       rf.write(f"ERROR ModelUnit-Generation when generating pyx code --- {model.name} ---:\n{e}\n\n")
-    pass
-  return code_generated
+    xml_path = os.path.join(model_package, 'crop2ml', f"unit.{model.name}.xml")
+    errors.append(_check_error("ModelUnit-Generation", xml_path, model.name, e))
+  return errors
 
 
 #-----------------------------------------------------------------
 # Function to check if the pyx code of model composite can be generated
+# Returns the errors found, an empty list when the code was generated.
 #-----------------------------------------------------------------
-def generate_pyx_composite(model_package, report_path):
-  code_generated = False
-  topology = Topology(model_package.split(os.path.sep)[-1], model_package)
+def generate_pyx_composite(model_package, report_path, session=None):
+  if session is None:
+    session = PackageSession(model_package)
+  errors = []
+  topology = session.topology()
   pkg = Path(model_package)
   output = Path(os.path.join(pkg, 'src'))
   cyml_rep = Path(os.path.join(output, 'pyx'))
@@ -49,178 +97,218 @@ def generate_pyx_composite(model_package, report_path):
     fileT = Path(os.path.join(cyml_rep, f"{mc_name}Component.pyx"))
     with open(fileT, "wb") as tg_file:
       tg_file.write(T_pyx.encode('utf-8'))
-    with open(report_path, 'a') as rf:
+    with log_block(report_path) as rf:
       rf.write(f"Successfully generated composite pyx code.\n")
-    code_generated = True
   except Exception as e:
-    with open(report_path, 'a') as rf:
+    with log_block(report_path) as rf:
       rf.write(f"ERROR ModelComposite-Generation when generating the pyx code of the model composite :\n{e}\n\n")
-    pass
+    xml_path = os.path.join(model_package, 'crop2ml', f"composition.{session.name}.xml")
+    errors.append(_check_error("ModelComposite-Generation", xml_path, session.name, e))
 
-  return code_generated
+  return errors
 
 
 #-----------------------------------------------------------------
 # Function to check the syntax of the generated code files and the CROP2ML -> language/platform transformation
+# Files already checked successfully are skipped while neither their content nor the XML of their model changed.
+# Every file is checked, so all the failing units are reported in one pass.
+# Returns the errors found, an empty list when every file was checked successfully.
 #-----------------------------------------------------------------
-def check_code_unit(model_package, report_path):
-  verif_result = False
-  topology = Topology(model_package.split(os.path.sep)[-1], model_package)
+def check_code_unit(model_package, report_path, session=None):
+  if session is None:
+    session = PackageSession(model_package)
+  topology = session.topology()
   pkg = Path(model_package)
   output = Path(os.path.join(pkg, 'src'))
-  models = model_parser(pkg)
+  models = session.models()
   cyml_rep = Path(os.path.join(output, 'pyx'))
+
+  errors = []
+  models_by_name = {}
+  for model in models:
+    if prefix(model) != "function":
+      models_by_name.setdefault(model.name.lower(), []).append(model)
   
   # Check each modelUnit
   for k, file in enumerate(cyml_rep.files()):
-    with open(file, 'r') as fi:
-      source = fi.read()
     name = os.path.split(file)[1].split(".")[0]
-    for model in models:
-      if name.lower() == model.name.lower() and prefix(model) != "function":
-        test = Main(file, 'cs', model, topology.model.name)
-
-        try:
-          test.parse()
-          with open(report_path, 'a') as rf:
-            rf.write(f"Successfully parsed {os.path.basename(file)}\n")
-        except Exception as e:
-          with open(report_path, 'a') as rf:
-            rf.write(f"ERROR ModelUnit when parsing --- {os.path.basename(file)} ---\n{e}\n\n")
-          raise
-
-        try:
-          test.to_ast(source)
-          with open(report_path, 'a') as rf:
-            rf.write(f"Successfully generated AST for {os.path.basename(file)}\n")
-        except Exception as e:
-          with open(report_path, 'a') as rf:
-            rf.write(f"ERROR ModelUnit when generating AST --- {os.path.basename(file)} ---\n{e}\n\n")
-          raise
-  verif_result = True
-  return verif_result
+    for model in models_by_name.get(name.lower(), []):
+      key = (session.signature(file)[2], session.model_digest(model), topology.model.name)
+      if session.verdict(file, key):
+        with log_block(report_path) as rf:
+          rf.write(f"Unchanged since last successful check {os.path.basename(file)}\n")
+        continue
+
+      source = session.source(file)
+      test = Main(file, 'cs', model, topology.model.name)
+      session.record_verdict(file, key, False)
+
+      try:
+        test.parse()
+        with log_block(report_path) as rf:
+          rf.write(f"Successfully parsed {os.path.basename(file)}\n")
+      except Exception as e:
+        with log_block(report_path) as rf:
+          rf.write(f"ERROR ModelUnit when parsing --- {os.path.basename(file)} ---\n{e}\n\n")
+        errors.append(_check_error("ModelUnit", file, model.name, e))
+        continue
+
+      try:
+        test.to_ast(source)
+        with log_block(report_path) as rf:
+          rf.write(f"Successfully generated AST for {os.path.basename(file)}\n")
+      except Exception as e:
+        with log_block(report_path) as rf:
+          rf.write(f"ERROR ModelUnit when generating AST --- {os.path.basename(file)} ---\n{e}\n\n")
+        errors.append(_check_error("ModelUnit", file, model.name, e))
+        continue
+
+      session.record_verdict(file, key, True)
+  return errors
 
 
 #-----------------------------------------------------------------
 # Function to check the syntax of the generated composite and the CROP2ML -> language/platform transformation
+# Returns the errors found, an empty list when the composite was checked successfully.
 #-----------------------------------------------------------------
-def check_code_composite(model_package, report_path):
-  verif_result = False
+def check_code_composite(model_package, report_path, session=None):
+  if session is None:
+    session = PackageSession(model_package)
   pkg = Path(model_package)
   output = Path(os.path.join(pkg, 'src'))
   cyml_rep = Path(os.path.join(output, 'pyx'))
-  topology = Topology(model_package.split(os.path.sep)[-1], model_package)
+  topology = session.topology()
   mc_name = topology.model.name
   compoPath = Path(os.path.join(cyml_rep, f"{mc_name}Component.pyx"))
-  with open(compoPath, 'r') as fi:
-    source = fi.read()
+  source = session.source(compoPath)
   test = Main(source, 'cs', topology.model, topology.model.name)
 
   try:
     test.parse()
-    with open(report_path, 'a') as rf:
+    with log_block(report_path) as rf:
       rf.write(f"Successfully parsed composite model --- {mc_name}Component.pyx ---\n")
   except Exception as e:
-    with open(report_path, 'a') as rf:
+    with log_block(report_path) as rf:
       rf.write(f"ERROR ModelComposite when parsing --- {mc_name}Component.pyx --- :\n{e}\n\n")
-    raise
+    return [_check_error("ModelComposite", compoPath, mc_name, e)]
 
   try:
     test.to_ast(source)
-    with open(report_path, 'a') as rf:
+    with log_block(report_path) as rf:
       rf.write(f"Successfully generated the AST for the composite model --- {mc_name}Component.pyx ---\n")
   except Exception as e:
-    with open(report_path, 'a') as rf:
+    with log_block(report_path) as rf:
       rf.write(f"ERROR ModelComposite when generating the AST --- {mc_name}Component.pyx --- :\n{e}\n\n")
-    raise
+    return [_check_error("ModelComposite", compoPath, mc_name, e)]
 
-  with open(report_path, 'a') as rf:
+  with log_block(report_path) as rf:
     rf.write("All files parsed and AST generated successfully.\n")
     
-  verif_result = True
-  return verif_result
+  return []
+
+
+#-----------------------------------------------------------------
+# Function to repair several errors at once
+# Only one error per file is kept, so the corrections of the concurrent agent calls are applied to disjoint files.
+# The agent calls run in a thread pool, the corrections are applied in the order of the errors once they all returned.
+#-----------------------------------------------------------------
+def repair_errors(errors, repair, apply, max_workers):
+  repairs = []
+  seen = set()
+  for error in errors:
+    if error.file not in seen:
+      seen.add(error.file)
+      repairs.append(error)
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(repairs)))) as executor:
+    futures = [executor.submit(repair, error) for error in repairs]
+    results = []
+    for error, fut in zip(repairs, futures):
+      try:
+        results.append((error, fut.result()))
+      except Exception as e:
+        print(f"Error while repairing {os.path.basename(error.file)}: {e}")
+
+  for error, result in results:
+    if result is not None:
+      apply(error, result)
+
+
+#-----------------------------------------------------------------
+# Function to write an XML documentation corrected by an agent
+#-----------------------------------------------------------------
+def write_corrected_xml(response_xml, xml_path, session=None):
+  write_xml(format_xml(response_xml), xml_path)
+  invalidate_text(xml_path)
+  if session is not None:
+    session.invalidate(xml_path)
 
 
 #-----------------------------------------------------------------
 # Function to check if the code generated in the output folder is correct by verifying the syntax and AST of the generated files
+# The errors returned by check_code_unit or check_code_composite are repaired concurrently, one agent call per failing file.
 #-----------------------------------------------------------------
-def debug_code(api_key, debug_cyml, apply_xml, apply_code, code_or_xml, model, model_package, report_path, apply_correction):
-  with open(report_path, 'r') as f:
-    lines = f.readlines()
-  for line in reversed(lines):
-
-    if "ERROR ModelUnit" in line:
-      parts = line.split('---')
-      filename = parts[1].strip()
-      cyml_path = os.path.join(model_package, 'src', 'pyx', filename)
-      xml_path = os.path.join(model_package, 'crop2ml', f"unit.{filename.split('.')[0]}.xml")
-      error_msg = "".join(lines[lines.index(line)+1:])
-      response, response_xml, response_code, file_to_modify = create_debug_code_unit(
-                                                              api_key, debug_cyml, code_or_xml, apply_code,
-                                                              apply_xml, model, cyml_path, xml_path, 
-                                                              error_msg, apply_correction)
-      break
-
-    elif "ERROR ModelComposite" in line:
-      parts = line.split('---')
-      filename = parts[1].strip()
-      cyml_path = os.path.join(model_package, 'src', 'pyx', filename)
-      base = filename.split('.')[0].replace("Component", "")
-      xml_path = os.path.join(model_package, 'crop2ml', f"composition.{base}.xml")
-      algo_metas = [os.path.join(model_package, 'crop2ml', f) for f in os.listdir(os.path.join(model_package, 'crop2ml')) if f.startswith("unit") and f.endswith(".xml")]
-      error_msg = "".join(lines[lines.index(line)+1:])
-      response, response_xml, response_code, file_to_modify = create_debug_code_composite(
-                                                              api_key, debug_cyml, code_or_xml, apply_code,
-                                                              apply_xml, model, cyml_path, xml_path, algo_metas,
-                                                              error_msg, apply_correction)
-      break
-
-  if apply_correction:
-    if file_to_modify == "XML" or file_to_modify == "BOTH":
-      dom = format_xml(response_xml)
-      dom = xml.dom.minidom.parseString(dom.decode('utf-8') if isinstance(dom, bytes) else dom)
-      with open(xml_path, 'w', encoding='utf-8') as f:
-        f.write(dom.toprettyxml())
-    if file_to_modify == "CODEBASE" or file_to_modify == "BOTH":
-      with open(cyml_path, 'w', encoding='utf-8') as rf:
-        rf.write(response_code)
-    
-  else :
-    with open(report_path, 'a') as rf:
-      rf.write(f"To debug this error, try :\n\n {response}\n")
+def debug_code(api_key, debug_cyml, apply_xml, apply_code, code_or_xml, model, model_package, report_path, errors, apply_correction, session=None, max_workers=4):
+  crop2ml_folder = os.path.join(model_package, 'crop2ml')
+
+  def xml_path_of(error):
+    filename = os.path.basename(error.file)
+    if error.kind == "ModelUnit":
+      return os.path.join(crop2ml_folder, f"unit.{filename.split('.')[0]}.xml")
+    base = filename.split('.')[0].replace("Component", "")
+    return os.path.join(crop2ml_folder, f"composition.{base}.xml")
+
+  def repair(error):
+    xml_path = xml_path_of(error)
+    with telemetry_scope(error.model, "debug-code"):
+      if error.kind == "ModelUnit":
+        return create_debug_code_unit(api_key, debug_cyml, code_or_xml, apply_code,
+                                      apply_xml, model, error.file, xml_path, 
+                                      error.describe(), apply_correction)
+      algo_metas = [os.path.join(crop2ml_folder, f) for f in os.listdir(crop2ml_folder) if f.startswith("unit") and f.endswith(".xml")]
+      return create_debug_code_composite(api_key, debug_cyml, code_or_xml, apply_code,
+                                         apply_xml, model, error.file, xml_path, algo_metas,
+                                         error.describe(), apply_correction)
+
+  def apply(error, result):
+    response, response_xml, response_code, file_to_modify = result
+    if apply_correction:
+      if file_to_modify == "XML" or file_to_modify == "BOTH":
+        write_corrected_xml(response_xml, xml_path_of(error), session)
+      if file_to_modify == "CODEBASE" or file_to_modify == "BOTH":
+        with open(error.file, 'w', encoding='utf-8') as rf:
+          rf.write(response_code)
+        invalidate_text(error.file)
+        if session is not None:
+          session.invalidate(error.file)
+    else :
+      with log_block(report_path) as rf:
+        rf.write(f"To debug the error in {os.path.basename(error.file)}, try :\n\n {response}\n")
+
+  errors = [error for error in errors if error.kind in ("ModelUnit", "ModelComposite")]
+  repair_errors(errors, repair, apply, max_workers)
 
 
 #-----------------------------------------------------------------
 # Function to check if the code generated in the output folder is correct by verifying the syntax and AST of the generated files
+# The errors returned by generate_pyx_unit or generate_pyx_composite are repaired concurrently, one agent call per failing file.
 #-----------------------------------------------------------------
-def debug_xml(api_key, debug_xml, apply_xml, model, model_package, report_path, apply_correction):
-  with open(report_path, 'r') as f:
-    lines = f.readlines()
-  for line in reversed(lines):
-
-    if "ERROR ModelUnit-Generation" in line:
-      parts = line.split('---')
-      filename = parts[1].strip()
-      xml_path = os.path.join(model_package, 'crop2ml', f"unit.{filename.split('.')[0]}.xml")
-      error_msg = "".join(lines[lines.index(line)+1:])
-      response = create_debug_xml_unit(api_key, debug_xml, apply_xml, model, xml_path, error_msg, apply_correction)
-      break
-
-    elif "ERROR ModelComposite-Generation" in line:
-      parts = line.split('---')
-      filename = parts[1].strip()
-      base = filename.split('.')[0].replace("Component", "")
-      xml_path = os.path.join(model_package, 'crop2ml', f"composition.{base}.xml")
-      algo_metas = [os.path.join(model_package, 'crop2ml', f) for f in os.listdir(os.path.join(model_package, 'crop2ml')) if f.startswith("unit") and f.endswith(".xml")]
-      error_msg = "".join(lines[lines.index(line)+1:])
-      response = create_debug_xml_composite(api_key, debug_xml, apply_xml, model, xml_path, algo_metas, error_msg, apply_correction)
-      break
-
-  if apply_correction:
-    dom = format_xml(response)
-    dom = xml.dom.minidom.parseString(dom.decode('utf-8') if isinstance(dom, bytes) else dom)
-    with open(xml_path, 'w', encoding='utf-8') as f:
-      f.write(dom.toprettyxml())
-  else:
-    with open(report_path, 'a') as rf:
-      rf.write(f"To debug this error, try :\n\n {response}\n")
\ No newline at end of file
+def debug_xml(api_key, debug_xml, apply_xml, model, model_package, report_path, errors, apply_correction, session=None, max_workers=4):
+  crop2ml_folder = os.path.join(model_package, 'crop2ml')
+
+  def repair(error):
+    with telemetry_scope(error.model, "debug-xml"):
+      if error.kind == "ModelUnit-Generation":
+        return create_debug_xml_unit(api_key, debug_xml, apply_xml, model, error.file, error.describe(), apply_correction)
+      algo_metas = [os.path.join(crop2ml_folder, f) for f in os.listdir(crop2ml_folder) if f.startswith("unit") and f.endswith(".xml")]
+      return create_debug_xml_composite(api_key, debug_xml, apply_xml, model, error.file, algo_metas, error.describe(), apply_correction)
+
+  def apply(error, response):
+    if apply_correction:
+      write_corrected_xml(response, error.file, session)
+    else:
+      with log_block(report_path) as rf:
+        rf.write(f"To debug the error in {os.path.basename(error.file)}, try :\n\n {response}\n")
+
+  errors = [error for error in errors if error.kind in ("ModelUnit-Generation", "ModelComposite-Generation")]
+  repair_errors(errors, repair, apply, max_workers)
@@ -0,0 +1,47 @@
+import os
+import sys
+import time
+import argparse
+import concurrent.futures
+from openai import OpenAI
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Crop2LLM"))
+from openAI_interaction import configure_client_pool, send_to_gpt
+from stub_server import start_stub_server
+
+#-----------------------------------------------------------------
+# Micro-benchmark of the per-call overhead of the OpenAI client
+# Compares one client built per call (previous behaviour) with the shared client of the registry, against a local stub server.
+#-----------------------------------------------------------------
+def call_fresh_client(base_url):
+  client = OpenAI(api_key="stub", base_url=base_url)
+  client.responses.create(model="stub", input="ping")
+
+
+def call_pooled_client():
+  send_to_gpt("instructions", "ping", "stub", "stub", "low", "text", "low", use_cache=False)
+
+
+def measure(call, calls, threads):
+  start = time.perf_counter()
+  with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+    for fut in [executor.submit(call) for _ in range(calls)]:
+      fut.result()
+  return (time.perf_counter() - start) / calls
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Measure the per-call overhead of the OpenAI client.")
+  parser.add_argument('--calls', type=int, default=200, help='Number of calls per measure')
+  parser.add_argument('--threads', type=int, default=15, help='Number of concurrent threads')
+  args = parser.parse_args()
+
+  server, base_url = start_stub_server()
+  configure_client_pool(args.threads, base_url=base_url)
+
+  for threads in [1, args.threads]:
+    fresh = measure(lambda: call_fresh_client(base_url), args.calls, threads)
+    pooled = measure(call_pooled_client, args.calls, threads)
+    print(f"{threads:>3} thread(s) : fresh client {fresh * 1000:.2f} ms/call, pooled client {pooled * 1000:.2f} ms/call, speed-up x{fresh / pooled:.1f}")
+
+  server.shutdown()
@@ -0,0 +1,238 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from contextlib import contextmanager
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "Crop2LLM"))
+import main
+from utilities import check_files, configure_text_cache
+from response_cache import configure_cache
+from openAI_interaction import configure_client_pool, summarize_code
+from generation import process_unit, process_composite, create_crop2ml_package, maj_component, generate_components
+from telemetry import configure_telemetry, call_records, summarize
+from scheduler import configure_rate_limits
+from agents import load_agents
+from checkpoint import configure_checkpoint
+from context_budget import configure_context_budget
+from batch import load_manifest
+from run_log import flush_logs
+from stub_server import StubHandler, start_stub_server
+
+#-----------------------------------------------------------------
+# End-to-end benchmark over the examples corpus
+# Each example of the manifest (examples.json by default, in the format of the batch manifests) goes through the stages
+# of the --unit and --package pipelines : process_unit for each unit, process_composite, create_crop2ml_package, the
+# verification and repair of the package and generate_components. The agent calls are answered by the stub server
+# replaying a recording (python main.py --record), without network nor API key, the response cache is bypassed.
+# The units are processed one after the other, so that the cost of each one is measured alone, where a real run
+# overlaps them in one task graph.
+# Wall time, CPU time, peak RSS, agent calls and tokens per phase of each stage are saved as JSON, to be compared with
+# the results of another commit with --compare.
+#-----------------------------------------------------------------
+def current_rss():
+  try:
+    with open("/proc/self/statm") as f:
+      return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+  except (OSError, ValueError):
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+#-----------------------------------------------------------------
+# Function to measure a stage, the RSS is sampled in a background thread while it runs
+# The stage dictionary is filled when the block ends, with the agent calls recorded by the telemetry during the block.
+#-----------------------------------------------------------------
+@contextmanager
+def measure_stage(stage, interval=0.02):
+  peak = [current_rss()]
+  running = threading.Event()
+  running.set()
+
+  def sample():
+    while running.is_set():
+      peak[0] = max(peak[0], current_rss())
+      time.sleep(interval)
+
+  sampler = threading.Thread(target=sample, daemon=True)
+  first_record = len(call_records())
+  wall, cpu = time.perf_counter(), time.process_time()
+  sampler.start()
+  try:
+    yield stage
+  except Exception as e:
+    stage["status"] = "failed"
+    stage["error"] = f"{type(e).__name__}: {e}"
+  finally:
+    stage["wall"] = round(time.perf_counter() - wall, 3)
+    stage["cpu"] = round(time.process_time() - cpu, 3)
+    running.clear()
+    sampler.join()
+    stage["peak_rss"] = max(peak[0], current_rss())
+    stage.setdefault("status", "ok")
+    phases = summarize(("phase",), call_records()[first_record:])
+    stage["calls"] = sum(row["calls"] for row in phases.values())
+    stage["phases"] = {key[0]: {k: row[k] for k in ("calls", "retries", "input_tokens", "output_tokens", "reasoning_tokens")}
+                       for key, row in phases.items()}
+
+
+#-----------------------------------------------------------------
+# Function to run the stages of an example in its output folder, the stages after a failed one are skipped
+#-----------------------------------------------------------------
+def run_example(job, output_folder, api_key_path, skip_package):
+  stages = []
+
+  def stage(name):
+    stages.append({"stage": name})
+    return measure_stage(stages[-1])
+
+  def failed():
+    return stages[-1]["status"] != "ok"
+
+  os.makedirs(output_folder, exist_ok=True)
+  check_files(*job.units, comp=job.composite, config_files=[api_key_path], log_file=main.LOG_FILE, output_folder=output_folder)
+  configure_checkpoint(os.path.join(output_folder, main.CHECKPOINT_FILE))
+
+  results = []
+  for group in job.units:
+    with stage(f"process_unit:{os.path.splitext(os.path.basename(group[0]))[0]}"):
+      results.append(process_unit(api_key_path, main.UNIT_META, main.PY_REFACTOR, main.ALGO_META, main.CYML_TRANSPILE, main.PY_CONSENSUS,
+                                  main.SMALL_MODEL, main.BIG_MODEL, main.NUMBER_CANDIDATES, main.LOG_FILE, group, job.composite,
+                                  output_folder, main.MAX_PARALLEL_FUNCTIONS, main.CANDIDATE_QUORUM, main.MAX_EXTRA_CANDIDATES))
+    if failed():
+      return stages
+
+  with stage("process_composite"):
+    composite_metadata, xml_composite, model_composite = process_composite(api_key_path, main.COMPOSITE_META, main.SMALL_MODEL, output_folder,
+                                                                           [xml for xml, _ in results], job.composite, main.LOG_FILE, job.units[0][0])
+  if failed():
+    return stages
+
+  with stage("create_crop2ml_package"):
+    package = create_crop2ml_package(main.COOKIE_CUTTER_TEMPLATE, output_folder, model_composite, composite_metadata,
+                                     [xml for xml, _ in results], xml_composite, [functions for _, functions in results], main.LOG_FILE)
+  if failed() or skip_package:
+    return stages
+
+  with stage("verify_package") as verified:
+    if not main.verify_package(package):
+      verified["status"] = "failed"
+      verified["error"] = "The package could not be repaired, see its transformation report"
+  if failed():
+    return stages
+
+  with stage("generate_components") as generated:
+    maj_component(package, os.path.join(package, 'src', 'pyx'), os.path.join(package, 'crop2ml'))
+    languages = generate_components(package, main.LANGUAGES, main.MAX_PARALLEL_LANGUAGES)
+    generated["languages"] = {language: {"elapsed": round(elapsed, 3), "error": error} for language, elapsed, error in languages}
+  return stages
+
+
+def git_commit():
+  try:
+    return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+#-----------------------------------------------------------------
+# Function to print the wall time of each stage against the results of a previous run
+#-----------------------------------------------------------------
+def compare(results, previous_path):
+  with open(previous_path, "r", encoding="utf-8") as f:
+    previous = json.load(f)
+  before = {(e["name"], s["stage"]): s for e in previous["examples"] for s in e["stages"]}
+  print(f"\nCompared with {previous_path} (commit {previous.get('commit')}) :")
+  for example in results["examples"]:
+    for s in example["stages"]:
+      old = before.get((example["name"], s["stage"]))
+      if old is None or not old["wall"]:
+        continue
+      print(f"  {example['name'][:28]:<28} {s['stage'][:32]:<32} {old['wall']:9.2f} s -> {s['wall']:9.2f} s  x{s['wall'] / old['wall']:.2f}"
+            f"  calls {old['calls']} -> {s['calls']}")
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Run the pipeline on the examples corpus against recorded responses.")
+  parser.add_argument('--recording', required=True, help='Recording of the agent calls to replay (python main.py --record)')
+  parser.add_argument('--manifest', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples.json"), help='Examples to run')
+  parser.add_argument('--only', nargs='+', default=None, help='Names of the examples to run')
+  parser.add_argument('--results', default=None, help='JSON file of the results, results/examples_<commit>.json by default')
+  parser.add_argument('--compare', default=None, help='JSON results of a previous run to compare with')
+  parser.add_argument('--workdir', default=None, help='Folder of the generated packages, a temporary one removed at the end by default')
+  parser.add_argument('--skip-package', action='store_true', help='Stop after create_crop2ml_package, without the --package stages')
+  parser.add_argument('--latency', type=float, default=0.0, help='Delay of every response of the stub server, in seconds')
+  parser.add_argument('--tokens-per-second', type=float, default=None, help='Output tokens per second of the stub server')
+  args = parser.parse_args()
+
+  jobs = [job for job in load_manifest(args.manifest) if job.kind == "unit" and (args.only is None or job.name in args.only)]
+  recording = os.path.abspath(args.recording)
+  results_path = os.path.abspath(args.results or os.path.join(os.path.dirname(os.path.abspath(__file__)), "results", f"examples_{git_commit() or 'local'}.json"))
+  compare_path = os.path.abspath(args.compare) if args.compare else None
+  workdir = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix="crop2llm_bench_")
+  os.makedirs(workdir, exist_ok=True)
+  # The agents, the cookiecutter template and the other configuration files are relative to the root of the repository
+  os.chdir(ROOT)
+
+  # The stub server does not check the key, the one of the configuration is not needed
+  api_key_path = os.path.join(workdir, "api_key.txt")
+  with open(api_key_path, "w") as f:
+    f.write("stub")
+  main.API_KEY_PATH = api_key_path
+  main.CONFIG_FILES = [api_key_path]
+
+  StubHandler.configure(recording, latency=args.latency, tokens_per_second=args.tokens_per_second)
+  server, base_url = start_stub_server()
+  configure_cache(main.CACHE_FOLDER, main.CACHE_MAX_SIZE, main.CACHE_MAX_AGE, mode="bypass")
+  configure_text_cache(main.TEXT_CACHE_MAX_SIZE)
+  load_agents(main.AGENT_FILES)
+  configure_client_pool(main.MAX_PARALLEL_UNITS * (max(main.NUMBER_CANDIDATES, main.MAX_PARALLEL_FUNCTIONS) + 1), base_url=base_url)
+  configure_rate_limits(main.RATE_LIMITS, main.MAX_RETRIES)
+  configure_context_budget(main.MAX_SOURCE_TOKENS, main.CHUNK_TOKENS, main.SUMMARY_TOKENS,
+                           summarize=lambda chunk: summarize_code(api_key_path, main.SUMMARIZE, main.SMALL_MODEL, chunk))
+
+  results = {"commit": git_commit(), "date": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+             "recording": recording, "latency": args.latency, "tokens_per_second": args.tokens_per_second, "examples": []}
+  try:
+    for job in jobs:
+      print(f"Running {job.name}...")
+      output_folder = os.path.join(workdir, job.name)
+      configure_telemetry(os.path.join(output_folder, main.TRACE_FILE))
+      wall, cpu = time.perf_counter(), time.process_time()
+      try:
+        stages = run_example(job, output_folder, api_key_path, args.skip_package)
+      except Exception as e:
+        stages = [{"stage": "check_files", "status": "failed", "error": f"{type(e).__name__}: {e}", "wall": 0.0, "cpu": 0.0,
+                   "peak_rss": current_rss(), "calls": 0, "phases": {}}]
+      flush_logs()
+      example = {"name": job.name, "status": "ok" if all(s["status"] == "ok" for s in stages) else "failed",
+                 "wall": round(time.perf_counter() - wall, 3), "cpu": round(time.process_time() - cpu, 3),
+                 "peak_rss": max(s["peak_rss"] for s in stages), "calls": sum(s["calls"] for s in stages), "stages": stages}
+      results["examples"].append(example)
+      for s in stages:
+        tokens = sum(p["input_tokens"] + p["output_tokens"] for p in s["phases"].values())
+        print(f"  {s['stage'][:40]:<40} {s['status']:<7} wall {s['wall']:8.2f} s  cpu {s['cpu']:8.2f} s  "
+              f"rss {s['peak_rss'] / 2 ** 20:7.1f} MiB  {s['calls']:4} calls {tokens:9} tokens")
+        if s.get("error"):
+          print(f"    {s['error']}")
+  finally:
+    server.shutdown()
+    if args.workdir is None:
+      shutil.rmtree(workdir, ignore_errors=True)
+
+  results["stub"] = dict(StubHandler.stats)
+  os.makedirs(os.path.dirname(results_path), exist_ok=True)
+  with open(results_path, "w", encoding="utf-8") as f:
+    json.dump(results, f, ensure_ascii=False, indent=1)
+  print(f"\n{sum(e['status'] == 'ok' for e in results['examples'])}/{len(results['examples'])} examples succeeded, "
+        f"{results['stub']['replayed']} responses replayed, {results['stub']['missed']} missing from the recording")
+  print(f"Results saved in {results_path}")
+  if compare_path:
+    compare(results, compare_path)
@@ -0,0 +1,57 @@
+import os
+import sys
+import time
+import argparse
+import concurrent.futures
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Crop2LLM"))
+from openAI_interaction import configure_client_pool, send_to_gpt
+from scheduler import PRIORITY_BULK, PRIORITY_REPAIR, configure_rate_limits
+from stub_server import StubHandler, start_stub_server
+
+#-----------------------------------------------------------------
+# Check of the request scheduler against a local stub server injecting throttling and errors
+# Bulk and repair calls are sent together under a requests per minute budget, every call must succeed and the
+# repair calls must finish before the bulk calls submitted at the same time.
+#-----------------------------------------------------------------
+def call(priority):
+  start = time.perf_counter()
+  send_to_gpt("instructions", "ping", "stub", "stub", "low", "text", "low", use_cache=False, priority=priority)
+  return time.perf_counter() - start
+
+
+def run(calls, threads, priority):
+  with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+    return [executor.submit(call, priority) for _ in range(calls)]
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Check the request scheduler against a throttling stub server.")
+  parser.add_argument('--bulk', type=int, default=150, help='Number of bulk calls')
+  parser.add_argument('--repair', type=int, default=5, help='Number of repair calls, sent after the bulk calls')
+  parser.add_argument('--rpm', type=int, default=120, help='Requests per minute allowed by the scheduler')
+  parser.add_argument('--throttle-rate', type=float, default=0.2, help='Share of the requests answered with 429')
+  parser.add_argument('--error-rate', type=float, default=0.05, help='Share of the requests answered with 500')
+  args = parser.parse_args()
+
+  StubHandler.throttle_rate = args.throttle_rate
+  StubHandler.error_rate = args.error_rate
+  server, base_url = start_stub_server()
+  configure_client_pool(args.bulk + args.repair, base_url=base_url)
+  configure_rate_limits({"stub": (args.rpm, 10 ** 9)}, max_retries=10, base_delay=0.05, max_delay=1.0)
+
+  start = time.perf_counter()
+  with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+    bulk = executor.submit(run, args.bulk, args.bulk, PRIORITY_BULK)
+    time.sleep(0.2)
+    repair = executor.submit(run, args.repair, args.repair, PRIORITY_REPAIR)
+    bulk_latencies = [fut.result() for fut in bulk.result()]
+    repair_latencies = [fut.result() for fut in repair.result()]
+  elapsed = time.perf_counter() - start
+
+  print(f"{args.bulk + args.repair} calls succeeded in {elapsed:.1f} s ({args.rpm} requests/min budget, "
+        f"{args.throttle_rate:.0%} throttled, {args.error_rate:.0%} errors)")
+  print(f"  bulk   : mean {sum(bulk_latencies) / len(bulk_latencies):.2f} s, max {max(bulk_latencies):.2f} s")
+  print(f"  repair : mean {sum(repair_latencies) / len(repair_latencies):.2f} s, max {max(repair_latencies):.2f} s")
+
+  server.shutdown()
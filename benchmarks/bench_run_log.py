@@ -0,0 +1,80 @@
+import os
+import sys
+import time
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Crop2LLM"))
+from run_log import flush_logs, log_block, log_stats, reset_log
+
+#-----------------------------------------------------------------
+# Benchmark of the run log
+# Threads write sections of a few lines in the same report, as the units processed in parallel do, first by opening
+# the file in append mode for each section, then through the run log. Checks that no section of the run log is
+# interleaved with another one.
+#-----------------------------------------------------------------
+def write_section(f, unit, lines):
+  f.write(f"--- {unit} ---\n")
+  for i in range(lines):
+    f.write(f"{unit} comment {i}\n")
+  f.write("\n")
+
+
+def append_open(path, unit, sections, lines):
+  for _ in range(sections):
+    with open(path, 'a', encoding='utf-8') as f:
+      write_section(f, unit, lines)
+
+
+def append_run_log(path, unit, sections, lines):
+  for _ in range(sections):
+    with log_block(path) as f:
+      write_section(f, unit, lines)
+
+
+def measure(write, path, threads, sections, lines):
+  workers = [threading.Thread(target=write, args=(path, f"Unit{k}", sections, lines)) for k in range(threads)]
+  start = time.perf_counter()
+  for worker in workers:
+    worker.start()
+  for worker in workers:
+    worker.join()
+  flush_logs()
+  return time.perf_counter() - start
+
+
+#-----------------------------------------------------------------
+# Function to count the sections of a report containing lines of another unit than the one of their title
+#-----------------------------------------------------------------
+def interleaved(path):
+  count = 0
+  for section in open(path, encoding='utf-8').read().split("\n\n"):
+    if section:
+      unit = section.split("\n")[0].strip("- ")
+      count += any(not line.startswith(unit) for line in section.split("\n")[1:])
+  return count
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Measure the run log against appending to the report for each section.")
+  parser.add_argument('--threads', type=int, default=8, help='Number of units writing at the same time')
+  parser.add_argument('--sections', type=int, default=1000, help='Number of sections written by each unit')
+  parser.add_argument('--lines', type=int, default=5, help='Number of lines of each section')
+  args = parser.parse_args()
+
+  with tempfile.TemporaryDirectory() as folder:
+    old_path = os.path.join(folder, "open.txt")
+    new_path = os.path.join(folder, "run_log.txt")
+    open(old_path, 'w').close()
+    reset_log(new_path)
+
+    old = measure(append_open, old_path, args.threads, args.sections, args.lines)
+    new = measure(append_run_log, new_path, args.threads, args.sections, args.lines)
+    stats = log_stats()
+    print(f"open/append : {old * 1000:.1f} ms, {args.threads * args.sections} opens")
+    print(f"run log     : {new * 1000:.1f} ms, {stats['messages']} messages written in {stats['batches']} batches")
+    print(f"Speed-up x{old / new:.1f}")
+    if interleaved(new_path):
+      print(f"{interleaved(new_path)} sections of the run log are interleaved")
+      sys.exit(1)
@@ -0,0 +1,82 @@
+import os
+import sys
+import glob
+import time
+import argparse
+import tracemalloc
+import xml.dom.minidom
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Crop2LLM"))
+from json2XML import convert_unit, format_xml, pretty_xml
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "examples")
+
+#-----------------------------------------------------------------
+# Benchmark of the XML writer
+# Compares the previous serialization (ET.tostring, minidom.parseString, toprettyxml) with the single pass pretty_xml
+# on every XML of the examples corpus and on synthetic units with hundreds of inputs, and checks that both give
+# the same text.
+#-----------------------------------------------------------------
+def minidom_pretty_xml(root):
+  return xml.dom.minidom.parseString(ET.tostring(root, encoding='utf-8').decode('utf-8')).toprettyxml()
+
+
+#-----------------------------------------------------------------
+# Function to build the tree of a synthetic unit with n inputs and outputs, as produced by convert_unit
+#-----------------------------------------------------------------
+def synthetic_unit(n):
+  metadata = {"metadata": {"Title": f"Synthetic{n}", "Authors": "A & B", "Model version": "1.0",
+                           "Extended description": "Unit with <many> \"inputs\"", "Short description": ""}}
+  variables = [{"name": f"v{i}", "description": f"variable {i} in [0, 1]", "inputtype": "parameter" if i % 3 == 0 else "variable",
+                "category": "constant" if i % 3 == 0 else "state", "datatype": "DOUBLE" if i % 2 else "DOUBLEARRAY", "len": "10",
+                "max": "1", "min": "0", "default": "0.5", "unit": "m", "uri": ""} for i in range(n)]
+  algo = {"init": {"name": "init"}, "process": {"name": "process"}, "inputs": variables, "outputs": variables[: n // 2],
+          "functions": [{"name": f"f{i}", "description": f"function {i}"} for i in range(10)], "tests": []}
+  return convert_unit(f"Synthetic{n}.py", metadata, algo)
+
+
+def corpus():
+  trees = []
+  for path in sorted(glob.glob(os.path.join(EXAMPLES, "**", "*.xml"), recursive=True)):
+    try:
+      trees.append((os.path.relpath(path, EXAMPLES), format_xml(open(path, "rb").read())))
+    except ET.ParseError as e:
+      print(f"Skipped {path}: {e}")
+  for n in [100, 500, 2000]:
+    trees.append((f"synthetic unit, {n} inputs", synthetic_unit(n)))
+  return trees
+
+
+def measure(serialize, root, repeat):
+  tracemalloc.start()
+  start = time.perf_counter()
+  for _ in range(repeat):
+    text = serialize(root)
+  elapsed = (time.perf_counter() - start) / repeat
+  peak = tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+  return text, elapsed, peak
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Measure the XML writer against the minidom round-trip.")
+  parser.add_argument('--repeat', type=int, default=20, help='Number of serializations per XML')
+  args = parser.parse_args()
+
+  total_old = total_new = 0
+  mismatches = 0
+  for name, root in corpus():
+    old, old_time, old_peak = measure(minidom_pretty_xml, root, args.repeat)
+    new, new_time, new_peak = measure(pretty_xml, root, args.repeat)
+    total_old += old_time
+    total_new += new_time
+    if old != new:
+      mismatches += 1
+    print(f"{name[:60]:<60} minidom {old_time * 1000:8.2f} ms {old_peak / 1024:8.0f} KiB, "
+          f"single pass {new_time * 1000:8.2f} ms {new_peak / 1024:8.0f} KiB, {'identical' if old == new else 'DIFFERENT'}")
+
+  print(f"Total : minidom {total_old * 1000:.1f} ms, single pass {total_new * 1000:.1f} ms, speed-up x{total_old / total_new:.1f}")
+  if mismatches:
+    print(f"{mismatches} XML differ from the minidom output")
+    sys.exit(1)
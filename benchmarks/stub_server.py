@@ -0,0 +1,217 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Crop2LLM"))
+from recording import VARIANT_HEADER, load_recording, recording_key
+
+#-----------------------------------------------------------------
+# Local stub of OpenAI's Responses API
+# Every POST on /v1/responses is answered with a fixed text, so the cost of the client side can be measured offline.
+# With a recording (python main.py --record), the responses of a real run are replayed instead : a request is answered
+# with the response recorded for the same agent instructions, prompt and candidate variant, and a request that was not
+# recorded with a 404, so that a benchmark never runs on responses it did not expect.
+# A share of the requests can be answered with 429 (throttle_rate) or 500 (error_rate) to exercise the retries, from a
+# seeded generator. Responses can be delayed by a fixed latency plus their output tokens at tokens_per_second, at most
+# max_concurrent are generated at the same time, and the requests above max_rpm in the last minute get a 429.
+#-----------------------------------------------------------------
+def build_response(text, model, input_tokens=0, output_tokens=None, reasoning_tokens=0):
+  output_tokens = len(text) // 4 if output_tokens is None else output_tokens
+  return {
+    "id": f"resp_stub_{time.time_ns()}",
+    "object": "response",
+    "created_at": int(time.time()),
+    "status": "completed",
+    "model": model,
+    "output": [
+      {
+        "id": "msg_stub",
+        "type": "message",
+        "status": "completed",
+        "role": "assistant",
+        "content": [{"type": "output_text", "text": text, "annotations": []}]
+      }
+    ],
+    "parallel_tool_calls": False,
+    "tool_choice": "auto",
+    "tools": [],
+    "usage": {
+      "input_tokens": input_tokens,
+      "input_tokens_details": {"cached_tokens": 0},
+      "output_tokens": output_tokens,
+      "output_tokens_details": {"reasoning_tokens": reasoning_tokens},
+      "total_tokens": input_tokens + output_tokens
+    }
+  }
+
+
+#-----------------------------------------------------------------
+# Function to get the instructions and the prompt of a request built by request_params
+#-----------------------------------------------------------------
+def request_texts(request):
+  texts = {"developer": "", "user": ""}
+  for message in request.get("input", []):
+    if isinstance(message, dict) and message.get("role") in texts:
+      texts[message["role"]] = "".join(c.get("text", "") for c in message.get("content", []) if isinstance(c, dict))
+  return texts["developer"], texts["user"]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+  disable_nagle_algorithm = True
+  response_text = "{}"
+  throttle_rate = 0.0
+  error_rate = 0.0
+  retry_after = None
+  recording = None
+  latency = 0.0
+  tokens_per_second = None
+  max_rpm = None
+  random = random.Random(0)
+  lock = threading.Lock()
+  slots = None
+  window = deque()
+  stats = {"requests": 0, "replayed": 0, "missed": 0, "throttled": 0, "errors": 0}
+
+  #-----------------------------------------------------------------
+  # Function to configure the behaviour of every handler, the statistics are started again
+  #-----------------------------------------------------------------
+  @classmethod
+  def configure(cls, recording_path=None, response_text="{}", latency=0.0, tokens_per_second=None, max_concurrent=None,
+                max_rpm=None, throttle_rate=0.0, error_rate=0.0, retry_after=None, seed=0):
+    cls.recording = load_recording(recording_path) if recording_path else None
+    cls.response_text = response_text
+    cls.latency = latency
+    cls.tokens_per_second = tokens_per_second
+    cls.slots = threading.BoundedSemaphore(max_concurrent) if max_concurrent else None
+    cls.max_rpm = max_rpm
+    cls.throttle_rate = throttle_rate
+    cls.error_rate = error_rate
+    cls.retry_after = retry_after
+    cls.random = random.Random(seed)
+    cls.window = deque()
+    cls.stats = {"requests": 0, "replayed": 0, "missed": 0, "throttled": 0, "errors": 0}
+
+  @classmethod
+  def count(cls, name):
+    with cls.lock:
+      cls.stats[name] += 1
+
+  def send_error_response(self, status, message):
+    body = json.dumps({"error": {"message": message, "type": "stub_error", "code": None, "param": None}}).encode("utf-8")
+    self.send_response(status)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(body)))
+    if status == 429 and self.retry_after is not None:
+      self.send_header("Retry-After", str(self.retry_after))
+    self.end_headers()
+    self.wfile.write(body)
+
+  #-----------------------------------------------------------------
+  # Function to draw whether the request is throttled or fails, under the lock so that a seed gives the same draws
+  #-----------------------------------------------------------------
+  def draw_failure(self):
+    cls = type(self)
+    now = time.monotonic()
+    with cls.lock:
+      cls.stats["requests"] += 1
+      while cls.window and now - cls.window[0] > 60:
+        cls.window.popleft()
+      draw = cls.random.random()
+      if draw < cls.throttle_rate or (cls.max_rpm is not None and len(cls.window) >= cls.max_rpm):
+        cls.stats["throttled"] += 1
+        return 429
+      if draw < cls.throttle_rate + cls.error_rate:
+        cls.stats["errors"] += 1
+        return 500
+      cls.window.append(now)
+    return None
+
+  def do_POST(self):
+    length = int(self.headers.get("Content-Length", 0))
+    raw = self.rfile.read(length)
+    failure = self.draw_failure()
+    if failure == 429:
+      return self.send_error_response(429, "Rate limit reached (stub)")
+    if failure == 500:
+      return self.send_error_response(500, "Internal error (stub)")
+
+    request = json.loads(raw or b"{}")
+    if self.recording is None:
+      # Rough estimate of 4 characters per token, enough for the telemetry to show non-zero counts
+      response = build_response(self.response_text, request.get("model", ""), len(raw) // 4)
+    else:
+      instructions, prompt = request_texts(request)
+      record = self.recording.get(recording_key(instructions, prompt, self.headers.get(VARIANT_HEADER, "0")))
+      if record is None:
+        self.count("missed")
+        return self.send_error_response(404, "No recorded response for this request (stub)")
+      self.count("replayed")
+      response = build_response(record["text"], request.get("model", ""), record["input_tokens"] or len(raw) // 4,
+                                record["output_tokens"] or None, record["reasoning_tokens"])
+
+    body = json.dumps(response).encode("utf-8")
+    delay = self.latency
+    if self.tokens_per_second:
+      delay += response["usage"]["output_tokens"] / self.tokens_per_second
+    if self.slots is not None:
+      with self.slots:
+        time.sleep(delay)
+    elif delay:
+      time.sleep(delay)
+
+    self.send_response(200)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
+
+
+#-----------------------------------------------------------------
+# Function to start the stub server in a background thread
+# Returns the server and the base URL to give to the OpenAI client.
+#-----------------------------------------------------------------
+def start_stub_server(host="127.0.0.1", port=0):
+  server = ThreadingHTTPServer((host, port), StubHandler)
+  server.daemon_threads = True
+  thread = threading.Thread(target=server.serve_forever, daemon=True)
+  thread.start()
+  return server, f"http://{host}:{server.server_address[1]}/v1"
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Local stub of OpenAI's Responses API.")
+  parser.add_argument('--host', default="127.0.0.1", help='Host to listen on')
+  parser.add_argument('--port', type=int, default=8000, help='Port to listen on')
+  parser.add_argument('--replay', default=None, help='Recording of a real run (main.py --record) to answer the requests with')
+  parser.add_argument('--latency', type=float, default=0.0, help='Delay of every response, in seconds')
+  parser.add_argument('--tokens-per-second', type=float, default=None, help='Output tokens generated per second, added to the latency')
+  parser.add_argument('--max-concurrent', type=int, default=None, help='Responses generated at the same time, the others wait')
+  parser.add_argument('--max-rpm', type=int, default=None, help='Requests accepted per minute, the others are answered with 429')
+  parser.add_argument('--throttle-rate', type=float, default=0.0, help='Share of the requests answered with 429')
+  parser.add_argument('--error-rate', type=float, default=0.0, help='Share of the requests answered with 500')
+  parser.add_argument('--retry-after', type=float, default=None, help='Retry-After header of the 429 responses, in seconds')
+  parser.add_argument('--seed', type=int, default=0, help='Seed of the throttling and error draws')
+  args = parser.parse_args()
+
+  StubHandler.configure(args.replay, latency=args.latency, tokens_per_second=args.tokens_per_second, max_concurrent=args.max_concurrent,
+                        max_rpm=args.max_rpm, throttle_rate=args.throttle_rate, error_rate=args.error_rate,
+                        retry_after=args.retry_after, seed=args.seed)
+  if StubHandler.recording is not None:
+    print(f"Replaying {len(StubHandler.recording)} recorded responses of {args.replay}")
+
+  server = ThreadingHTTPServer((args.host, args.port), StubHandler)
+  print(f"Stub server listening on http://{args.host}:{args.port}/v1")
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    print(f"Stub server stopped : {StubHandler.stats}")
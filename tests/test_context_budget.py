@@ -0,0 +1,36 @@
+import os
+import sys
+import glob
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "Crop2LLM"))
+from context_budget import BudgetedSources, budget_sources, configure_context_budget, estimate_tokens
+
+BIOMA = os.path.join(ROOT, "examples", "AP_all", "bioma")
+APSIM = os.path.join(ROOT, "examples", "AP_all", "f90", "ApsimCampbell", "soiltemperature.f90")
+
+
+def budgeted_tokens(budgeted):
+  return sum(estimate_tokens(t) for t in budgeted.texts.values())
+
+
+#-----------------------------------------------------------------
+# The end of the files is cut until the texts fit, once per pass : the marker of the cut must not be cut again
+#-----------------------------------------------------------------
+def test_budget_sources_ends_on_large_sources():
+  main_file = os.path.join(BIOMA, "SoilTemperature.cs")
+  helper_files = [f for f in sorted(glob.glob(os.path.join(BIOMA, "*.cs"))) if f != main_file]
+  for max_tokens, chunk_tokens, summary_tokens in ((10000, 2000, 2000), (20000, 8000, 8000)):
+    configure_context_budget(max_tokens, chunk_tokens, summary_tokens)
+    budgeted = budget_sources(main_file, helper_files)
+    assert isinstance(budgeted, BudgetedSources)
+    assert budgeted_tokens(budgeted) <= max_tokens - min(summary_tokens, max_tokens // 4)
+  configure_context_budget(40000)
+
+
+def test_budget_sources_cuts_a_single_file():
+  configure_context_budget(20000, 8000, 8000)
+  budgeted = budget_sources(APSIM, [])
+  assert budgeted_tokens(budgeted) <= 20000 - 5000
+  assert budgeted.texts[APSIM].endswith("... end of the file summarized below ...\n")
+  configure_context_budget(40000)